@@ -0,0 +1,92 @@
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("backfill-payment-analytics")
+@click.option("--from-date", help="Rebuild rollups starting from this date")
+@click.option("--to-date", help="Rebuild rollups up to this date")
+@pass_context
+def backfill_payment_analytics(context, from_date=None, to_date=None):
+	"Rebuild Payment Analytics Rollup from Integration Request history"
+	from payments.payments.doctype.payment_analytics_rollup.payment_analytics_rollup import (
+		backfill_payment_analytics,
+	)
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		count = backfill_payment_analytics(from_date=from_date, to_date=to_date)
+		click.secho(f"Rebuilt {count} payment analytics rollups", fg="green")
+	finally:
+		frappe.destroy()
+
+
+@click.command("export-payments")
+@click.argument("file_path")
+@click.option("--format", "export_format", type=click.Choice(["csv", "ndjson"]), default="csv")
+@click.option("--gateway", help="Integration Request Service, e.g. Razorpay")
+@click.option("--status", help="Comma separated statuses, e.g. Completed,Failed")
+@click.option("--from-date", help="Export requests created on or after this date")
+@click.option("--to-date", help="Export requests created on or before this date")
+@click.option("--include-archived", is_flag=True, default=False)
+@pass_context
+def export_payments(
+	context,
+	file_path,
+	export_format="csv",
+	gateway=None,
+	status=None,
+	from_date=None,
+	to_date=None,
+	include_archived=False,
+):
+	"Stream payment requests with decoded payloads to a CSV or NDJSON file"
+	from payments.utils.export import export_payment_records
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		count = export_payment_records(
+			file_path,
+			export_format=export_format,
+			gateway=gateway,
+			status=status,
+			from_date=from_date,
+			to_date=to_date,
+			include_archived=include_archived,
+		)
+		click.secho(f"Exported {count} payment records to {file_path}", fg="green")
+	finally:
+		frappe.destroy()
+
+
+@click.command("import-settlement-file")
+@click.argument("file_path")
+@click.option(
+	"--gateway", required=True, type=click.Choice(["Razorpay", "Stripe", "PayPal"])
+)
+@pass_context
+def import_settlement_file(context, file_path, gateway):
+	"Match a gateway settlement report against Integration Requests"
+	from payments.utils.settlement import import_settlement_file
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		summary = import_settlement_file(file_path, gateway)
+		click.secho(
+			f"Read {summary.rows} payments: {summary.settled} settled, "
+			f"{summary.mismatched} mismatched, {summary.unmatched} without an Integration Request",
+			fg="green",
+		)
+		if summary.unmatched_ids:
+			click.echo("Unmatched payments: " + ", ".join(summary.unmatched_ids))
+	finally:
+		frappe.destroy()
+
+
+commands = [backfill_payment_analytics, export_payments, import_settlement_file]
@@ -0,0 +1,17 @@
+import frappe
+
+
+class GatewayUnavailableError(frappe.ValidationError):
+	"""A gateway call was refused before reaching the gateway, retry later"""
+
+	http_status_code = 503
+
+
+class CircuitOpenError(GatewayUnavailableError):
+	pass
+
+
+class DuplicatePaymentError(frappe.ValidationError):
+	"""The same checkout payment is already being processed"""
+
+	http_status_code = 409
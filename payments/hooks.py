@@ -102,13 +102,14 @@ override_doctype_class = {
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-# 	}
-# }
+doc_events = {
+	"Integration Request": {
+		"on_change": [
+			"payments.payments.doctype.payment_analytics_rollup.payment_analytics_rollup.record_status_change",
+			"payments.utils.status_cache.clear_payment_status",
+		],
+	},
+}
 
 # Scheduled Tasks
 # ---------------
@@ -116,6 +117,19 @@ override_doctype_class = {
 scheduler_events = {
 	"all": [
 		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.capture_payment",
+		"payments.utils.webhooks.flush_notification_buffer",
+		"payments.utils.webhooks.process_subscription_notifications",
+		"payments.payment_gateways.doctype.stripe_settings.stripe_settings.process_stripe_events",
+		"payments.payments.doctype.payment_callback.payment_callback.deliver_pending_callbacks",
+		"payments.payments.doctype.payment_analytics_rollup.payment_analytics_rollup.flush_rollup_buffer",
+	],
+	"hourly_long": [
+		"payments.utils.reconciliation.reconcile_stale_requests",
+		"payments.payments.doctype.gateway_subscription.gateway_subscription.sync_gateway_subscriptions",
+		"payments.utils.bulk_operation.resume_operations",
+	],
+	"daily_long": [
+		"payments.payments.doctype.integration_request_archive.integration_request_archive.archive_integration_requests",
 	],
 }
 
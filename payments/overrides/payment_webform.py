@@ -7,6 +7,7 @@ from frappe.utils import flt
 from frappe.website.doctype.web_form.web_form import WebForm
 
 from payments.utils import get_payment_gateway_controller
+from payments.utils.routing import route_payment
 
 
 class PaymentWebForm(WebForm):
@@ -24,13 +25,15 @@ class PaymentWebForm(WebForm):
 
 	def get_payment_gateway_url(self, doc):
 		if getattr(self, "accept_payment", False):
-			controller = get_payment_gateway_controller(self.payment_gateway)
-
 			title = f"Payment for {doc.doctype} {doc.name}"
 			amount = self.amount
 			if self.amount_based_on_field:
 				amount = doc.get(self.amount_field)
 
+			controller = get_payment_gateway_controller(
+				route_payment(self.currency, amount, self.payment_gateway)
+			)
+
 			from decimal import Decimal
 
 			if amount is None or Decimal(amount) <= 0:
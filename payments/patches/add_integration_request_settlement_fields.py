@@ -0,0 +1,5 @@
+from payments.utils import make_custom_fields
+
+
+def execute():
+	make_custom_fields()
@@ -8,149 +8,34 @@ import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, get_url
-
-from payments.utils import create_payment_gateway
+from frappe.utils import call_hook_method, flt, get_url
+
+from payments.exceptions import GatewayUnavailableError
+from payments.payments.doctype.payment_callback.payment_callback import (
+	authorize_reference_document,
+)
+from payments.utils import create_payment_gateway, get_payment_details_controller, http
+from payments.utils.bulkhead import gateway_call
+from payments.utils.currency import SUPPORTED_CURRENCIES, validate_transaction_currency
+from payments.utils.payment_links import get_integration_request_row
+
+BRAINTREE_TRANSACTION_STATUSES = {
+	"authorized": "Authorized",
+	"submitted_for_settlement": "Completed",
+	"settlement_pending": "Completed",
+	"settling": "Completed",
+	"settled": "Completed",
+	"authorization_expired": "Failed",
+	"failed": "Failed",
+	"gateway_rejected": "Failed",
+	"processor_declined": "Failed",
+	"settlement_declined": "Failed",
+	"voided": "Cancelled",
+}
 
 
 class BraintreeSettings(Document):
-	supported_currencies = [
-		"AED",
-		"AMD",
-		"AOA",
-		"ARS",
-		"AUD",
-		"AWG",
-		"AZN",
-		"BAM",
-		"BBD",
-		"BDT",
-		"BGN",
-		"BIF",
-		"BMD",
-		"BND",
-		"BOB",
-		"BRL",
-		"BSD",
-		"BWP",
-		"BYN",
-		"BZD",
-		"CAD",
-		"CHF",
-		"CLP",
-		"CNY",
-		"COP",
-		"CRC",
-		"CVE",
-		"CZK",
-		"DJF",
-		"DKK",
-		"DOP",
-		"DZD",
-		"EGP",
-		"ETB",
-		"EUR",
-		"FJD",
-		"FKP",
-		"GBP",
-		"GEL",
-		"GHS",
-		"GIP",
-		"GMD",
-		"GNF",
-		"GTQ",
-		"GYD",
-		"HKD",
-		"HNL",
-		"HRK",
-		"HTG",
-		"HUF",
-		"IDR",
-		"ILS",
-		"INR",
-		"ISK",
-		"JMD",
-		"JPY",
-		"KES",
-		"KGS",
-		"KHR",
-		"KMF",
-		"KRW",
-		"KYD",
-		"KZT",
-		"LAK",
-		"LBP",
-		"LKR",
-		"LRD",
-		"LSL",
-		"LTL",
-		"MAD",
-		"MDL",
-		"MKD",
-		"MNT",
-		"MOP",
-		"MUR",
-		"MVR",
-		"MWK",
-		"MXN",
-		"MYR",
-		"MZN",
-		"NAD",
-		"NGN",
-		"NIO",
-		"NOK",
-		"NPR",
-		"NZD",
-		"PAB",
-		"PEN",
-		"PGK",
-		"PHP",
-		"PKR",
-		"PLN",
-		"PYG",
-		"QAR",
-		"RON",
-		"RSD",
-		"RUB",
-		"RWF",
-		"SAR",
-		"SBD",
-		"SCR",
-		"SEK",
-		"SGD",
-		"SHP",
-		"SLL",
-		"SOS",
-		"SRD",
-		"STD",
-		"SVC",
-		"SYP",
-		"SZL",
-		"THB",
-		"TJS",
-		"TOP",
-		"TRY",
-		"TTD",
-		"TWD",
-		"TZS",
-		"UAH",
-		"UGX",
-		"USD",
-		"UYU",
-		"UZS",
-		"VEF",
-		"VND",
-		"VUV",
-		"WST",
-		"XAF",
-		"XCD",
-		"XOF",
-		"XPF",
-		"YER",
-		"ZAR",
-		"ZMK",
-		"ZWD",
-	]
+	supported_currencies = SUPPORTED_CURRENCIES["Braintree"]
 
 	def validate(self):
 		if not self.flags.ignore_mandatory:
@@ -175,26 +60,95 @@ class BraintreeSettings(Document):
 			merchant_id=self.merchant_id,
 			public_key=self.public_key,
 			private_key=self.get_password(fieldname="private_key", raise_exception=False),
+			timeout=http.get_timeout(),
 		)
 
-	def validate_transaction_currency(self, currency):
-		if currency not in self.supported_currencies:
-			frappe.throw(
-				_(
-					"Please select another payment method. Stripe does not support transactions in currency '{0}'"
-				).format(currency)
+	def get_braintree_gateway(self):
+		"""Return a gateway bound to this account, unlike `configure_braintree` it does not
+		change the global configuration so it is safe to use from worker threads"""
+		return braintree.BraintreeGateway(
+			braintree.Configuration(
+				environment=braintree.Environment.Sandbox
+				if self.use_sandbox
+				else braintree.Environment.Production,
+				merchant_id=self.merchant_id,
+				public_key=self.public_key,
+				private_key=self.get_password(fieldname="private_key", raise_exception=False),
 			)
+		)
+
+	def get_payment_status_query(self, integration_request):
+		"""Return a thread safe lookup of the transaction behind `integration_request`,
+		used by `payments.utils.reconciliation`"""
+		transaction_id = integration_request.gateway_payment_id
+		gateway = self.get_braintree_gateway()
+
+		def query():
+			if not transaction_id:
+				# checkout link that expired without a transaction, see
+				# `payments.utils.reconciliation`
+				return {"status": "Cancelled"}
+
+			transaction = gateway.transaction.find(transaction_id)
+			return {"status": BRAINTREE_TRANSACTION_STATUSES.get(transaction.status)}
+
+		return query
+
+	def get_refund_query(self, integration_request, amount=None, idempotency_key=None):
+		"""Return a thread safe refund of `amount` (or all) of the transaction behind
+		`integration_request`, used by `payments.utils.refund`"""
+		transaction_id = integration_request.gateway_payment_id
+		if not transaction_id:
+			frappe.throw(_("No Braintree transaction found for {0}").format(integration_request.name))
+
+		gateway = self.get_braintree_gateway()
+		amount = str(flt(amount, 2)) if amount else None
+
+		def refund():
+			result = gateway.transaction.refund(transaction_id, amount)
+			if not result.is_success:
+				raise Exception(result.message)
+
+			return {
+				"refund_id": result.transaction.id,
+				"refunded_amount": flt(result.transaction.amount),
+				"status": result.transaction.status,
+			}
+
+		return refund
+
+	def validate_transaction_currency(self, currency):
+		validate_transaction_currency("Braintree", currency)
 
 	def get_payment_url(self, **kwargs):
-		return get_url(f"./braintree_checkout?{urlencode(kwargs)}")
+		integration_request = create_request_log(kwargs, service_name="Braintree")
+		return get_url(f"./braintree_checkout?token={integration_request.name}")
+
+	def get_payment_url_query(self, **kwargs):
+		"""Return a thread safe builder of the checkout url, used by
+		`payments.utils.payment_links`"""
+		integration_request = get_integration_request_row(kwargs, "Braintree")
+		url = get_url(f"./braintree_checkout?token={integration_request['name']}")
+
+		return lambda: {"url": url, "integration_request": integration_request}
 
 	def create_payment_request(self, data):
 		self.data = frappe._dict(data)
 
+		if self.data.token:
+			# checkout session started by `get_payment_url`
+			self.integration_request = frappe.get_doc("Integration Request", self.data.token)
+			if self.integration_request.status != "Queued":
+				frappe.throw(_("This payment has already been processed"))
+
 		try:
-			self.integration_request = create_request_log(self.data, service_name="Braintree")
+			if not self.data.token:
+				self.integration_request = create_request_log(self.data, service_name="Braintree")
 			return self.create_charge_on_braintree()
 
+		except GatewayUnavailableError:
+			raise
+
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
 			return {
@@ -208,21 +162,24 @@ class BraintreeSettings(Document):
 			}
 
 	def create_charge_on_braintree(self):
-		self.configure_braintree()
-
 		redirect_to = self.data.get("redirect_to") or None
 		redirect_message = self.data.get("redirect_message") or None
 
-		result = braintree.Transaction.sale(
-			{
-				"amount": self.data.amount,
-				"payment_method_nonce": self.data.payload_nonce,
-				"options": {"submit_for_settlement": True},
-			}
-		)
+		with gateway_call("Braintree", self.gateway_name):
+			self.configure_braintree()
+			result = braintree.Transaction.sale(
+				{
+					"amount": self.data.amount,
+					"payment_method_nonce": self.data.payload_nonce,
+					"options": {"submit_for_settlement": True},
+				}
+			)
 
 		if result.is_success:
-			self.integration_request.db_set("status", "Completed", update_modified=False)
+			self.integration_request.db_set(
+				{"status": "Completed", "gateway_payment_id": result.transaction.id},
+				update_modified=False,
+			)
 			self.flags.status_changed_to = "Completed"
 			self.integration_request.db_set(
 				"output", result.transaction.status, update_modified=False
@@ -250,11 +207,10 @@ class BraintreeSettings(Document):
 		if self.flags.status_changed_to == "Completed":
 			status = "Completed"
 			if self.data.reference_doctype and self.data.reference_docname:
-				custom_redirect_to = None
+				custom_redirect_to = authorize_reference_document(
+					self.integration_request, self.flags.status_changed_to
+				)
 				try:
-					custom_redirect_to = frappe.get_doc(
-						self.data.reference_doctype, self.data.reference_docname
-					).run_method("on_payment_authorized", self.flags.status_changed_to)
 					braintree_success_page = frappe.get_hooks("braintree_success_page")
 					if braintree_success_page:
 						custom_redirect_to = frappe.get_attr(braintree_success_page[-1])(self.data)
@@ -277,17 +233,19 @@ class BraintreeSettings(Document):
 		return {"redirect_to": redirect_url, "status": status}
 
 
-def get_gateway_controller(doc):
-	payment_request = frappe.get_doc("Payment Request", doc)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", payment_request.payment_gateway, "gateway_controller"
-	)
-	return gateway_controller
+def get_gateway_controller(payment_details):
+	"""Return the Braintree Settings of a checkout session, the account the payment was
+	routed to if it was"""
+	controller = get_payment_details_controller(payment_details, "Braintree")
+	if controller.doctype != "Braintree Settings":
+		frappe.throw(_("{0} is not a Braintree account").format(controller.name))
+
+	return controller.name
 
 
-def get_client_token(doc):
-	gateway_controller = get_gateway_controller(doc)
+def get_client_token(gateway_controller):
 	settings = frappe.get_doc("Braintree Settings", gateway_controller)
-	settings.configure_braintree()
 
-	return braintree.ClientToken.generate()
+	with gateway_call("Braintree", settings.gateway_name):
+		settings.configure_braintree()
+		return braintree.ClientToken.generate()
@@ -70,10 +70,57 @@ import pytz
 from frappe import _
 from frappe.integrations.utils import create_request_log, make_post_request
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, get_datetime, get_url
+from frappe.utils import call_hook_method, cint, flt, get_datetime, get_url
 from frappe.utils.data import get_system_timezone
 
-from payments.utils import create_payment_gateway
+from payments.payments.doctype.gateway_subscription.gateway_subscription import (
+	get_subscription_state,
+	record_subscription_state,
+	update_subscription,
+)
+from payments.payments.doctype.payment_callback.payment_callback import (
+	authorize_reference_document,
+)
+from payments.utils import (
+	create_payment_gateway,
+	get_request_data,
+	http,
+	set_integration_request_status,
+)
+from payments.utils.bulkhead import gateway_call
+from payments.utils.currency import SUPPORTED_CURRENCIES, validate_transaction_currency
+from payments.utils.payment_links import get_integration_request_row
+from payments.utils.webhooks import (
+	claim_notification,
+	is_async_webhooks_enabled,
+	is_batch_notifications_enabled,
+	is_buffered_webhooks_enabled,
+	receive_notification,
+	release_notification,
+	schedule_subscription_notifications,
+)
+
+# IPN transaction types sent when a recurring payments profile changes its status
+PAYPAL_PROFILE_STATUS_NOTIFICATIONS = (
+	"recurring_payment_profile_created",
+	"recurring_payment_profile_cancel",
+	"recurring_payment_expired",
+	"recurring_payment_suspended",
+	"recurring_payment_suspended_due_to_max_failed_payment",
+)
+
+# ManageRecurringPaymentsProfileStatus action of the bulk subscription operation actions
+PAYPAL_SUBSCRIPTION_ACTIONS = {
+	"Cancel": "Cancel",
+	"Pause": "Suspend",
+	"Resume": "Reactivate",
+}
+
+PAYPAL_PROFILE_ACTION_STATUSES = {
+	"Cancel": "Cancelled",
+	"Suspend": "Suspended",
+	"Reactivate": "Active",
+}
 
 api_path = (
 	"/api/method/payments.payment_gateways.doctype.paypal_settings.paypal_settings"
@@ -81,33 +128,7 @@ api_path = (
 
 
 class PayPalSettings(Document):
-	supported_currencies = [
-		"AUD",
-		"BRL",
-		"CAD",
-		"CZK",
-		"DKK",
-		"EUR",
-		"HKD",
-		"HUF",
-		"ILS",
-		"JPY",
-		"MYR",
-		"MXN",
-		"TWD",
-		"NZD",
-		"NOK",
-		"PHP",
-		"PLN",
-		"GBP",
-		"RUB",
-		"SGD",
-		"SEK",
-		"CHF",
-		"THB",
-		"TRY",
-		"USD",
-	]
+	supported_currencies = SUPPORTED_CURRENCIES["PayPal"]
 
 	def __setup__(self):
 		setattr(self, "use_sandbox", 0)
@@ -126,12 +147,7 @@ class PayPalSettings(Document):
 		pass
 
 	def validate_transaction_currency(self, currency):
-		if currency not in self.supported_currencies:
-			frappe.throw(
-				_(
-					"Please select another payment method. PayPal does not support transactions in currency '{0}'"
-				).format(currency)
-			)
+		validate_transaction_currency("PayPal", currency)
 
 	def get_paypal_params_and_url(self):
 		params = {
@@ -177,13 +193,6 @@ class PayPalSettings(Document):
 
 		response = self.execute_set_express_checkout(**kwargs)
 
-		if self.paypal_sandbox or self.use_sandbox:
-			return_url = (
-				"https://www.sandbox.paypal.com/cgi-bin/webscr?cmd=_express-checkout&token={0}"
-			)
-		else:
-			return_url = "https://www.paypal.com/cgi-bin/webscr?cmd=_express-checkout&token={0}"
-
 		kwargs.update(
 			{
 				"token": response.get("TOKEN")[0],
@@ -193,9 +202,57 @@ class PayPalSettings(Document):
 
 		create_request_log(kwargs, service_name="PayPal", name=kwargs["token"])
 
-		return return_url.format(kwargs["token"])
+		return self.get_express_checkout_url(kwargs["token"])
+
+	def get_payment_url_query(self, **kwargs):
+		"""Return a thread safe SetExpressCheckout call returning the checkout url, used by
+		`payments.utils.payment_links`"""
+		setattr(self, "use_sandbox", cint(kwargs.get("use_sandbox", 0)))
+
+		params, url = self.get_set_express_checkout_params(**kwargs)
+		checkout_url = self.get_express_checkout_url("{0}")
+		error_message = _("Looks like something is wrong with this site's Paypal configuration.")
+
+		def query():
+			response = http.make_post_request(url, data=params)
+
+			if response.get("ACK")[0] != "Success":
+				raise Exception(error_message)
+
+			token = response.get("TOKEN")[0]
+			data = dict(kwargs, token=token, correlation_id=response.get("CORRELATIONID")[0])
+
+			return {
+				"url": checkout_url.format(token),
+				"integration_request": get_integration_request_row(data, "PayPal", name=token),
+			}
+
+		return query
+
+	def get_express_checkout_url(self, token):
+		if self.paypal_sandbox or self.use_sandbox:
+			return_url = (
+				"https://www.sandbox.paypal.com/cgi-bin/webscr?cmd=_express-checkout&token={0}"
+			)
+		else:
+			return_url = "https://www.paypal.com/cgi-bin/webscr?cmd=_express-checkout&token={0}"
+
+		return return_url.format(token)
 
 	def execute_set_express_checkout(self, **kwargs):
+		params, url = self.get_set_express_checkout_params(**kwargs)
+
+		with gateway_call("PayPal"):
+			response = http.make_post_request(url, data=params)
+
+		if response.get("ACK")[0] != "Success":
+			frappe.throw(
+				_("Looks like something is wrong with this site's Paypal configuration.")
+			)
+
+		return response
+
+	def get_set_express_checkout_params(self, **kwargs):
 		params, url = self.get_paypal_params_and_url()
 
 		params.update(
@@ -212,15 +269,83 @@ class PayPalSettings(Document):
 		if kwargs.get("subscription_details"):
 			self.configure_recurring_payments(params, kwargs)
 
-		params = urlencode(params)
-		response = make_post_request(url, data=params.encode("utf-8"))
+		return params, url
 
-		if response.get("ACK")[0] != "Success":
-			frappe.throw(
-				_("Looks like something is wrong with this site's Paypal configuration.")
-			)
+	def get_payment_status_query(self, integration_request):
+		"""Return a thread safe lookup of the express checkout behind `integration_request`,
+		used by `payments.utils.reconciliation`"""
+		if get_request_data(integration_request).get("subscription_details"):
+			return
 
-		return response
+		token = integration_request.name
+		self.setup_sandbox_env(token)
+		params, url = self.get_paypal_params_and_url()
+		params.update({"METHOD": "GetExpressCheckoutDetails", "TOKEN": token})
+
+		def query():
+			response = http.make_post_request(url, data=params)
+
+			if response.get("ACK")[0] != "Success":
+				# error code 10410 indicates the token is invalid or has expired,
+				# which happens 3 hours after checkout was started without paying
+				if response.get("L_ERRORCODE0", [None])[0] == "10410":
+					return {"status": "Cancelled"}
+
+				return {"status": None}
+
+			checkout_status = response.get("CHECKOUTSTATUS", [None])[0]
+			if checkout_status == "PaymentActionCompleted":
+				transaction_id = response.get("PAYMENTREQUEST_0_TRANSACTIONID", [None])[0]
+				return {
+					"status": "Completed",
+					"gateway_payment_id": transaction_id,
+					"data": {"transaction_id": transaction_id},
+				}
+			elif checkout_status == "PaymentActionFailed":
+				return {"status": "Failed"}
+
+			return {"status": None}
+
+		return query
+
+	def get_refund_query(self, integration_request, amount=None, idempotency_key=None):
+		"""Return a thread safe refund of `amount` (or all) of the transaction behind
+		`integration_request`, used by `payments.utils.refund`"""
+		data = get_request_data(integration_request)
+		transaction_id = integration_request.gateway_payment_id or data.get("transaction_id")
+		if not transaction_id:
+			frappe.throw(_("No PayPal transaction found for {0}").format(integration_request.name))
+
+		setattr(self, "use_sandbox", cint(data.get("use_sandbox")))
+		params, url = self.get_paypal_params_and_url()
+		params.update(
+			{
+				"METHOD": "RefundTransaction",
+				"TRANSACTIONID": transaction_id,
+				"REFUNDTYPE": "Partial" if amount else "Full",
+			}
+		)
+		if amount:
+			params.update({"AMT": flt(amount, 2), "CURRENCYCODE": data.get("currency").upper()})
+		if idempotency_key:
+			# paypal ignores a refund repeating the message submission id of an earlier one
+			params["MSGSUBID"] = idempotency_key
+
+		error_message = _("Failed while refunding the payment")
+
+		def refund():
+			response = http.make_post_request(url, data=params)
+
+			if response.get("ACK")[0] not in ("Success", "SuccessWithWarning"):
+				raise Exception(response.get("L_LONGMESSAGE0", [error_message])[0])
+
+			return {
+				"refund_id": response.get("REFUNDTRANSACTIONID")[0],
+				"refunded_amount": flt(response.get("GROSSREFUNDAMT", [0])[0]),
+				"status": response.get("REFUNDSTATUS", [None])[0],
+			}
+
+		return refund
 
 	def configure_recurring_payments(self, params, kwargs):
 		# removing the params as we have to setup rucurring payments
@@ -277,7 +402,8 @@ def get_express_checkout_details(token):
 		params, url = doc.get_paypal_params_and_url()
 		params.update({"METHOD": "GetExpressCheckoutDetails", "TOKEN": token})
 
-		response = make_post_request(url, data=params)
+		with gateway_call("PayPal"):
+			response = http.make_post_request(url, data=params)
 
 		if response.get("ACK")[0] != "Success":
 			frappe.respond_as_web_page(
@@ -325,11 +451,14 @@ def confirm_payment(token):
 			}
 		)
 
-		response = make_post_request(url, data=params)
+		with gateway_call("PayPal"):
+			response = http.make_post_request(url, data=params)
 
 		if response.get("ACK")[0] == "Success":
-			update_integration_request_status(
-				token,
+			doc = frappe.get_doc("Integration Request", token)
+			doc.gateway_payment_id = response.get("PAYMENTINFO_0_TRANSACTIONID")[0]
+			set_integration_request_status(
+				doc,
 				{
 					"transaction_id": response.get("PAYMENTINFO_0_TRANSACTIONID")[0],
 					"correlation_id": response.get("CORRELATIONID")[0],
@@ -337,11 +466,8 @@ def confirm_payment(token):
 				"Completed",
 			)
 
-			if data.get("reference_doctype") and data.get("reference_docname"):
-				custom_redirect_to = frappe.get_doc(
-					data.get("reference_doctype"), data.get("reference_docname")
-				).run_method("on_payment_authorized", "Completed")
-				frappe.db.commit()
+			custom_redirect_to = authorize_reference_document(doc, "Completed", data)
+			frappe.db.commit()
 
 			redirect_url = "payment-success?doctype={}&docname={}".format(
 				data.get("reference_doctype"), data.get("reference_docname")
@@ -400,11 +526,13 @@ def create_recurring_profile(token, payerid):
 		# "PROFILESTARTDATE": datetime.utcfromtimestamp(get_timestamp(starts_at)).isoformat()
 		params.update({"PROFILESTARTDATE": starts_at.isoformat()})
 
-		response = make_post_request(url, data=params)
+		with gateway_call("PayPal"):
+			response = http.make_post_request(url, data=params)
 
 		if response.get("ACK")[0] == "Success":
-			update_integration_request_status(
-				token,
+			doc = frappe.get_doc("Integration Request", token)
+			set_integration_request_status(
+				doc,
 				{
 					"profile_id": response.get("PROFILEID")[0],
 				},
@@ -414,11 +542,8 @@ def create_recurring_profile(token, payerid):
 			if data.get("reference_doctype") and data.get("reference_docname"):
 				data["subscription_id"] = response.get("PROFILEID")[0]
 
-				frappe.flags.data = data
-				custom_redirect_to = frappe.get_doc(
-					data.get("reference_doctype"), data.get("reference_docname")
-				).run_method("on_payment_authorized", status_changed_to)
-				frappe.db.commit()
+				custom_redirect_to = authorize_reference_document(doc, status_changed_to, data)
+			frappe.db.commit()
 
 			redirect_url = "payment-success?doctype={}&docname={}".format(
 				data.get("reference_doctype"), data.get("reference_docname")
@@ -468,9 +593,31 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 	):
 		frappe.throw(_("Failed while amending subscription"))
 
+	if response.get("ACK")[0] == "Success":
+		status = PAYPAL_PROFILE_ACTION_STATUSES[action]
+		update_subscription(
+			"PayPal", profile_id, {"gateway_status": status, "is_active": status == "Active"}
+		)
+
 
 @frappe.whitelist(allow_guest=True)
 def ipn_handler():
+	event_key = claim_notification(
+		"PayPal", frappe.local.form_dict, frappe.local.form_dict.get("ipn_track_id")
+	)
+	if not event_key:
+		# redelivery of a notification that has already been received
+		return
+
+	if is_async_webhooks_enabled() or is_buffered_webhooks_enabled():
+		try:
+			receive_notification("PayPal", frappe.local.form_dict)
+		except Exception:
+			release_notification("PayPal", event_key)
+			raise
+
+		return
+
 	try:
 		data = frappe.local.form_dict
 
@@ -489,17 +636,21 @@ def ipn_handler():
 		).insert(ignore_permissions=True)
 		frappe.db.commit()
 
-		frappe.enqueue(
-			method="payments.payment_gateways.doctype.paypal_settings.paypal_settings.handle_subscription_notification",
-			queue="long",
-			timeout=600,
-			is_async=True,
-			**{"doctype": "Integration Request", "docname": doc.name},
-		)
+		if is_batch_notifications_enabled():
+			schedule_subscription_notifications()
+		else:
+			frappe.enqueue(
+				method="payments.payment_gateways.doctype.paypal_settings.paypal_settings.handle_subscription_notification",
+				queue="long",
+				timeout=600,
+				is_async=True,
+				**{"doctype": "Integration Request", "docname": doc.name},
+			)
 
 	except frappe.InvalidStatusError:
 		pass
 	except Exception as e:
+		release_notification("PayPal", event_key)
 		frappe.log(frappe.log_error(title=e))
 
 
@@ -510,21 +661,81 @@ def validate_ipn_request(data):
 	if not data.get("recurring_payment_id"):
 		_throw()
 
+	# any known profile is valid, notifications also report cancellations and failed
+	# payments. Those change its status, which they carry, or it is refreshed.
+	changes_status = data.get("txn_type") in PAYPAL_PROFILE_STATUS_NOTIFICATIONS
+	if changes_status and data.get("profile_status"):
+		record_subscription_state(
+			"PayPal",
+			data.get("recurring_payment_id"),
+			{
+				"gateway_status": data.get("profile_status"),
+				"is_active": data.get("profile_status") == "Active",
+			},
+		)
+
+	if not get_subscription_state(
+		"PayPal",
+		data.get("recurring_payment_id"),
+		data=data,
+		refresh=changes_status and not data.get("profile_status"),
+	):
+		_throw()
+
+
+def get_subscription_status_query(profile_id, data=None):
+	"""Return a thread safe lookup of the status of a recurring payments profile, used by
+	`payments.payments.doctype.gateway_subscription`"""
 	doc = frappe.get_doc("PayPal Settings")
 	params, url = doc.get_paypal_params_and_url()
-
 	params.update(
 		{
 			"METHOD": "GetRecurringPaymentsProfileDetails",
-			"PROFILEID": data.get("recurring_payment_id"),
+			"PROFILEID": profile_id,
 		}
 	)
 
-	params = urlencode(params)
-	res = make_post_request(url=url, data=params.encode("utf-8"))
+	def query():
+		res = http.make_post_request(url, data=params)
 
-	if res["ACK"][0] != "Success":
-		_throw()
+		if res["ACK"][0] != "Success":
+			return
+
+		status = res.get("STATUS", [None])[0]
+		return {"gateway_status": status, "is_active": status == "Active"}
+
+	return query
+
+
+def get_subscription_action_query(profile_id, action, data=None):
+	"""Return a thread safe call applying `action` (Cancel, Pause or Resume) to a recurring
+	payments profile, used by `payments.payments.doctype.subscription_operation`"""
+	doc = frappe.get_doc("PayPal Settings")
+	params, url = doc.get_paypal_params_and_url()
+	profile_action = PAYPAL_SUBSCRIPTION_ACTIONS[action]
+	params.update(
+		{
+			"METHOD": "ManageRecurringPaymentsProfileStatus",
+			"PROFILEID": profile_id,
+			"ACTION": profile_action,
+		}
+	)
+	error_message = _("Failed while amending subscription")
+
+	def query():
+		response = http.make_post_request(url, data=params)
+
+		if response.get("ACK")[0] != "Success":
+			# error code 11556 indicates the profile is not in a state the action applies to
+			if response.get("L_ERRORCODE0", [None])[0] == "11556":
+				return
+
+			raise Exception(response.get("L_LONGMESSAGE0", [error_message])[0])
+
+		status = PAYPAL_PROFILE_ACTION_STATUSES[profile_action]
+		return {"gateway_status": status, "is_active": status == "Active"}
+
+	return query
 
 
 def handle_subscription_notification(doctype, docname):
@@ -5,7 +5,6 @@ import json
 from urllib.parse import urlencode
 
 import frappe
-import requests
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
@@ -20,23 +19,29 @@ from frappe.utils import (
 from frappe.utils.password import get_decrypted_password
 from paytmchecksum import generateSignature, verifySignature
 
-from payments.utils import create_payment_gateway
+from payments.payments.doctype.payment_callback.payment_callback import (
+	authorize_reference_document,
+)
+from payments.utils import create_payment_gateway, get_request_data, http
+from payments.utils.bulkhead import gateway_call
+from payments.utils.currency import SUPPORTED_CURRENCIES, validate_transaction_currency
+from payments.utils.payment_links import get_integration_request_row
+
+PAYTM_TRANSACTION_STATUSES = {
+	"TXN_SUCCESS": "Completed",
+	"TXN_FAILURE": "Failed",
+}
 
 
 class PaytmSettings(Document):
-	supported_currencies = ["INR"]
+	supported_currencies = SUPPORTED_CURRENCIES["Paytm"]
 
 	def validate(self):
 		create_payment_gateway("Paytm")
 		call_hook_method("payment_gateway_enabled", gateway="Paytm")
 
 	def validate_transaction_currency(self, currency):
-		if currency not in self.supported_currencies:
-			frappe.throw(
-				_(
-					"Please select another payment method. Paytm does not support transactions in currency '{0}'"
-				).format(currency)
-			)
+		validate_transaction_currency("Paytm", currency)
 
 	def get_payment_url(self, **kwargs):
 		"""Return payment url with several params"""
@@ -46,6 +51,82 @@ class PaytmSettings(Document):
 
 		return get_url(f"./paytm_checkout?{urlencode(kwargs)}")
 
+	def get_payment_url_query(self, **kwargs):
+		"""Return a thread safe builder of the checkout url, used by
+		`payments.utils.payment_links`"""
+		integration_request = get_integration_request_row(kwargs, "Paytm")
+		kwargs.update(dict(order_id=integration_request["name"]))
+		url = get_url(f"./paytm_checkout?{urlencode(kwargs)}")
+
+		return lambda: {"url": url, "integration_request": integration_request}
+
+	def get_payment_status_query(self, integration_request):
+		"""Return a thread safe lookup of the order behind `integration_request`,
+		used by `payments.utils.reconciliation`"""
+		paytm_config = get_paytm_config()
+		paytm_params = dict(MID=paytm_config.merchant_id, ORDERID=integration_request.name)
+		paytm_params["CHECKSUMHASH"] = generateSignature(paytm_params, paytm_config.merchant_key)
+		url = paytm_config.transaction_status_url
+
+		def query():
+			response = http.make_post_request(
+				url, data=json.dumps(paytm_params), headers={"Content-type": "application/json"}
+			)
+
+			# response code 334 indicates an invalid order id, the buyer never reached paytm
+			if response.get("RESPCODE") == "334":
+				return {"status": "Cancelled"}
+
+			return {
+				"status": PAYTM_TRANSACTION_STATUSES.get(response.get("STATUS")),
+				"gateway_payment_id": response.get("TXNID"),
+			}
+
+		return query
+
+	def get_refund_query(self, integration_request, amount=None, idempotency_key=None):
+		"""Return a thread safe refund of `amount` (or all) of the order behind
+		`integration_request`, used by `payments.utils.refund`"""
+		txn_id = integration_request.gateway_payment_id
+		if not txn_id:
+			frappe.throw(_("No Paytm transaction found for {0}").format(integration_request.name))
+
+		paytm_config = get_paytm_config()
+		body = {
+			"mid": paytm_config.merchant_id,
+			"txnType": "REFUND",
+			"orderId": integration_request.name,
+			"txnId": txn_id,
+			# paytm refunds only once per reference id
+			"refId": idempotency_key or frappe.generate_hash(length=20),
+			"refundAmount": cstr(
+				flt(amount or get_request_data(integration_request).get("amount"), 2)
+			),
+		}
+		payload = {
+			"body": body,
+			"head": {"signature": generateSignature(json.dumps(body), paytm_config.merchant_key)},
+		}
+		url = paytm_config.refund_url
+
+		def refund():
+			response = http.make_post_request(
+				url, data=json.dumps(payload), headers={"Content-type": "application/json"}
+			)
+
+			response_body = response.get("body") or {}
+			result = response_body.get("resultInfo") or {}
+			if result.get("resultStatus") == "TXN_FAILURE":
+				raise Exception(result.get("resultMsg"))
+
+			return {
+				"refund_id": response_body.get("refundId"),
+				"refunded_amount": flt(response_body.get("refundAmount")),
+				"status": result.get("resultStatus"),
+			}
+
+		return refund
+
 
 def get_paytm_config():
 	"""Returns paytm config"""
@@ -65,6 +146,7 @@ def get_paytm_config():
 				website="WEBSTAGING",
 				url="https://securegw-stage.paytm.in/order/process",
 				transaction_status_url="https://securegw-stage.paytm.in/order/status",
+				refund_url="https://securegw-stage.paytm.in/refund/apply",
 				industry_type_id="RETAIL",
 			)
 		)
@@ -73,6 +155,7 @@ def get_paytm_config():
 			dict(
 				url="https://securegw.paytm.in/order/process",
 				transaction_status_url="https://securegw.paytm.in/order/status",
+				refund_url="https://securegw.paytm.in/refund/apply",
 			)
 		)
 	return paytm_config
@@ -148,9 +231,10 @@ def verify_transaction_status(paytm_config, order_id):
 	post_data = json.dumps(paytm_params)
 	url = paytm_config.transaction_status_url
 
-	response = requests.post(
-		url, data=post_data, headers={"Content-type": "application/json"}
-	).json()
+	with gateway_call("Paytm"):
+		response = http.make_post_request(
+			url, data=post_data, headers={"Content-type": "application/json"}
+		)
 	finalize_request(order_id, response)
 
 
@@ -162,15 +246,12 @@ def finalize_request(order_id, transaction_response):
 
 	if transaction_response["STATUS"] == "TXN_SUCCESS":
 		if transaction_data.reference_doctype and transaction_data.reference_docname:
-			custom_redirect_to = None
-			try:
-				custom_redirect_to = frappe.get_doc(
-					transaction_data.reference_doctype, transaction_data.reference_docname
-				).run_method("on_payment_authorized", "Completed")
-				request.db_set("status", "Completed")
-			except Exception:
-				request.db_set("status", "Failed")
-				frappe.log_error(frappe.get_traceback())
+			request.db_set(
+				{"status": "Completed", "gateway_payment_id": transaction_response.get("TXNID")}
+			)
+			custom_redirect_to = authorize_reference_document(
+				request, "Completed", transaction_data
+			)
 
 			if custom_redirect_to:
 				redirect_to = custom_redirect_to
@@ -75,11 +75,95 @@ from frappe.integrations.utils import (
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, get_timestamp, get_url
 
-from payments.utils import create_payment_gateway
+from payments.exceptions import GatewayUnavailableError
+from payments.payments.doctype.gateway_subscription.gateway_subscription import (
+	is_subscription_active,
+	record_subscription_state,
+	update_subscription,
+)
+from payments.payments.doctype.payment_callback.payment_callback import (
+	authorize_reference_document,
+)
+from payments.utils import (
+	create_payment_gateway,
+	get_request_data,
+	http,
+	set_integration_request_status,
+)
+from payments.utils.bulkhead import gateway_call
+from payments.utils.currency import (
+	SUPPORTED_CURRENCIES,
+	from_minor_units,
+	to_minor_units,
+	validate_transaction_currency,
+)
+from payments.utils.payment_links import get_integration_request_row
+from payments.utils.reconciliation import is_checkout_session_expired
+from payments.utils.status_cache import get_payment_status_cache, invalidate_payment_status
+from payments.utils.velocity import velocity_limit
+from payments.utils.webhooks import (
+	claim_notification,
+	is_async_webhooks_enabled,
+	is_batch_notifications_enabled,
+	is_buffered_webhooks_enabled,
+	receive_notification,
+	release_notification,
+	schedule_subscription_notifications,
+)
+
+# webhook events sent when a subscription changes its status
+RAZORPAY_SUBSCRIPTION_STATUS_EVENTS = (
+	"subscription.activated",
+	"subscription.pending",
+	"subscription.halted",
+	"subscription.paused",
+	"subscription.resumed",
+	"subscription.cancelled",
+	"subscription.completed",
+)
+
+# endpoint and payload of the bulk subscription operation actions
+RAZORPAY_SUBSCRIPTION_ACTIONS = {
+	"Cancel": ("cancel", {"cancel_at_cycle_end": 0}),
+	"Pause": ("pause", {"pause_at": "now"}),
+	"Resume": ("resume", {"resume_at": "now"}),
+}
+
+RAZORPAY_PAYMENT_STATUSES = {
+	"authorized": "Authorized",
+	"captured": "Completed",
+	"refunded": "Completed",
+	"failed": "Failed",
+}
+
+
+def get_payment_status(payment):
+	"""Return the Integration Request status of a Razorpay payment"""
+	return RAZORPAY_PAYMENT_STATUSES.get(payment.get("status"))
+
+
+def get_order_payment_status(order_id, settings, expired):
+	"""Return the reconciled status of an order from its captured or authorized payment"""
+	resp = http.make_get_request(
+		f"https://api.razorpay.com/v1/orders/{order_id}/payments",
+		auth=(settings.api_key, settings.api_secret),
+	)
+	payments = {payment.get("status"): payment for payment in resp.get("items") or []}
+	payment = payments.get("captured") or payments.get("authorized")
+
+	if not payment:
+		# not paid yet, abandoned orders are cancelled like expired checkout links
+		return {"status": "Cancelled" if expired else None}
+
+	return {
+		"status": get_payment_status(payment),
+		"gateway_payment_id": payment["id"],
+		"data": {"razorpay_payment_id": payment["id"], "razorpay_order_id": order_id},
+	}
 
 
 class RazorpaySettings(Document):
-	supported_currencies = ["INR"]
+	supported_currencies = SUPPORTED_CURRENCIES["Razorpay"]
 
 	def init_client(self):
 		if self.api_key:
@@ -106,12 +190,7 @@ class RazorpaySettings(Document):
 				frappe.throw(_("Seems API Key or API Secret is wrong !!!"))
 
 	def validate_transaction_currency(self, currency):
-		if currency not in self.supported_currencies:
-			frappe.throw(
-				_(
-					"Please select another payment method. Razorpay does not support transactions in currency '{0}'"
-				).format(currency)
-			)
+		validate_transaction_currency("Razorpay", currency)
 
 	def setup_addon(self, settings, **kwargs):
 		"""
@@ -203,11 +282,19 @@ class RazorpaySettings(Document):
 		integration_request = create_request_log(kwargs, service_name="Razorpay")
 		return get_url(f"./razorpay_checkout?token={integration_request.name}")
 
+	def get_payment_url_query(self, **kwargs):
+		"""Return a thread safe builder of the checkout url, used by
+		`payments.utils.payment_links`"""
+		integration_request = get_integration_request_row(kwargs, "Razorpay")
+		url = get_url(f"./razorpay_checkout?token={integration_request['name']}")
+
+		return lambda: {"url": url, "integration_request": integration_request}
+
 	def create_order(self, **kwargs):
 		# Creating Orders https://razorpay.com/docs/api/orders/
 
 		# convert rupees to paisa
-		kwargs["amount"] *= 100
+		kwargs["amount"] = to_minor_units(kwargs["amount"], "INR")
 
 		# Create integration log
 		integration_request = create_request_log(kwargs, service_name="Razorpay")
@@ -221,16 +308,21 @@ class RazorpaySettings(Document):
 		}
 		if self.api_key and self.api_secret:
 			try:
-				order = make_post_request(
-					"https://api.razorpay.com/v1/orders",
-					auth=(
-						self.api_key,
-						self.get_password(fieldname="api_secret", raise_exception=False),
-					),
-					data=payment_options,
-				)
+				with gateway_call("Razorpay"):
+					order = http.make_post_request(
+						"https://api.razorpay.com/v1/orders",
+						auth=(
+							self.api_key,
+							self.get_password(fieldname="api_secret", raise_exception=False),
+						),
+						data=payment_options,
+					)
+				# kept to find the payment of the order if its callback never arrives
+				integration_request.db_set("request_id", order.get("id"))
 				order["integration_request"] = integration_request.name
 				return order  # Order returned to be consumed by razorpay.js
+			except GatewayUnavailableError:
+				raise
 			except Exception:
 				frappe.log(frappe.get_traceback())
 				frappe.throw(_("Could not create razorpay order"))
@@ -238,11 +330,20 @@ class RazorpaySettings(Document):
 	def create_request(self, data):
 		self.data = frappe._dict(data)
 
+		if frappe.db.get_value("Integration Request", self.data.token, "status") in (
+			"Authorized",
+			"Completed",
+		):
+			frappe.throw(_("This payment has already been processed"))
+
 		try:
 			self.integration_request = frappe.get_doc("Integration Request", self.data.token)
 			self.integration_request.update_status(self.data, "Queued")
 			return self.authorize_payment()
 
+		except GatewayUnavailableError:
+			raise
+
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
 			return {
@@ -264,18 +365,28 @@ class RazorpaySettings(Document):
 		data = json.loads(self.integration_request.data)
 		settings = self.get_settings(data)
 
+		if self.data.razorpay_payment_id:
+			self.integration_request.gateway_payment_id = self.data.razorpay_payment_id
+
+		def fetch():
+			with gateway_call("Razorpay"):
+				return http.make_get_request(
+					f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
+					auth=(settings.api_key, settings.api_secret),
+				)
+
+		resp = None
 		try:
-			resp = make_get_request(
-				f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
-				auth=(settings.api_key, settings.api_secret),
+			resp = get_payment_status_cache("Razorpay", self.data.razorpay_payment_id).get(
+				fetch, get_payment_status
 			)
 
 			if resp.get("status") == "authorized":
-				self.integration_request.update_status(data, "Authorized")
+				set_integration_request_status(self.integration_request, data, "Authorized")
 				self.flags.status_changed_to = "Authorized"
 
 			elif resp.get("status") == "captured":
-				self.integration_request.update_status(data, "Completed")
+				set_integration_request_status(self.integration_request, data, "Completed")
 				self.flags.status_changed_to = "Completed"
 
 			elif data.get("subscription_id"):
@@ -284,30 +395,28 @@ class RazorpaySettings(Document):
 					# razorpay refunds the amount after authorizing the card details
 					# thus changing status to Verified
 
-					self.integration_request.update_status(data, "Completed")
+					set_integration_request_status(self.integration_request, data, "Completed")
 					self.flags.status_changed_to = "Verified"
 
 			else:
 				frappe.log_error(message=str(resp), title="Razorpay Payment not authorized")
 
+		except GatewayUnavailableError:
+			raise
+
 		except Exception:
 			frappe.log_error()
 
-		status = frappe.flags.integration_request.status_code
+		# 200 once Razorpay answered, the page then follows `redirect_to` to the outcome
+		status = 200 if resp is not None else 500
 
 		redirect_to = data.get("redirect_to") or None
 		redirect_message = data.get("redirect_message") or None
 		if self.flags.status_changed_to in ("Authorized", "Verified", "Completed"):
 			if self.data.reference_doctype and self.data.reference_docname:
-				custom_redirect_to = None
-				try:
-					frappe.flags.data = data
-					custom_redirect_to = frappe.get_doc(
-						self.data.reference_doctype, self.data.reference_docname
-					).run_method("on_payment_authorized", self.flags.status_changed_to)
-
-				except Exception:
-					frappe.log_error(frappe.get_traceback())
+				custom_redirect_to = authorize_reference_document(
+					self.integration_request, self.flags.status_changed_to, data
+				)
 
 				if custom_redirect_to:
 					redirect_to = custom_redirect_to
@@ -343,6 +452,68 @@ class RazorpaySettings(Document):
 
 		return settings
 
+	def get_payment_status_query(self, integration_request):
+		"""Return a thread safe lookup of the payment behind `integration_request`,
+		used by `payments.utils.reconciliation`"""
+		data = get_request_data(integration_request)
+		settings = self.get_settings(data)
+		payment_id = integration_request.gateway_payment_id or data.get("razorpay_payment_id")
+		order_id = data.get("razorpay_order_id") or integration_request.get("request_id")
+		status_cache = payment_id and get_payment_status_cache("Razorpay", payment_id)
+		expired = is_checkout_session_expired(integration_request)
+
+		def query():
+			if not payment_id and order_id:
+				# the callback of the order payment may have been lost
+				return get_order_payment_status(order_id, settings, expired)
+
+			if not payment_id:
+				# checkout was closed before paying
+				return {"status": "Cancelled"}
+
+			resp = status_cache.get(
+				lambda: http.make_get_request(
+					f"https://api.razorpay.com/v1/payments/{payment_id}",
+					auth=(settings.api_key, settings.api_secret),
+				),
+				get_payment_status,
+			)
+
+			return {
+				"status": get_payment_status(resp),
+				"gateway_payment_id": payment_id,
+				"data": {"razorpay_payment_id": payment_id},
+			}
+
+		return query
+
+	def get_refund_query(self, integration_request, amount=None, idempotency_key=None):
+		"""Return a thread safe refund of `amount` (or all) of the payment behind
+		`integration_request`, used by `payments.utils.refund`"""
+		data = get_request_data(integration_request)
+		settings = self.get_settings(data)
+		payment_id = integration_request.gateway_payment_id or data.get("razorpay_payment_id")
+		if not payment_id:
+			frappe.throw(_("No Razorpay payment found for {0}").format(integration_request.name))
+
+		# convert rupees to paisa, razorpay refunds the whole payment without an amount
+		payload = {"amount": to_minor_units(amount, "INR")} if amount else {}
+
+		def refund():
+			resp = http.make_post_request(
+				f"https://api.razorpay.com/v1/payments/{payment_id}/refund",
+				auth=(settings.api_key, settings.api_secret),
+				json=payload,
+			)
+
+			return {
+				"refund_id": resp.get("id"),
+				"refunded_amount": from_minor_units(resp.get("amount"), "INR"),
+				"status": resp.get("status"),
+			}
+
+		return refund
+
 	def cancel_subscription(self, subscription_id):
 		settings = self.get_settings({})
 
@@ -351,6 +522,12 @@ class RazorpaySettings(Document):
 				f"https://api.razorpay.com/v1/subscriptions/{subscription_id}/cancel",
 				auth=(settings.api_key, settings.api_secret),
 			)
+			if resp.get("status"):
+				update_subscription(
+					"Razorpay",
+					subscription_id,
+					{"gateway_status": resp.get("status"), "is_active": resp.get("status") == "active"},
+				)
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
 
@@ -390,24 +567,34 @@ def capture_payment(is_sandbox=False, sanbox_response=None):
 			else:
 				data = json.loads(doc.data)
 				settings = controller.get_settings(data)
+				payment_id = data.get("razorpay_payment_id")
 
-				resp = make_get_request(
-					"https://api.razorpay.com/v1/payments/{}".format(data.get("razorpay_payment_id")),
-					auth=(settings.api_key, settings.api_secret),
-					data={"amount": data.get("amount")},
-				)
+				def fetch(payment_id=payment_id, settings=settings, data=data):
+					with gateway_call("Razorpay"):
+						return http.make_get_request(
+							f"https://api.razorpay.com/v1/payments/{payment_id}",
+							auth=(settings.api_key, settings.api_secret),
+							data={"amount": data.get("amount")},
+						)
+
+				resp = get_payment_status_cache("Razorpay", payment_id).get(fetch, get_payment_status)
 
 				if resp.get("status") == "authorized":
-					resp = make_post_request(
-						"https://api.razorpay.com/v1/payments/{}/capture".format(
-							data.get("razorpay_payment_id")
-						),
-						auth=(settings.api_key, settings.api_secret),
-						data={"amount": data.get("amount")},
-					)
+					with gateway_call("Razorpay"):
+						resp = http.make_post_request(
+							f"https://api.razorpay.com/v1/payments/{payment_id}/capture",
+							auth=(settings.api_key, settings.api_secret),
+							data={"amount": data.get("amount")},
+						)
+
+					invalidate_payment_status("Razorpay", payment_id)
 
 			if resp.get("status") == "captured":
-				frappe.db.set_value("Integration Request", doc.name, "status", "Completed")
+				frappe.get_doc("Integration Request", doc.name).db_set("status", "Completed")
+
+		except GatewayUnavailableError:
+			# Razorpay is down, the remaining payments are captured by a later run
+			break
 
 		except Exception:
 			doc = frappe.get_doc("Integration Request", doc.name)
@@ -424,6 +611,7 @@ def get_api_key():
 
 
 @frappe.whitelist(allow_guest=True)
+@velocity_limit(reference=("doctype", "docname"))
 def get_order(doctype, docname):
 	# Order returned to be consumed by razorpay.js
 	doc = frappe.get_doc(doctype, docname)
@@ -481,13 +669,29 @@ def order_payment_failure(integration_request, params):
 
 def convert_rupee_to_paisa(**kwargs):
 	for addon in kwargs.get("addons"):
-		addon["item"]["amount"] *= 100
+		addon["item"]["amount"] = to_minor_units(addon["item"]["amount"], "INR")
 
 	frappe.conf.converted_rupee_to_paisa = True
 
 
 @frappe.whitelist(allow_guest=True)
 def razorpay_subscription_callback():
+	event_key = claim_notification(
+		"Razorpay", frappe.local.form_dict, frappe.get_request_header("X-Razorpay-Event-Id")
+	)
+	if not event_key:
+		# redelivery of a notification that has already been received
+		return
+
+	if is_async_webhooks_enabled() or is_buffered_webhooks_enabled():
+		try:
+			receive_notification("Razorpay", frappe.local.form_dict)
+		except Exception:
+			release_notification("Razorpay", event_key)
+			raise
+
+		return
+
 	try:
 		data = frappe.local.form_dict
 
@@ -506,17 +710,21 @@ def razorpay_subscription_callback():
 		).insert(ignore_permissions=True)
 		frappe.db.commit()
 
-		frappe.enqueue(
-			method="payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.handle_subscription_notification",
-			queue="long",
-			timeout=600,
-			is_async=True,
-			**{"doctype": "Integration Request", "docname": doc.name},
-		)
+		if is_batch_notifications_enabled():
+			schedule_subscription_notifications()
+		else:
+			frappe.enqueue(
+				method="payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.handle_subscription_notification",
+				queue="long",
+				timeout=600,
+				is_async=True,
+				**{"doctype": "Integration Request", "docname": doc.name},
+			)
 
 	except frappe.InvalidStatusError:
 		pass
 	except Exception as e:
+		release_notification("Razorpay", event_key)
 		frappe.log(frappe.log_error(title=e))
 
 
@@ -524,22 +732,65 @@ def validate_payment_callback(data):
 	def _throw():
 		frappe.throw(_("Invalid Subscription"), exc=frappe.InvalidStatusError)
 
-	subscription_id = data.get("payload").get("subscription").get("entity").get("id")
+	subscription = data.get("payload").get("subscription").get("entity")
+	subscription_id = subscription.get("id")
 
 	if not (subscription_id):
 		_throw()
 
-	controller = frappe.get_doc("Razorpay Settings")
+	# events changing the status carry the new one, or it is refreshed
+	changes_status = data.get("event") in RAZORPAY_SUBSCRIPTION_STATUS_EVENTS
+	if changes_status and subscription.get("status"):
+		record_subscription_state(
+			"Razorpay",
+			subscription_id,
+			{
+				"gateway_status": subscription.get("status"),
+				"is_active": subscription.get("status") == "active",
+			},
+		)
 
-	settings = controller.get_settings(data)
+	if not is_subscription_active(
+		"Razorpay",
+		subscription_id,
+		data=data,
+		refresh=changes_status and not subscription.get("status"),
+	):
+		_throw()
 
-	resp = make_get_request(
-		f"https://api.razorpay.com/v1/subscriptions/{subscription_id}",
-		auth=(settings.api_key, settings.api_secret),
-	)
 
-	if resp.get("status") != "active":
-		_throw()
+def get_subscription_status_query(subscription_id, data=None):
+	"""Return a thread safe lookup of the status of a subscription, used by
+	`payments.payments.doctype.gateway_subscription`"""
+	settings = frappe.get_doc("Razorpay Settings").get_settings(data or {})
+
+	def query():
+		resp = http.make_get_request(
+			f"https://api.razorpay.com/v1/subscriptions/{subscription_id}",
+			auth=(settings.api_key, settings.api_secret),
+		)
+
+		return {"gateway_status": resp.get("status"), "is_active": resp.get("status") == "active"}
+
+	return query
+
+
+def get_subscription_action_query(subscription_id, action, data=None):
+	"""Return a thread safe call applying `action` (Cancel, Pause or Resume) to a
+	subscription, used by `payments.payments.doctype.subscription_operation`"""
+	settings = frappe.get_doc("Razorpay Settings").get_settings(data or {})
+	endpoint, payload = RAZORPAY_SUBSCRIPTION_ACTIONS[action]
+
+	def query():
+		resp = http.make_post_request(
+			f"https://api.razorpay.com/v1/subscriptions/{subscription_id}/{endpoint}",
+			auth=(settings.api_key, settings.api_secret),
+			json=payload,
+		)
+
+		return {"gateway_status": resp.get("status"), "is_active": resp.get("status") == "active"}
+
+	return query
 
 
 def handle_subscription_notification(doctype, docname):
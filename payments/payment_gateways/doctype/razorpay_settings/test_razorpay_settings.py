@@ -0,0 +1,62 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+from unittest.mock import ANY, patch
+
+import frappe
+from frappe.integrations.utils import create_request_log
+from frappe.tests.utils import FrappeTestCase
+
+from payments.payment_gateways.doctype.razorpay_settings.razorpay_settings import (
+	capture_payment,
+)
+
+
+class TestRazorpaySettings(FrappeTestCase):
+	def make_integration_request(self, payment_id):
+		return create_request_log(
+			{"amount": 50000, "currency": "INR", "razorpay_payment_id": payment_id},
+			service_name="Razorpay",
+		)
+
+	def authorize(self, integration_request, payment_id):
+		controller = frappe.get_doc("Razorpay Settings")
+		controller.integration_request = integration_request
+		controller.data = frappe._dict(razorpay_payment_id=payment_id)
+		return controller.authorize_payment()
+
+	@patch("payments.utils.http.make_post_request")
+	@patch("payments.utils.http.make_get_request")
+	def test_authorize_and_capture(self, make_get_request, make_post_request):
+		payment_id = f"pay_{frappe.generate_hash(length=10)}"
+		integration_request = self.make_integration_request(payment_id)
+
+		make_get_request.return_value = {"id": payment_id, "status": "authorized"}
+		result = self.authorize(integration_request, payment_id)
+
+		self.assertEqual(result["status"], 200)
+		self.assertTrue(result["redirect_to"].startswith("payment-success"))
+		integration_request.reload()
+		self.assertEqual(integration_request.status, "Authorized")
+		self.assertEqual(integration_request.gateway_payment_id, payment_id)
+
+		make_post_request.return_value = {"id": payment_id, "status": "captured"}
+		capture_payment()
+
+		make_post_request.assert_any_call(
+			f"https://api.razorpay.com/v1/payments/{payment_id}/capture",
+			auth=ANY,
+			data={"amount": 50000},
+		)
+		integration_request.reload()
+		self.assertEqual(integration_request.status, "Completed")
+
+	@patch("payments.utils.http.make_get_request")
+	def test_authorize_unreachable_gateway(self, make_get_request):
+		payment_id = f"pay_{frappe.generate_hash(length=10)}"
+		integration_request = self.make_integration_request(payment_id)
+
+		make_get_request.side_effect = ConnectionError
+		result = self.authorize(integration_request, payment_id)
+
+		self.assertEqual(result["status"], 500)
+		self.assertEqual(result["redirect_to"], "payment-failed")
@@ -1,152 +1,53 @@
 # Copyright (c) 2017, Frappe Technologies and contributors
 # License: MIT. See LICENSE
 
+import json
 from urllib.parse import urlencode
 
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log, make_get_request
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, flt, get_url
+from frappe.utils import call_hook_method, cint, get_url
+from frappe.utils.password import get_decrypted_password
 
-from payments.utils import create_payment_gateway
+from payments.exceptions import GatewayUnavailableError
+from payments.payments.doctype.payment_callback.payment_callback import (
+	authorize_reference_document,
+)
+from payments.utils import (
+	create_payment_gateway,
+	get_payment_details_controller,
+	get_request_data,
+	http,
+	idempotency,
+	set_integration_request_status,
+)
+from payments.utils.bulkhead import gateway_call
+from payments.utils.currency import (
+	MINIMUM_AMOUNTS,
+	SUPPORTED_CURRENCIES,
+	from_minor_units,
+	to_minor_units,
+	validate_minimum_transaction_amount,
+	validate_transaction_currency,
+)
+from payments.utils.payment_links import get_integration_request_row
+from payments.utils.refund import record_refunds
+from payments.utils.status_cache import get_payment_status_cache
+from payments.utils.webhooks import (
+	claim_notification,
+	mark_notifications_processed,
+	release_notification,
+)
+
+STRIPE_EVENT = "Stripe Event"
 
 
 class StripeSettings(Document):
-	supported_currencies = [
-		"AED",
-		"ALL",
-		"ANG",
-		"ARS",
-		"AUD",
-		"AWG",
-		"BBD",
-		"BDT",
-		"BIF",
-		"BMD",
-		"BND",
-		"BOB",
-		"BRL",
-		"BSD",
-		"BWP",
-		"BZD",
-		"CAD",
-		"CHF",
-		"CLP",
-		"CNY",
-		"COP",
-		"CRC",
-		"CVE",
-		"CZK",
-		"DJF",
-		"DKK",
-		"DOP",
-		"DZD",
-		"EGP",
-		"ETB",
-		"EUR",
-		"FJD",
-		"FKP",
-		"GBP",
-		"GIP",
-		"GMD",
-		"GNF",
-		"GTQ",
-		"GYD",
-		"HKD",
-		"HNL",
-		"HRK",
-		"HTG",
-		"HUF",
-		"IDR",
-		"ILS",
-		"INR",
-		"ISK",
-		"JMD",
-		"JPY",
-		"KES",
-		"KHR",
-		"KMF",
-		"KRW",
-		"KYD",
-		"KZT",
-		"LAK",
-		"LBP",
-		"LKR",
-		"LRD",
-		"MAD",
-		"MDL",
-		"MNT",
-		"MOP",
-		"MRO",
-		"MUR",
-		"MVR",
-		"MWK",
-		"MXN",
-		"MYR",
-		"NAD",
-		"NGN",
-		"NIO",
-		"NOK",
-		"NPR",
-		"NZD",
-		"PAB",
-		"PEN",
-		"PGK",
-		"PHP",
-		"PKR",
-		"PLN",
-		"PYG",
-		"QAR",
-		"RUB",
-		"SAR",
-		"SBD",
-		"SCR",
-		"SEK",
-		"SGD",
-		"SHP",
-		"SLL",
-		"SOS",
-		"STD",
-		"SVC",
-		"SZL",
-		"THB",
-		"TOP",
-		"TTD",
-		"TWD",
-		"TZS",
-		"UAH",
-		"UGX",
-		"USD",
-		"UYU",
-		"UZS",
-		"VND",
-		"VUV",
-		"WST",
-		"XAF",
-		"XOF",
-		"XPF",
-		"YER",
-		"ZAR",
-	]
+	supported_currencies = SUPPORTED_CURRENCIES["Stripe"]
 
-	currency_wise_minimum_charge_amount = {
-		"JPY": 50,
-		"MXN": 10,
-		"DKK": 2.50,
-		"HKD": 4.00,
-		"NOK": 3.00,
-		"SEK": 3.00,
-		"USD": 0.50,
-		"AUD": 0.50,
-		"BRL": 0.50,
-		"CAD": 0.50,
-		"CHF": 0.50,
-		"EUR": 0.50,
-		"GBP": 0.30,
-		"NZD": 0.50,
-		"SGD": 0.50,
-	}
+	currency_wise_minimum_charge_amount = MINIMUM_AMOUNTS["Stripe"]
 
 	def on_update(self):
 		create_payment_gateway(
@@ -171,36 +72,101 @@ class StripeSettings(Document):
 				frappe.throw(_("Seems Publishable Key or Secret Key is wrong !!!"))
 
 	def validate_transaction_currency(self, currency):
-		if currency not in self.supported_currencies:
-			frappe.throw(
-				_(
-					"Please select another payment method. Stripe does not support transactions in currency '{0}'"
-				).format(currency)
-			)
+		validate_transaction_currency("Stripe", currency)
 
 	def validate_minimum_transaction_amount(self, currency, amount):
-		if currency in self.currency_wise_minimum_charge_amount:
-			if flt(amount) < self.currency_wise_minimum_charge_amount.get(currency, 0.0):
-				frappe.throw(
-					_("For currency {0}, the minimum transaction amount should be {1}").format(
-						currency, self.currency_wise_minimum_charge_amount.get(currency, 0.0)
-					)
-				)
+		validate_minimum_transaction_amount("Stripe", currency, amount)
 
 	def get_payment_url(self, **kwargs):
-		return get_url(f"./stripe_checkout?{urlencode(kwargs)}")
+		integration_request = create_request_log(kwargs, service_name="Stripe")
+		return get_url(f"./stripe_checkout?token={integration_request.name}")
+
+	def get_payment_url_query(self, **kwargs):
+		"""Return a thread safe builder of the checkout url, used by
+		`payments.utils.payment_links`"""
+		integration_request = get_integration_request_row(kwargs, "Stripe")
+		url = get_url(f"./stripe_checkout?token={integration_request['name']}")
+
+		return lambda: {"url": url, "integration_request": integration_request}
+
+	def get_payment_status_query(self, integration_request):
+		"""Return a thread safe lookup of the charge behind `integration_request`,
+		used by `payments.utils.reconciliation`"""
+		charge_id = integration_request.gateway_payment_id
+		secret_key = self.get_password(fieldname="secret_key", raise_exception=False)
+		status_cache = charge_id and get_payment_status_cache("Stripe", charge_id)
+
+		def query():
+			if not charge_id:
+				# checkout link that expired without a charge, see
+				# `payments.utils.reconciliation`
+				return {"status": "Cancelled"}
+
+			charge = status_cache.get(
+				lambda: http.make_get_request(
+					f"https://api.stripe.com/v1/charges/{charge_id}",
+					headers={"Authorization": f"Bearer {secret_key}"},
+				),
+				get_charge_status,
+			)
+
+			return {"status": get_charge_status(charge)}
+
+		return query
+
+	def get_refund_query(self, integration_request, amount=None, idempotency_key=None):
+		"""Return a thread safe refund of `amount` (or all) of the charge behind
+		`integration_request`, used by `payments.utils.refund`"""
+		charge_id = integration_request.gateway_payment_id
+		if not charge_id:
+			frappe.throw(_("No Stripe charge found for {0}").format(integration_request.name))
+
+		headers = {
+			"Authorization": "Bearer {}".format(
+				self.get_password(fieldname="secret_key", raise_exception=False)
+			)
+		}
+		if idempotency_key:
+			headers["Idempotency-Key"] = idempotency_key
+
+		currency = get_request_data(integration_request).get("currency")
+		payload = {"charge": charge_id}
+		if amount:
+			payload["amount"] = to_minor_units(amount, currency)
+
+		def refund():
+			resp = http.make_post_request(
+				"https://api.stripe.com/v1/refunds", headers=headers, data=payload
+			)
+
+			return {
+				"refund_id": resp.get("id"),
+				"refunded_amount": from_minor_units(resp.get("amount"), currency),
+				"status": resp.get("status"),
+			}
+
+		return refund
 
 	def create_request(self, data):
 		import stripe
 
 		self.data = frappe._dict(data)
 		stripe.api_key = self.get_password(fieldname="secret_key", raise_exception=False)
-		stripe.default_http_client = stripe.http_client.RequestsClient()
+
+		if self.data.token:
+			# checkout session started by `get_payment_url`
+			self.integration_request = frappe.get_doc("Integration Request", self.data.token)
+			if self.integration_request.status != "Queued":
+				frappe.throw(_("This payment has already been processed"))
 
 		try:
-			self.integration_request = create_request_log(self.data, service_name="Stripe")
+			if not self.data.token:
+				self.integration_request = create_request_log(self.data, service_name="Stripe")
 			return self.create_charge_on_stripe()
 
+		except GatewayUnavailableError:
+			raise
+
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
 			return {
@@ -217,21 +183,32 @@ class StripeSettings(Document):
 		import stripe
 
 		try:
-			charge = stripe.Charge.create(
-				amount=cint(flt(self.data.amount) * 100),
-				currency=self.data.currency,
-				source=self.data.stripe_token_id,
-				description=self.data.description,
-				receipt_email=self.data.payer_email,
-			)
+			with gateway_call("Stripe", self.gateway_name):
+				stripe.default_http_client = stripe.http_client.RequestsClient(
+					timeout=http.get_timeout()
+				)
+				charge = stripe.Charge.create(
+					amount=to_minor_units(self.data.amount, self.data.currency),
+					currency=self.data.currency,
+					source=self.data.stripe_token_id,
+					description=self.data.description,
+					receipt_email=self.data.payer_email,
+					metadata={"integration_request": self.integration_request.name},
+					idempotency_key=self.data.idempotency_key,
+				)
 
 			if charge.captured == True:
-				self.integration_request.db_set("status", "Completed", update_modified=False)
+				self.integration_request.db_set(
+					{"status": "Completed", "gateway_payment_id": charge.id}, update_modified=False
+				)
 				self.flags.status_changed_to = "Completed"
 
 			else:
 				frappe.log_error(charge.failure_message, "Stripe Payment not completed")
 
+		except GatewayUnavailableError:
+			raise
+
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
 
@@ -244,13 +221,9 @@ class StripeSettings(Document):
 
 		if self.flags.status_changed_to == "Completed":
 			if self.data.reference_doctype and self.data.reference_docname:
-				custom_redirect_to = None
-				try:
-					custom_redirect_to = frappe.get_doc(
-						self.data.reference_doctype, self.data.reference_docname
-					).run_method("on_payment_authorized", self.flags.status_changed_to)
-				except Exception:
-					frappe.log_error(frappe.get_traceback())
+				custom_redirect_to = authorize_reference_document(
+					self.integration_request, self.flags.status_changed_to
+				)
 
 				if custom_redirect_to:
 					redirect_to = custom_redirect_to
@@ -271,9 +244,228 @@ class StripeSettings(Document):
 		return {"redirect_to": redirect_url, "status": status}
 
 
-def get_gateway_controller(doctype, docname):
-	reference_doc = frappe.get_doc(doctype, docname)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", reference_doc.payment_gateway, "gateway_controller"
+def get_charge_status(charge):
+	"""Return the Integration Request status of a Stripe charge, if it is final"""
+	if charge.get("status") == "succeeded" and charge.get("captured"):
+		return "Completed"
+	elif charge.get("status") == "failed":
+		return "Failed"
+
+
+def get_gateway_controller(payment_details):
+	"""Return the Stripe Settings of a checkout session, the account the payment was
+	routed to if it was"""
+	controller = get_payment_details_controller(payment_details, "Stripe")
+	if controller.doctype != "Stripe Settings":
+		frappe.throw(_("{0} is not a Stripe account").format(controller.name))
+
+	return controller.name
+
+
+@frappe.whitelist(allow_guest=True)
+def stripe_webhook(gateway_name):
+	"""Receive events of the Stripe account `gateway_name`.
+
+	The signature is verified locally with the account's webhook signing secret, the
+	event is stored as a queued Stripe Event Integration Request and processed in
+	batches by `process_stripe_events`.
+	"""
+	import stripe
+
+	secret = get_decrypted_password(
+		"Stripe Settings", gateway_name, "webhook_secret", raise_exception=False
 	)
-	return gateway_controller
+	if not secret:
+		frappe.throw(_("Stripe webhooks are not configured"), exc=frappe.PermissionError)
+
+	try:
+		event = stripe.Webhook.construct_event(
+			frappe.request.get_data(as_text=True),
+			frappe.get_request_header("Stripe-Signature"),
+			secret,
+		)
+	except (ValueError, stripe.error.SignatureVerificationError):
+		frappe.throw(_("Stripe Signature Verification Failed"), exc=frappe.PermissionError)
+
+	if not claim_notification("Stripe-" + gateway_name, {}, event_id=event.id):
+		# redelivery of an event that has already been received
+		return
+
+	try:
+		frappe.get_doc(
+			{
+				"doctype": "Integration Request",
+				"integration_request_service": "Stripe",
+				"request_description": STRIPE_EVENT,
+				"request_id": event.id,
+				"is_remote_request": 1,
+				"status": "Queued",
+				"data": json.dumps(
+					{"gateway_name": gateway_name, "event": event.to_dict_recursive()}
+				),
+			}
+		).insert(ignore_permissions=True)
+		frappe.db.commit()
+	except Exception:
+		# let the redelivery of Stripe through
+		frappe.db.rollback()
+		release_notification("Stripe-" + gateway_name, event.id)
+		raise
+
+	if idempotency.claim("Stripe Events", "scheduled", ttl=600):
+		frappe.enqueue(
+			"payments.payment_gateways.doctype.stripe_settings.stripe_settings.process_stripe_events",
+			queue="long",
+			timeout=1500,
+			enqueue_after_commit=True,
+		)
+
+
+def process_stripe_events():
+	"""Process queued Stripe Events in batches of `payments_notification_batch_size`
+	(default 500), looking up the Integration Requests of a batch with one query"""
+	# let events arriving from now on schedule another run
+	idempotency.release("Stripe Events", "scheduled")
+
+	lock = frappe.cache().lock(frappe.cache().make_key("payments:stripe_events"), timeout=1500)
+	if not lock.acquire(blocking=False):
+		return
+
+	try:
+		batch_size = cint(frappe.conf.payments_notification_batch_size) or 500
+		while True:
+			events = frappe.get_all(
+				"Integration Request",
+				filters={"request_description": STRIPE_EVENT, "status": "Queued"},
+				fields=["name", "data"],
+				order_by="creation asc",
+				limit=batch_size,
+			)
+			if not events:
+				break
+
+			process_stripe_event_batch(events)
+
+			if len(events) < batch_size:
+				break
+	finally:
+		lock.release()
+
+
+def process_stripe_event_batch(events):
+	for event in events:
+		event.event = frappe._dict(get_request_data(event).get("event") or {})
+		event.charge = get_event_charge(event.event)
+
+	charges = {event.charge.id: event.charge for event in events if event.charge}
+	requests = get_charge_integration_requests(charges.values())
+
+	failed = {}
+	for event in events:
+		try:
+			integration_request = event.charge and requests.get(event.charge.id)
+			if integration_request:
+				handle_stripe_event(event.event, event.charge, integration_request)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			failed[event.name] = frappe.get_traceback()
+
+	mark_notifications_processed([event.name for event in events], failed)
+
+
+def get_event_charge(event):
+	"""Return the charge an event is about, refunds and disputes carry its id"""
+	obj = frappe._dict((event.get("data") or {}).get("object") or {})
+	if obj.object == "charge":
+		return obj
+	elif obj.get("charge"):
+		charge_id = obj.charge if isinstance(obj.charge, str) else obj.charge.get("id")
+		return frappe._dict(id=charge_id, metadata={}, related=obj)
+
+
+def get_charge_integration_requests(charges):
+	"""Return {charge id: Integration Request} looked up by payment id, falling back to
+	the Integration Request name kept in the charge metadata"""
+	charges = list(charges)
+	if not charges:
+		return {}
+
+	names = {
+		request.gateway_payment_id: request.name
+		for request in frappe.get_all(
+			"Integration Request",
+			filters={
+				"integration_request_service": "Stripe",
+				"gateway_payment_id": ("in", [charge.id for charge in charges]),
+			},
+			fields=["name", "gateway_payment_id"],
+		)
+	}
+
+	for charge in charges:
+		name = (charge.metadata or {}).get("integration_request")
+		if charge.id not in names and name:
+			names[charge.id] = name
+
+	return {
+		charge_id: frappe.get_doc("Integration Request", name)
+		for charge_id, name in names.items()
+		if frappe.db.exists("Integration Request", name)
+	}
+
+
+def get_charge_refunds(charge):
+	"""Return the refunds of a charge for `record_refunds`, or the refunded total when the
+	charge does not list them"""
+	refunds = (charge.get("refunds") or {}).get("data")
+	if refunds is None:
+		return [{"total_refunded": from_minor_units(charge.amount_refunded, charge.currency)}]
+
+	return [
+		{
+			"refund_id": refund["id"],
+			"refunded_amount": from_minor_units(refund["amount"], charge.currency),
+			"status": refund.get("status"),
+		}
+		for refund in refunds
+		if refund.get("status") not in ("failed", "canceled")
+	]
+
+
+def handle_stripe_event(event, charge, integration_request):
+	"""Apply an event to the Integration Request of its charge and let the reference
+	document know through `on_payment_authorized`, `on_payment_failed`,
+	`on_payment_refunded` or `on_payment_disputed`"""
+	data = get_request_data(integration_request)
+	reference_doc = None
+	if data.reference_doctype and data.reference_docname:
+		reference_doc = frappe.get_doc(data.reference_doctype, data.reference_docname)
+
+	if not integration_request.gateway_payment_id:
+		integration_request.gateway_payment_id = charge.id
+
+	if event.type == "charge.succeeded":
+		if integration_request.status != "Completed":
+			set_integration_request_status(integration_request, {}, "Completed")
+			authorize_reference_document(integration_request, "Completed", data, sync=False)
+
+	elif event.type == "charge.failed":
+		if integration_request.status != "Completed":
+			set_integration_request_status(
+				integration_request, {"failure_message": charge.failure_message}, "Failed"
+			)
+			if reference_doc:
+				reference_doc.run_method("on_payment_failed", charge.failure_message)
+
+	elif event.type == "charge.refunded":
+		# refunds made through `refund_payment` are already recorded, by their refund id
+		record_refunds({integration_request.name: get_charge_refunds(charge)})
+
+	elif event.type.startswith("charge.dispute."):
+		dispute_status = charge.related.status
+		set_integration_request_status(
+			integration_request, {"dispute_status": dispute_status}, integration_request.status
+		)
+		if reference_doc:
+			reference_doc.run_method("on_payment_disputed", dispute_status)
@@ -0,0 +1,195 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+"""
+Local mirror of subscription state at the gateways.
+
+Subscription notification validators used to ask the gateway about a Razorpay
+subscription (which has to be active) or PayPal recurring payments profile (which only
+has to exist) for every event. They now read it from Gateway Subscription, keyed by
+gateway and subscription id, and only look
+it up at the gateway when it is missing or older than `payments_subscription_mirror_ttl`
+seconds (site config, default 12 hours). Notifications that change the state of a
+subscription update it with the state they report, through `record_subscription_state`,
+and `sync_gateway_subscriptions` refreshes the ones that can still change every hour,
+`payments_subscription_sync_batch_size` (site config, default 500) at a time.
+
+Each gateway provides the lookup through `get_subscription_status_query(subscription_id,
+data)` in its settings module, which returns a thread safe callable returning
+`{"gateway_status": ..., "is_active": ...}`, or `None` if the gateway did not know.
+"""
+
+import traceback
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_to_date, cint, now_datetime
+
+from payments.utils.concurrency import run_concurrently
+
+DEFAULT_MIRROR_TTL = 12 * 60 * 60
+
+SUBSCRIPTION_STATUS_QUERIES = {
+	"Razorpay": "payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.get_subscription_status_query",
+	"PayPal": "payments.payment_gateways.doctype.paypal_settings.paypal_settings.get_subscription_status_query",
+}
+
+# statuses a subscription never leaves, these are trusted no matter how old
+FINAL_STATUSES = {
+	"Razorpay": ("cancelled", "completed", "expired"),
+	"PayPal": ("Cancelled", "Expired"),
+}
+
+
+class GatewaySubscription(Document):
+	def autoname(self):
+		self.name = get_subscription_name(self.gateway, self.subscription_id)
+
+
+def get_subscription_name(gateway, subscription_id):
+	return f"{gateway}-{subscription_id}"
+
+
+def get_mirror_ttl():
+	return cint(frappe.conf.payments_subscription_mirror_ttl) or DEFAULT_MIRROR_TTL
+
+
+def is_subscription_active(gateway, subscription_id, data=None, refresh=False):
+	"""Return whether a subscription is active, see `get_subscription_state`"""
+	subscription = get_subscription_state(gateway, subscription_id, data, refresh)
+	return bool(subscription and subscription.is_active)
+
+
+def get_subscription_state(gateway, subscription_id, data=None, refresh=False):
+	"""Return the `gateway_status` and `is_active` of a subscription, from the mirror
+	while it is fresh and from the gateway (updating the mirror) otherwise or when
+	`refresh` is set. None if the gateway does not know the subscription."""
+	if not refresh:
+		subscription = get_mirrored_subscription(gateway, subscription_id)
+		if subscription:
+			return subscription
+
+	result = get_subscription_status_query(gateway, subscription_id, data)()
+	if not result:
+		return
+
+	update_subscription(gateway, subscription_id, result)
+	return frappe._dict(result)
+
+
+def get_mirrored_subscription(gateway, subscription_id):
+	"""Return the mirrored state of a subscription, None if it is missing or stale"""
+	subscription = frappe.db.get_value(
+		"Gateway Subscription",
+		get_subscription_name(gateway, subscription_id),
+		["gateway_status", "is_active", "last_synced_on"],
+		as_dict=True,
+	)
+	if not subscription:
+		return
+
+	if subscription.gateway_status in FINAL_STATUSES.get(gateway, ()) or (
+		subscription.last_synced_on
+		and subscription.last_synced_on > add_to_date(now_datetime(), seconds=-get_mirror_ttl())
+	):
+		return subscription
+
+
+def get_subscription_status_query(gateway, subscription_id, data=None):
+	return frappe.get_attr(SUBSCRIPTION_STATUS_QUERIES[gateway])(subscription_id, data)
+
+
+def update_subscription(gateway, subscription_id, result):
+	values = {
+		"gateway_status": result.get("gateway_status"),
+		"is_active": cint(result.get("is_active")),
+		"last_synced_on": now_datetime(),
+	}
+	name = get_subscription_name(gateway, subscription_id)
+
+	if not frappe.db.exists("Gateway Subscription", name):
+		frappe.db.savepoint("gateway_subscription")
+		try:
+			frappe.get_doc(
+				dict(
+					values, doctype="Gateway Subscription", gateway=gateway, subscription_id=subscription_id
+				)
+			).insert(ignore_permissions=True)
+			return
+		except frappe.DuplicateEntryError:
+			# mirrored concurrently, fall through and update it instead
+			frappe.db.rollback(save_point="gateway_subscription")
+
+	frappe.db.set_value("Gateway Subscription", name, values)
+
+
+def record_subscription_state(gateway, subscription_id, result):
+	"""Update a mirrored subscription with the state a notification reports. Subscriptions
+	that are not mirrored yet are left to be looked up at the gateway."""
+	if frappe.db.exists("Gateway Subscription", get_subscription_name(gateway, subscription_id)):
+		update_subscription(gateway, subscription_id, result)
+
+
+def sync_gateway_subscriptions():
+	"""Refresh mirrored subscriptions that can still change and were last synced more
+	than half the mirror TTL ago, so validators rarely find them stale"""
+	batch_size = cint(frappe.conf.payments_subscription_sync_batch_size) or 500
+	synced_before = add_to_date(now_datetime(), seconds=-get_mirror_ttl() // 2)
+
+	for gateway in SUBSCRIPTION_STATUS_QUERIES:
+		# paged by name, subscriptions that failed to sync keep their place in the filter
+		last_name = ""
+		while True:
+			subscriptions = frappe.get_all(
+				"Gateway Subscription",
+				filters={
+					"gateway": gateway,
+					"gateway_status": ("not in", FINAL_STATUSES.get(gateway, ())),
+					"last_synced_on": ("<", synced_before),
+					"name": (">", last_name),
+				},
+				fields=["name", "gateway", "subscription_id"],
+				order_by="name asc",
+				limit=batch_size,
+			)
+			if not subscriptions:
+				break
+
+			sync_subscription_batch(subscriptions)
+
+			if len(subscriptions) < batch_size:
+				break
+			last_name = subscriptions[-1].name
+
+
+def sync_subscription_batch(subscriptions):
+	tasks = []
+	for subscription in subscriptions:
+		try:
+			query = get_subscription_status_query(subscription.gateway, subscription.subscription_id)
+		except Exception:
+			frappe.log_error(frappe.get_traceback(), f"Subscription sync failed for {subscription.name}")
+			continue
+
+		tasks.append((subscription.name, subscription.gateway, query))
+
+	updates = {}
+	for name, result, exception in run_concurrently(tasks):
+		if exception:
+			frappe.log_error(
+				"".join(traceback.format_exception(type(exception), exception, exception.__traceback__)),
+				f"Subscription sync failed for {name}",
+			)
+			continue
+
+		if result:
+			updates[name] = {
+				"gateway_status": result.get("gateway_status"),
+				"is_active": cint(result.get("is_active")),
+				"last_synced_on": now_datetime(),
+			}
+
+	if updates:
+		frappe.db.bulk_update("Gateway Subscription", updates)
+
+	frappe.db.commit()
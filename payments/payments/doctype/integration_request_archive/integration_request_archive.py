@@ -0,0 +1,85 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, cint, now_datetime
+
+TERMINAL_STATUSES = ("Completed", "Failed", "Cancelled")
+
+ARCHIVED_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"modified_by",
+	"owner",
+	"request_id",
+	"integration_request_service",
+	"is_remote_request",
+	"request_description",
+	"status",
+	"url",
+	"request_headers",
+	"data",
+	"output",
+	"error",
+	"reference_doctype",
+	"reference_docname",
+	"gateway_payment_id",
+	"settlement_status",
+	"settled_amount",
+)
+
+
+class IntegrationRequestArchive(Document):
+	pass
+
+
+def archive_integration_requests():
+	"""
+	Moves terminal Integration Requests older than `payments_archive_after_days`
+	(site config, default 90) into Integration Request Archive.
+
+	Rows are moved in batches of `payments_archive_batch_size` (default 1000) and
+	every batch is committed on its own, so an interrupted run simply resumes on
+	the next schedule.
+	"""
+	after_days = cint(frappe.conf.payments_archive_after_days) or 90
+	batch_size = cint(frappe.conf.payments_archive_batch_size) or 1000
+	cutoff = add_days(now_datetime(), -after_days)
+
+	while True:
+		requests = frappe.get_all(
+			"Integration Request",
+			filters={"status": ("in", TERMINAL_STATUSES), "modified": ("<", cutoff)},
+			fields=ARCHIVED_FIELDS,
+			order_by="modified asc",
+			limit=batch_size,
+		)
+
+		if not requests:
+			break
+
+		archive_batch(requests)
+		frappe.db.commit()
+
+		if len(requests) < batch_size:
+			break
+
+
+def archive_batch(requests):
+	archived_on = now_datetime()
+	values = [
+		tuple(request.get(fieldname) for fieldname in ARCHIVED_FIELDS) + (archived_on,)
+		for request in requests
+	]
+
+	frappe.db.bulk_insert(
+		"Integration Request Archive",
+		fields=ARCHIVED_FIELDS + ("archived_on",),
+		values=values,
+		ignore_duplicates=True,
+	)
+	frappe.db.delete(
+		"Integration Request", {"name": ("in", [request.name for request in requests])}
+	)
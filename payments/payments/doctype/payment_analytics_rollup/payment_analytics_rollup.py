@@ -0,0 +1,406 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+"""
+Daily rollups of payment requests per gateway, currency and status.
+
+Every request is counted once as Queued, on the day it was created, and once more
+under its final status (Completed, Failed or Cancelled) on the day it reached it, with
+the time it took as latency. Live counting and `backfill_payment_analytics` count
+alike, so a rebuilt day matches the live one.
+
+Live counts are not written in the transaction of the payment: `record_status_change`
+only increments counters in redis, and `flush_rollup_buffer` adds them to the rollup
+rows from the scheduler.
+"""
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, cint, flt, getdate, now_datetime, time_diff_in_seconds
+
+from payments.utils import get_request_data
+
+# upper bounds (in seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 21600, 86400)
+
+COUNTED_STATUSES = ("Queued", "Completed", "Failed", "Cancelled")
+STATUS_CACHE_TTL = 7 * 24 * 60 * 60
+
+BUFFER_KEY = "payments:analytics_buffer"
+
+
+class PaymentAnalyticsRollup(Document):
+	def autoname(self):
+		self.name = get_rollup_name(self.day, self.gateway, self.currency, self.status)
+
+
+def get_rollup_name(day, gateway, currency, status):
+	return f"{getdate(day)}-{gateway}-{currency or ''}-{status}"
+
+
+def get_latency_histogram(latency=None):
+	histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+	if latency is not None:
+		histogram[get_latency_bucket(latency)] += 1
+
+	return histogram
+
+
+def get_latency_bucket(latency):
+	for idx, upper_bound in enumerate(LATENCY_BUCKETS):
+		if latency <= upper_bound:
+			return idx
+
+	return len(LATENCY_BUCKETS)
+
+
+def merge_histograms(histogram, other):
+	merged = get_latency_histogram()
+	for source in (histogram or [], other or []):
+		for idx, count in enumerate(source[: len(merged)]):
+			merged[idx] += count
+
+	return merged
+
+
+def get_latency_percentile(histogram, percentile):
+	"""Return the upper bound of the bucket holding `percentile` (0-100) of the samples,
+	`None` for the unbounded bucket"""
+	total = sum(histogram or [])
+	if not total:
+		return 0
+
+	threshold = total * percentile / 100
+	seen = 0
+	for idx, count in enumerate(histogram):
+		seen += count
+		if seen >= threshold:
+			return LATENCY_BUCKETS[idx] if idx < len(LATENCY_BUCKETS) else None
+
+
+def record_status_change(doc, method=None):
+	"""`on_change` hook for Integration Request, counts a request when it is created and
+	when it reaches its final status"""
+	if (
+		doc.is_remote_request
+		or not doc.integration_request_service
+		or doc.status not in COUNTED_STATUSES
+	):
+		return
+
+	# `db_set` does not keep the previous document around, so every counted status is
+	# claimed in cache to count each one only once
+	cache = frappe.cache()
+	if not cache.set(
+		cache.make_key(f"payment_analytics_rollup_status:{doc.name}:{doc.status}"),
+		1,
+		nx=True,
+		ex=STATUS_CACHE_TTL,
+	):
+		return
+
+	data = get_request_data(doc)
+	day, latency = getdate(), None
+	if doc.status == "Queued":
+		day = getdate(doc.creation or day)
+	elif doc.creation:
+		latency = max(time_diff_in_seconds(now_datetime(), doc.creation), 0)
+
+	buffer_rollup(
+		day,
+		doc.integration_request_service,
+		data.get("currency"),
+		doc.status,
+		amount=flt(data.get("amount")),
+		latency=latency,
+	)
+
+
+def get_buffer_key(rollup_key=None):
+	return frappe.cache().make_key(f"{BUFFER_KEY}:{rollup_key}" if rollup_key else BUFFER_KEY)
+
+
+def buffer_rollup(day, gateway, currency, status, count=1, amount=0, latency=None):
+	"""Add to the counters of a rollup in redis, written to the database by
+	`flush_rollup_buffer`"""
+	rollup_key = json.dumps([str(getdate(day)), gateway, currency, status])
+	key = get_buffer_key(rollup_key)
+
+	pipeline = frappe.cache().pipeline()
+	pipeline.hincrby(key, "count", count)
+	pipeline.hincrbyfloat(key, "amount", flt(amount))
+	if latency is not None:
+		pipeline.hincrbyfloat(key, "latency", flt(latency))
+		pipeline.hincrby(key, f"bucket_{get_latency_bucket(latency)}", 1)
+	pipeline.sadd(get_buffer_key(), rollup_key)
+	pipeline.execute()
+
+
+def flush_rollup_buffer():
+	"""Add the counters buffered in redis to the rollups, runs on the `all` scheduler"""
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key("payments:analytics_buffer_flush"), timeout=600)
+	if not lock.acquire(blocking=False):
+		return
+
+	try:
+		while True:
+			# through a pipeline, RedisWrapper namespaces (and unpickles) `spop` and `hgetall`
+			pipeline = cache.pipeline()
+			pipeline.spop(get_buffer_key())
+			rollup_key = pipeline.execute()[0]
+			if not rollup_key:
+				break
+
+			rollup_key = frappe.safe_decode(rollup_key)
+			key = get_buffer_key(rollup_key)
+			flushing_key = f"{key}:flushing"
+
+			pipeline = cache.pipeline()
+			pipeline.exists(flushing_key)
+			pipeline.hgetall(flushing_key)
+			interrupted, counters = pipeline.execute()
+
+			if interrupted:
+				# counters of a flush that failed, flushed before renaming over them, the
+				# newer ones are flushed on the next pass
+				mark_for_flush(rollup_key)
+			else:
+				# counters added from now on go to a new hash and mark the rollup again
+				pipeline = cache.pipeline()
+				pipeline.rename(key, flushing_key)
+				pipeline.hgetall(flushing_key)
+				renamed, counters = pipeline.execute(raise_on_error=False)
+				if isinstance(renamed, Exception):
+					# nothing left to flush
+					continue
+
+			counters = {
+				frappe.safe_decode(field): frappe.safe_decode(value)
+				for field, value in counters.items()
+			}
+			histogram = [
+				cint(counters.get(f"bucket_{idx}")) for idx in range(len(get_latency_histogram()))
+			]
+
+			try:
+				add_to_rollup(
+					*json.loads(rollup_key),
+					count=cint(counters.get("count")),
+					amount=flt(counters.get("amount")),
+					latency=flt(counters.get("latency")),
+					histogram=histogram,
+				)
+				frappe.db.commit()
+			except Exception:
+				# the counters stay in the flushing hash for the next flush
+				frappe.db.rollback()
+				mark_for_flush(rollup_key)
+				raise
+
+			cache.delete(flushing_key)
+	finally:
+		lock.release()
+
+
+def mark_for_flush(rollup_key):
+	pipeline = frappe.cache().pipeline()
+	pipeline.sadd(get_buffer_key(), rollup_key)
+	pipeline.execute()
+
+
+def add_to_rollup(day, gateway, currency, status, count=1, amount=0, latency=0, histogram=None):
+	name = get_rollup_name(day, gateway, currency, status)
+
+	if not frappe.db.exists("Payment Analytics Rollup", name):
+		frappe.db.savepoint("payment_analytics_rollup")
+		try:
+			frappe.get_doc(
+				{
+					"doctype": "Payment Analytics Rollup",
+					"day": getdate(day),
+					"gateway": gateway,
+					"currency": currency,
+					"status": status,
+					"count": count,
+					"total_amount": amount,
+					"total_latency": latency,
+					"latency_histogram": json.dumps(merge_histograms(histogram, None)),
+				}
+			).insert(ignore_permissions=True)
+			return
+		except frappe.DuplicateEntryError:
+			# created concurrently, fall through and increment it instead
+			frappe.db.rollback(save_point="payment_analytics_rollup")
+
+	current = frappe.db.get_value(
+		"Payment Analytics Rollup", name, "latency_histogram", for_update=True
+	)
+	merged = merge_histograms(json.loads(current or "[]"), histogram)
+
+	frappe.db.sql(
+		"""
+		update `tabPayment Analytics Rollup`
+		set
+			`count` = `count` + %(count)s,
+			`total_amount` = `total_amount` + %(amount)s,
+			`total_latency` = `total_latency` + %(latency)s,
+			`latency_histogram` = %(histogram)s,
+			`modified` = %(modified)s
+		where `name` = %(name)s
+		""",
+		{
+			"name": name,
+			"count": count,
+			"amount": amount,
+			"latency": latency,
+			"histogram": json.dumps(merged),
+			"modified": now_datetime(),
+		},
+	)
+
+
+@frappe.whitelist()
+def get_payment_analytics(
+	from_date=None, to_date=None, gateway=None, currency=None, status=None
+):
+	"""Return rollup rows with average and percentile latency (in seconds) per
+	gateway, currency, status and day"""
+	filters = get_day_filters(from_date, to_date)
+	for fieldname, value in (("gateway", gateway), ("currency", currency), ("status", status)):
+		if value:
+			filters[fieldname] = value
+
+	rows = frappe.get_list(
+		"Payment Analytics Rollup",
+		filters=filters,
+		fields=[
+			"day",
+			"gateway",
+			"currency",
+			"status",
+			"count",
+			"total_amount",
+			"total_latency",
+			"latency_histogram",
+		],
+		order_by="day desc",
+		limit_page_length=0,
+	)
+
+	for row in rows:
+		histogram = json.loads(row.pop("latency_histogram") or "[]")
+		samples = sum(histogram)
+		row.average_latency = flt(row.total_latency / samples, 2) if samples else 0
+		row.p50_latency = get_latency_percentile(histogram, 50)
+		row.p90_latency = get_latency_percentile(histogram, 90)
+		row.p99_latency = get_latency_percentile(histogram, 99)
+
+	return rows
+
+
+def get_day_filters(from_date=None, to_date=None):
+	if from_date and to_date:
+		return {"day": ("between", (getdate(from_date), getdate(to_date)))}
+	elif from_date:
+		return {"day": (">=", getdate(from_date))}
+	elif to_date:
+		return {"day": ("<=", getdate(to_date))}
+
+	return {}
+
+
+def backfill_payment_analytics(from_date=None, to_date=None, batch_size=1000):
+	"""
+	Rebuilds rollups from Integration Request (and archived) history.
+
+	Requests are counted like `record_status_change` does: as Queued on the day they
+	were created, and under their final status on the day they were last modified, with
+	their creation to last modification time as latency. Existing rollups in the date
+	range are replaced.
+	"""
+	frappe.db.delete("Payment Analytics Rollup", get_day_filters(from_date, to_date))
+
+	rollups = {}
+	for doctype in ("Integration Request", "Integration Request Archive"):
+		for request in iter_requests(doctype, from_date, to_date, batch_size):
+			data = get_request_data(request)
+			amount = flt(data.get("amount"))
+			service, currency = request.integration_request_service, data.get("currency")
+
+			if is_in_range(request.creation, from_date, to_date):
+				rollup = rollups.setdefault(
+					(getdate(request.creation), service, currency, "Queued"),
+					[0, 0, 0, get_latency_histogram()],
+				)
+				rollup[0] += 1
+				rollup[1] += amount
+
+			if request.status in COUNTED_STATUSES[1:] and is_in_range(
+				request.modified, from_date, to_date
+			):
+				latency = max(time_diff_in_seconds(request.modified, request.creation), 0)
+				rollup = rollups.setdefault(
+					(getdate(request.modified), service, currency, request.status),
+					[0, 0, 0, get_latency_histogram()],
+				)
+				rollup[0] += 1
+				rollup[1] += amount
+				rollup[2] += latency
+				rollup[3][get_latency_bucket(latency)] += 1
+
+	for key, (count, amount, latency, histogram) in rollups.items():
+		add_to_rollup(
+			*key, count=count, amount=amount, latency=latency, histogram=histogram
+		)
+
+	frappe.db.commit()
+	return len(rollups)
+
+
+def is_in_range(date, from_date=None, to_date=None):
+	return (not from_date or getdate(date) >= getdate(from_date)) and (
+		not to_date or getdate(date) <= getdate(to_date)
+	)
+
+
+def iter_requests(doctype, from_date=None, to_date=None, batch_size=1000):
+	"""Walk payment requests of `doctype` created or modified in the date range by name,
+	one batch in memory at a time"""
+	filters = [
+		["is_remote_request", "=", 0],
+		["integration_request_service", "is", "set"],
+		["status", "is", "set"],
+	]
+	# requests are counted on the day they were created and the day they were last
+	# modified, the latter is never before the former
+	if from_date:
+		filters.append(["modified", ">=", getdate(from_date)])
+	if to_date:
+		filters.append(["creation", "<", add_days(getdate(to_date), 1)])
+
+	last_name = ""
+	while True:
+		batch = frappe.get_all(
+			doctype,
+			filters=filters + [["name", ">", last_name]],
+			fields=[
+				"name",
+				"creation",
+				"modified",
+				"integration_request_service",
+				"status",
+				"data",
+			],
+			order_by="name asc",
+			limit=batch_size,
+		)
+
+		yield from batch
+
+		if len(batch) < batch_size:
+			break
+
+		last_name = batch[-1].name
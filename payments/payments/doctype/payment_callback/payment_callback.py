@@ -0,0 +1,145 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+"""
+Outbox of `on_payment_authorized` callbacks to reference documents.
+
+Gateway controllers record the callback with `authorize_reference_document` in the
+same transaction as the status change of the Integration Request, so a committed
+payment always has its callback on record. By default the callback is delivered at
+once and its return value, the custom redirect of the reference document, is handed
+back to the checkout page. With `payments_callback_outbox` enabled in site config it
+is only delivered by a worker after the commit, keeping heavy ERP hooks out of the
+checkout request.
+
+A callback that raises is rolled back and retried with exponential backoff by
+`deliver_pending_callbacks`, up to `payments_callback_max_attempts` (site config,
+default 5) attempts, after which it is marked Failed and can be retried from the form.
+"""
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_to_date, cint, now_datetime
+
+from payments.utils import get_request_data
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BATCH_SIZE = 100
+
+
+class PaymentCallback(Document):
+	@frappe.whitelist()
+	def retry(self):
+		self.check_permission("write")
+
+		self.db_set({"status": "Pending", "attempts": 0, "next_attempt_on": now_datetime()})
+		enqueue_payment_callback(self.name)
+
+
+def is_outbox_enabled():
+	return cint(frappe.conf.payments_callback_outbox)
+
+
+def authorize_reference_document(integration_request, status, data=None, sync=None):
+	"""Record `on_payment_authorized(status)` for the reference document of
+	`integration_request`. Unless the outbox is enabled (or `sync` is False) it is
+	delivered at once, returns its return value then."""
+	data = frappe._dict(data or get_request_data(integration_request))
+	if not (data.reference_doctype and data.reference_docname):
+		return
+
+	callback = frappe.get_doc(
+		{
+			"doctype": "Payment Callback",
+			"integration_request": integration_request.name,
+			"reference_doctype": data.reference_doctype,
+			"reference_docname": data.reference_docname,
+			"payment_status": status,
+			"status": "Pending",
+			"next_attempt_on": now_datetime(),
+			"data": json.dumps(data, default=str),
+		}
+	).insert(ignore_permissions=True)
+
+	if sync is None:
+		sync = not is_outbox_enabled()
+
+	if not sync:
+		enqueue_payment_callback(callback.name)
+		return
+
+	return deliver_payment_callback(callback)
+
+
+def enqueue_payment_callback(name):
+	frappe.enqueue(
+		"payments.payments.doctype.payment_callback.payment_callback.deliver_queued_callback",
+		queue="short",
+		enqueue_after_commit=True,
+		name=name,
+	)
+
+
+def deliver_queued_callback(name):
+	callback = frappe.get_doc("Payment Callback", name, for_update=True)
+	if callback.status == "Pending":
+		deliver_payment_callback(callback)
+
+	frappe.db.commit()
+
+
+def deliver_payment_callback(callback):
+	"""Run the callback under a savepoint, returns its return value if it succeeded"""
+	frappe.db.savepoint("payment_callback")
+	try:
+		frappe.flags.data = frappe._dict(json.loads(callback.data or "{}"))
+		result = frappe.get_doc(callback.reference_doctype, callback.reference_docname).run_method(
+			"on_payment_authorized", callback.payment_status
+		)
+	except Exception:
+		frappe.db.rollback(save_point="payment_callback")
+		record_failed_attempt(callback, frappe.get_traceback())
+		return
+
+	callback.db_set(
+		{
+			"status": "Delivered",
+			"attempts": callback.attempts + 1,
+			"delivered_on": now_datetime(),
+			"next_attempt_on": None,
+			"error": None,
+		}
+	)
+	return result
+
+
+def record_failed_attempt(callback, error):
+	attempts = callback.attempts + 1
+	max_attempts = cint(frappe.conf.payments_callback_max_attempts) or DEFAULT_MAX_ATTEMPTS
+
+	if attempts >= max_attempts:
+		values = {"status": "Failed", "next_attempt_on": None}
+		frappe.log_error(error, f"Payment callback {callback.name} failed")
+	else:
+		# 2, 4, 8... minutes
+		values = {"next_attempt_on": add_to_date(now_datetime(), minutes=2**attempts)}
+
+	callback.db_set(dict(values, attempts=attempts, error=error))
+
+
+def deliver_pending_callbacks():
+	"""Retry callbacks that are due, and deliver those whose job was lost"""
+	for name in frappe.get_all(
+		"Payment Callback",
+		filters={"status": "Pending", "next_attempt_on": ("<=", now_datetime())},
+		order_by="next_attempt_on asc",
+		limit=DEFAULT_BATCH_SIZE,
+		pluck="name",
+	):
+		try:
+			deliver_queued_callback(name)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(frappe.get_traceback(), f"Payment callback {name} failed")
@@ -0,0 +1,75 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and Contributors
+# License: MIT. See LICENSE
+from unittest.mock import patch
+
+import frappe
+from frappe.core.doctype.user.user import User
+from frappe.integrations.utils import create_request_log
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from payments.payments.doctype.payment_callback.payment_callback import (
+	authorize_reference_document,
+	deliver_pending_callbacks,
+)
+
+
+@patch("frappe.enqueue")
+class TestPaymentCallback(FrappeTestCase):
+	def setUp(self):
+		patcher = patch.dict(frappe.conf, {"payments_callback_max_attempts": 2})
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def patch_callback(self, on_payment_authorized):
+		return patch.object(
+			User, "on_payment_authorized", side_effect=on_payment_authorized, create=True
+		)
+
+	def make_callback(self, on_payment_authorized):
+		data = {"reference_doctype": "User", "reference_docname": "Administrator"}
+		integration_request = create_request_log(data, service_name="Stripe")
+
+		with self.patch_callback(on_payment_authorized):
+			result = authorize_reference_document(integration_request, "Completed", sync=True)
+
+		callback = frappe.get_last_doc(
+			"Payment Callback", filters={"integration_request": integration_request.name}
+		)
+		return callback, result
+
+	def deliver_due(self, callback, on_payment_authorized):
+		callback.db_set("next_attempt_on", add_to_date(now_datetime(), minutes=-1))
+		with self.patch_callback(on_payment_authorized):
+			deliver_pending_callbacks()
+		callback.reload()
+
+	def test_delivered_at_once(self, enqueue):
+		callback, result = self.make_callback(lambda status: "/orders/1")
+
+		self.assertEqual(result, "/orders/1")
+		self.assertEqual((callback.status, callback.attempts), ("Delivered", 1))
+
+	def test_failed_callback_is_retried(self, enqueue):
+		callback, result = self.make_callback(Exception("ERP is down"))
+
+		self.assertIsNone(result)
+		self.assertEqual((callback.status, callback.attempts), ("Pending", 1))
+		self.assertIn("ERP is down", callback.error)
+		self.assertGreater(callback.next_attempt_on, now_datetime())
+
+		self.deliver_due(callback, lambda status: None)
+		self.assertEqual((callback.status, callback.attempts), ("Delivered", 2))
+		self.assertIsNone(callback.error)
+
+	def test_callback_gives_up_after_max_attempts(self, enqueue):
+		callback, result = self.make_callback(Exception("ERP is down"))
+
+		self.deliver_due(callback, Exception("ERP is still down"))
+		self.assertEqual((callback.status, callback.attempts), ("Failed", 2))
+		self.assertIsNone(callback.next_attempt_on)
+
+		callback.retry()
+		callback.reload()
+		self.assertEqual((callback.status, callback.attempts), ("Pending", 0))
+		enqueue.assert_called()
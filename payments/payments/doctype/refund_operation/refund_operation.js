@@ -0,0 +1,12 @@
+// Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Refund Operation', {
+	refresh: function(frm) {
+		if (["Queued", "In Progress", "Partially Failed"].includes(frm.doc.status)) {
+			frm.add_custom_button(__("Resume"), () => {
+				frm.call("resume").then(() => frm.reload_doc());
+			});
+		}
+	}
+});
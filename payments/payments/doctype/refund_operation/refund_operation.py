@@ -0,0 +1,159 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+"""
+Bulk refunds of Integration Requests across gateways.
+
+`create_refund_operation` records every Integration Request as a Pending item, and
+the refunds are issued in batches of `payments_refund_batch_size` (site config,
+default 200) on the concurrent, rate limited job runner, see
+`payments.utils.bulk_operation`. The results of a batch are written with one update
+of the items and one of the Integration Requests.
+
+A payment can only appear once per operation, and its Integration Request (or
+Integration Request Archive, once archived) is locked from the check of its refundable
+amount until its refund is recorded.
+
+A batch is marked Processing before any refund is issued. If the job dies while
+refunding, the interrupted items are marked Failed for review instead of being
+refunded again. Stripe, PayPal and Paytm refund only once per item, so retrying those
+with Resume is always safe.
+"""
+
+from collections import Counter
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+from payments.utils import get_integration_request
+from payments.utils.bulk_operation import (
+	BulkOperation,
+	get_failed_result,
+	get_item_result,
+	insert_items,
+)
+from payments.utils.concurrency import run_concurrently
+from payments.utils.refund import get_refund_query, record_refunds
+
+
+class RefundOperation(BulkOperation):
+	item_doctype = "Refund Operation Item"
+	item_fields = ("integration_request", "amount")
+	batch_size_key = "payments_refund_batch_size"
+	progress_fields = {"Refunded": "refunded", "Failed": "failed"}
+	interrupted_error = (
+		"Interrupted while refunding, check the payment at the gateway before retrying"
+	)
+
+	def before_insert(self):
+		super().before_insert()
+		self.total_requests = len(self.items)
+		names = [item.integration_request for item in self.items]
+		validate_unique_requests(names)
+
+		gateways = get_request_gateways(names)
+		for item in self.items:
+			item.gateway = gateways.get(item.integration_request)
+
+	@staticmethod
+	def process_batch(operation, items):
+		integration_requests = {item.name: item.integration_request for item in items}
+		updates = {}
+		refunds = {}
+
+		tasks = []
+		for item in items:
+			try:
+				# locked until the refund is recorded, like `refund_payment` does
+				integration_request = get_integration_request(item.integration_request, for_update=True)
+				# the item name doubles as idempotency key, so a retried item is refunded once
+				query = get_refund_query(integration_request, item.amount, idempotency_key=item.name)
+			except Exception:
+				frappe.clear_last_message()
+				updates[item.name] = get_item_result("Failed", error=frappe.get_traceback())
+				continue
+
+			tasks.append((item.name, integration_request.integration_request_service, query))
+
+		for name, result, exception in run_concurrently(tasks):
+			if exception:
+				updates[name] = get_failed_result(exception)
+				continue
+
+			updates[name] = get_item_result(
+				"Refunded",
+				refund_id=result.get("refund_id"),
+				refunded_amount=flt(result.get("refunded_amount")),
+			)
+			refunds[integration_requests[name]] = result
+
+		record_refunds(refunds)
+		return updates
+
+
+@frappe.whitelist()
+def create_refund_operation(refunds):
+	"""Queue refunds of a list of Integration Request names, or of
+	`{"integration_request": ..., "amount": ...}` dicts for partial refunds, returns the
+	name of the Refund Operation tracking them"""
+	refunds = [
+		frappe._dict(refund if isinstance(refund, dict) else {"integration_request": refund})
+		for refund in frappe.parse_json(refunds) or []
+	]
+	if not refunds:
+		frappe.throw(_("Please provide at least one payment to refund"))
+
+	names = [refund.integration_request for refund in refunds]
+	validate_unique_requests(names)
+
+	gateways = get_request_gateways(names)
+	missing = [
+		refund.integration_request for refund in refunds if refund.integration_request not in gateways
+	]
+	if missing:
+		frappe.throw(_("Integration Requests not found: {0}").format(", ".join(missing)))
+
+	doc = frappe.get_doc({"doctype": "Refund Operation"}).insert()
+	insert_items(
+		doc,
+		["integration_request", "gateway", "amount"],
+		[
+			(refund.integration_request, gateways[refund.integration_request], flt(refund.amount))
+			for refund in refunds
+		],
+	)
+	doc.db_set("total_requests", len(refunds))
+
+	return doc.name
+
+
+def validate_unique_requests(names):
+	# refunds of one payment would all be checked against what was left before the batch
+	duplicates = [name for name, count in Counter(names).items() if count > 1]
+	if duplicates:
+		frappe.throw(
+			_("Payments can only be refunded once per operation: {0}").format(
+				", ".join(sorted(duplicates))
+			)
+		)
+
+
+def get_request_gateways(names):
+	"""Return `{name: gateway}` of Integration Requests, archived or not"""
+	gateways = {}
+	for doctype in ("Integration Request", "Integration Request Archive"):
+		remaining = [name for name in names if name not in gateways]
+		if not remaining:
+			break
+
+		gateways.update(
+			frappe.get_all(
+				doctype,
+				filters={"name": ("in", remaining)},
+				fields=["name", "integration_request_service"],
+				as_list=True,
+			)
+		)
+
+	return gateways
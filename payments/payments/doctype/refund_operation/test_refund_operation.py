@@ -0,0 +1,7 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and Contributors
+# License: MIT. See LICENSE
+import unittest
+
+
+class TestRefundOperation(unittest.TestCase):
+	pass
@@ -0,0 +1,8 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+from frappe.model.document import Document
+
+
+class RefundOperationItem(Document):
+	pass
@@ -0,0 +1,105 @@
+# Copyright (c) 2023, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+"""
+Bulk cancel, pause or resume of Razorpay subscriptions and PayPal recurring payments
+profiles.
+
+`create_subscription_operation` records every subscription as a Pending item, and
+the gateway is called for them in batches of
+`payments_subscription_operation_batch_size` (site config, default 200) on the
+concurrent, rate limited job runner, see `payments.utils.bulk_operation`. An
+interrupted operation continues from its pending items when it is resumed.
+
+Each gateway provides the call through `get_subscription_action_query(subscription_id,
+action)` in its settings module, which returns a thread safe callable returning
+`{"gateway_status": ..., "is_active": ...}`, or `None` if the subscription was not in
+a state the action applies to.
+"""
+
+import frappe
+from frappe import _
+
+from payments.payments.doctype.gateway_subscription.gateway_subscription import (
+	update_subscription,
+)
+from payments.utils.bulk_operation import (
+	BulkOperation,
+	get_failed_result,
+	get_item_result,
+	insert_items,
+)
+from payments.utils.concurrency import run_concurrently
+
+SUBSCRIPTION_ACTION_QUERIES = {
+	"Razorpay": "payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.get_subscription_action_query",
+	"PayPal": "payments.payment_gateways.doctype.paypal_settings.paypal_settings.get_subscription_action_query",
+}
+
+
+class SubscriptionOperation(BulkOperation):
+	item_doctype = "Subscription Operation Item"
+	item_fields = ("subscription_id",)
+	operation_fields = ("gateway", "action")
+	batch_size_key = "payments_subscription_operation_batch_size"
+	progress_fields = {"Succeeded": "succeeded", "Failed": "failed", "Skipped": "skipped"}
+
+	def before_insert(self):
+		super().before_insert()
+		self.total_subscriptions = len(self.items)
+
+	@staticmethod
+	def process_batch(operation, items):
+		gateway, action = operation.gateway, operation.action
+		subscription_ids = {item.name: item.subscription_id for item in items}
+		updates = {}
+
+		tasks = []
+		for item in items:
+			try:
+				query = frappe.get_attr(SUBSCRIPTION_ACTION_QUERIES[gateway])(
+					item.subscription_id, action
+				)
+			except Exception:
+				updates[item.name] = get_item_result("Failed", error=frappe.get_traceback())
+				continue
+
+			tasks.append((item.name, gateway, query))
+
+		for name, result, exception in run_concurrently(tasks):
+			if exception:
+				updates[name] = get_failed_result(exception)
+			elif not result:
+				updates[name] = get_item_result("Skipped")
+			else:
+				updates[name] = get_item_result(
+					"Succeeded", gateway_status=result.get("gateway_status")
+				)
+				update_subscription(gateway, subscription_ids[name], result)
+
+		return updates
+
+
+@frappe.whitelist()
+def create_subscription_operation(gateway, action, subscription_ids):
+	"""Queue `action` (Cancel, Pause or Resume) for a list of subscription ids of
+	`gateway`, returns the name of the Subscription Operation tracking it"""
+	subscription_ids = frappe.parse_json(subscription_ids)
+	subscription_ids = list(dict.fromkeys(filter(None, subscription_ids or [])))
+	if not subscription_ids:
+		frappe.throw(_("Please provide at least one subscription"))
+
+	if gateway not in SUBSCRIPTION_ACTION_QUERIES:
+		frappe.throw(_("Bulk subscription operations are not supported for {0}").format(gateway))
+
+	doc = frappe.get_doc(
+		{"doctype": "Subscription Operation", "gateway": gateway, "action": action}
+	).insert()
+	insert_items(
+		doc,
+		["subscription_id"],
+		[(subscription_id,) for subscription_id in subscription_ids],
+	)
+	doc.db_set("total_subscriptions", len(subscription_ids))
+
+	return doc.name
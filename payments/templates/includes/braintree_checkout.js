@@ -2,9 +2,7 @@ $(document).ready(function() {
 
 	var button = document.querySelector('#submit-button');
 	var form = document.querySelector('#payment-form');
-	var data = {{ frappe.form_dict | json }};
-	var doctype = "{{ reference_doctype }}"
-	var docname = "{{ reference_docname }}"
+	var token = "{{ token }}"
 
 	braintree.dropin.create({
 		authorization: "{{ client_token }}",
@@ -20,7 +18,7 @@ $(document).ready(function() {
 					console.log('Error', err);
 					return;
 				}
-				frappe.call({
+				payments.make_payment({
 					method: "payments.templates.pages.braintree_checkout.make_payment",
 					freeze: true,
 					headers: {
@@ -28,9 +26,7 @@ $(document).ready(function() {
 					},
 					args: {
 						"payload_nonce": payload.nonce,
-						"data": JSON.stringify(data),
-						"reference_doctype": doctype,
-						"reference_docname": docname
+						"token": token
 					},
 					callback: function(r) {
 						if (r.message && r.message.status == "Completed") {
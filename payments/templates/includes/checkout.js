@@ -0,0 +1,43 @@
+frappe.provide('payments');
+
+// sent with every `make_payment` call of this page, so that double clicks and retries
+// return the response of the first call instead of charging again
+payments.idempotency_key = Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+// `frappe.call` for the `make_payment` endpoints of checkout pages, waits for the
+// payment to be confirmed when the site confirms payments in the background
+payments.make_payment = function(opts) {
+	var callback = opts.callback;
+	opts.args.idempotency_key = payments.idempotency_key;
+
+	opts.callback = function(r) {
+		if (r.message && r.message.checkout_job) {
+			payments.wait_for_payment(r.message.checkout_job, callback);
+		} else {
+			callback(r);
+		}
+	}
+
+	frappe.call(opts);
+}
+
+payments.wait_for_payment = function(checkout_job, callback) {
+	frappe.call({
+		method: "payments.utils.checkout.get_payment_status",
+		headers: {"X-Requested-With": "XMLHttpRequest"},
+		args: {
+			"checkout_job": checkout_job
+		},
+		callback: function(r) {
+			if (r.message.status == "Queued") {
+				setTimeout(function() {
+					payments.wait_for_payment(checkout_job, callback);
+				}, 1000);
+			} else if (r.message.status == "Failed") {
+				window.location.href = r.message.result.redirect_to
+			} else {
+				callback({message: r.message.result});
+			}
+		}
+	});
+}
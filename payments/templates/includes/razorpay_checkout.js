@@ -30,7 +30,7 @@ razorpay.make_payment_log = function(response, options, doctype, docname, token)
 	$('.razorpay-loading').addClass('hidden');
 	$('.razorpay-confirming').removeClass('hidden');
 
-	frappe.call({
+	payments.make_payment({
 		method:"payments.templates.pages.razorpay_checkout.make_payment",
 		freeze:true,
 		headers: {"X-Requested-With": "XMLHttpRequest"},
@@ -31,15 +31,13 @@ function setOutcome(result) {
 	if (result.token) {
 		$('#submit').prop('disabled', true)
 		$('#submit').html(__('Processing...'))
-		frappe.call({
+		payments.make_payment({
 			method:"payments.templates.pages.stripe_checkout.make_payment",
 			freeze:true,
 			headers: {"X-Requested-With": "XMLHttpRequest"},
 			args: {
 				"stripe_token_id": result.token.id,
-				"data": JSON.stringify({{ frappe.form_dict|json }}),
-				"reference_doctype": "{{ reference_doctype }}",
-				"reference_docname": "{{ reference_docname }}"
+				"token": "{{ token }}"
 			},
 			callback: function(r) {
 				if (r.message.status == "Completed") {
@@ -1,16 +1,18 @@
 # Copyright (c) 2021, Frappe Technologies Pvt. Ltd. and Contributors
 # License: MIT. See LICENSE
 
-import json
-
 import frappe
 from frappe import _
 from frappe.utils import flt
 
+from payments.exceptions import GatewayUnavailableError
 from payments.payment_gateways.doctype.braintree_settings.braintree_settings import (
 	get_client_token,
 	get_gateway_controller,
 )
+from payments.utils import get_checkout_session
+from payments.utils.checkout import process_payment
+from payments.utils.velocity import velocity_limit
 
 no_cache = 1
 
@@ -30,21 +32,33 @@ expected_keys = (
 def get_context(context):
 	context.no_cache = 1
 
-	# all these keys exist in form_dict
-	if not (set(expected_keys) - set(list(frappe.form_dict))):
+	try:
+		payment_details = get_checkout_session(frappe.form_dict.get("token"), "Braintree")
+
 		for key in expected_keys:
-			context[key] = frappe.form_dict[key]
+			context[key] = payment_details[key]
 
-		context.client_token = get_client_token(context.reference_docname)
+		context.token = frappe.form_dict.token
+		gateway_controller = get_gateway_controller(payment_details)
+		context.client_token = get_client_token(gateway_controller)
 
 		context["amount"] = flt(context["amount"])
 
-		gateway_controller = get_gateway_controller(context.reference_docname)
 		context["header_img"] = frappe.db.get_value(
 			"Braintree Settings", gateway_controller, "header_img"
 		)
 
-	else:
+	except GatewayUnavailableError as e:
+		frappe.redirect_to_message(
+			_("Payment gateway unavailable"),
+			str(e),
+			http_status_code=GatewayUnavailableError.http_status_code,
+			indicator_color="red",
+		)
+		frappe.local.flags.redirect_location = frappe.local.response.location
+		raise frappe.Redirect
+
+	except Exception:
 		frappe.redirect_to_message(
 			_("Some information is missing"),
 			_(
@@ -56,12 +70,23 @@ def get_context(context):
 
 
 @frappe.whitelist(allow_guest=True)
-def make_payment(payload_nonce, data, reference_doctype, reference_docname):
-	data = json.loads(data)
+@velocity_limit(reference="token")
+def make_payment(payload_nonce, token, idempotency_key=None):
+	return process_payment(
+		"payments.templates.pages.braintree_checkout.confirm_payment",
+		{
+			"payload_nonce": payload_nonce,
+			"token": token,
+		},
+		idempotency_key=idempotency_key,
+	)
+
 
-	data.update({"payload_nonce": payload_nonce})
+def confirm_payment(payload_nonce, token):
+	data = get_checkout_session(token, "Braintree")
+	data.update({"payload_nonce": payload_nonce, "token": token})
 
-	gateway_controller = get_gateway_controller(reference_docname)
+	gateway_controller = get_gateway_controller(data)
 	data = frappe.get_doc("Braintree Settings", gateway_controller).create_payment_request(
 		data
 	)
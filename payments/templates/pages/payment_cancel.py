@@ -7,6 +7,7 @@ import frappe
 def get_context(context):
 	token = frappe.local.form_dict.token
 
-	if token:
-		frappe.db.set_value("Integration Request", token, "status", "Cancelled")
+	if token and frappe.db.exists("Integration Request", token):
+		# `db_set` rather than `frappe.db.set_value`, so the cancellation is counted
+		frappe.get_doc("Integration Request", token).db_set("status", "Cancelled")
 		frappe.db.commit()
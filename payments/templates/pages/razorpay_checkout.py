@@ -6,6 +6,9 @@ import frappe
 from frappe import _
 from frappe.utils import cint, flt
 
+from payments.utils.checkout import process_payment
+from payments.utils.velocity import velocity_limit
+
 no_cache = 1
 
 expected_keys = (
@@ -59,9 +62,29 @@ def get_api_key():
 
 
 @frappe.whitelist(allow_guest=True)
+@velocity_limit(reference="token")
 def make_payment(
-	razorpay_payment_id, options, reference_doctype, reference_docname, token
+	razorpay_payment_id,
+	options,
+	reference_doctype,
+	reference_docname,
+	token,
+	idempotency_key=None,
 ):
+	return process_payment(
+		"payments.templates.pages.razorpay_checkout.confirm_payment",
+		{
+			"razorpay_payment_id": razorpay_payment_id,
+			"options": options,
+			"reference_doctype": reference_doctype,
+			"reference_docname": reference_docname,
+			"token": token,
+		},
+		idempotency_key=idempotency_key,
+	)
+
+
+def confirm_payment(razorpay_payment_id, options, reference_doctype, reference_docname, token):
 	data = {}
 
 	if isinstance(options, str):
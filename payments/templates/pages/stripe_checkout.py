@@ -1,7 +1,5 @@
 # Copyright (c) 2021, Frappe Technologies Pvt. Ltd. and Contributors
 # License: MIT. See LICENSE
-import json
-
 import frappe
 from frappe import _
 from frappe.utils import cint, fmt_money
@@ -9,6 +7,9 @@ from frappe.utils import cint, fmt_money
 from payments.payment_gateways.doctype.stripe_settings.stripe_settings import (
 	get_gateway_controller,
 )
+from payments.utils import get_checkout_session
+from payments.utils.checkout import process_payment
+from payments.utils.velocity import velocity_limit
 
 no_cache = 1
 
@@ -28,15 +29,15 @@ expected_keys = (
 def get_context(context):
 	context.no_cache = 1
 
-	# all these keys exist in form_dict
-	if not (set(expected_keys) - set(list(frappe.form_dict))):
+	try:
+		payment_details = get_checkout_session(frappe.form_dict.get("token"), "Stripe")
+
 		for key in expected_keys:
-			context[key] = frappe.form_dict[key]
+			context[key] = payment_details[key]
 
-		gateway_controller = get_gateway_controller(
-			context.reference_doctype, context.reference_docname
-		)
-		context.publishable_key = get_api_key(context.reference_docname, gateway_controller)
+		context.token = frappe.form_dict.token
+		gateway_controller = get_gateway_controller(payment_details)
+		context.publishable_key = get_api_key(payment_details, gateway_controller)
 		context.image = get_header_image(context.reference_docname, gateway_controller)
 
 		context["amount"] = fmt_money(amount=context["amount"], currency=context["currency"])
@@ -49,7 +50,7 @@ def get_context(context):
 
 			context["amount"] = context["amount"] + " " + _(recurrence)
 
-	else:
+	except Exception:
 		frappe.redirect_to_message(
 			_("Some information is missing"),
 			_(
@@ -60,11 +61,11 @@ def get_context(context):
 		raise frappe.Redirect
 
 
-def get_api_key(doc, gateway_controller):
+def get_api_key(payment_details, gateway_controller):
 	publishable_key = frappe.db.get_value(
 		"Stripe Settings", gateway_controller, "publishable_key"
 	)
-	if cint(frappe.form_dict.get("use_sandbox")):
+	if cint(payment_details.get("use_sandbox")):
 		publishable_key = frappe.conf.sandbox_publishable_key
 
 	return publishable_key
@@ -77,12 +78,27 @@ def get_header_image(doc, gateway_controller):
 
 
 @frappe.whitelist(allow_guest=True)
-def make_payment(stripe_token_id, data, reference_doctype=None, reference_docname=None):
-	data = json.loads(data)
+@velocity_limit(reference="token")
+def make_payment(stripe_token_id, token, idempotency_key=None):
+	return process_payment(
+		"payments.templates.pages.stripe_checkout.confirm_payment",
+		{
+			"stripe_token_id": stripe_token_id,
+			"token": token,
+			"idempotency_key": idempotency_key,
+		},
+		idempotency_key=idempotency_key,
+	)
+
 
-	data.update({"stripe_token_id": stripe_token_id})
+def confirm_payment(stripe_token_id, token, idempotency_key=None):
+	data = get_checkout_session(token, "Stripe")
+	data.update(
+		{"stripe_token_id": stripe_token_id, "token": token, "idempotency_key": idempotency_key}
+	)
 
-	gateway_controller = get_gateway_controller(reference_doctype, reference_docname)
+	reference_doctype, reference_docname = data.reference_doctype, data.reference_docname
+	gateway_controller = get_gateway_controller(data)
 
 	if is_a_subscription(reference_doctype, reference_docname):
 		reference = frappe.get_doc(reference_doctype, reference_docname)
@@ -0,0 +1,64 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+from unittest.mock import patch
+
+import frappe
+from frappe.integrations.utils import create_request_log
+from frappe.tests.utils import FrappeTestCase
+
+from payments.exceptions import DuplicatePaymentError
+from payments.utils import checkout, idempotency
+
+PAYMENTS = []
+
+
+def make_payment(token, status="Completed"):
+	"""Stands in for the `make_payment` of a checkout page"""
+	PAYMENTS.append(token)
+	frappe.db.set_value("Integration Request", token, "status", status)
+	return {"redirect_to": f"/payment-success?token={token}", "attempt": len(PAYMENTS)}
+
+
+class TestCheckoutIdempotency(FrappeTestCase):
+	method = "payments.tests.test_checkout.make_payment"
+
+	def setUp(self):
+		PAYMENTS.clear()
+		self.token = create_request_log({"amount": 10}, service_name="Stripe").name
+		self.idempotency_key = frappe.generate_hash(length=20)
+
+		patcher = patch.dict(frappe.conf, {"payments_async_checkout": 0})
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def pay(self, **kwargs):
+		return checkout.process_payment(
+			self.method, dict(token=self.token, **kwargs), idempotency_key=self.idempotency_key
+		)
+
+	def get_key(self):
+		return idempotency.get_payload_hash(
+			{"method": self.method, "token": self.token, "idempotency_key": self.idempotency_key}
+		)
+
+	def test_replayed_key_returns_same_response(self):
+		response = self.pay()
+
+		self.assertEqual(self.pay(), response)
+		self.assertEqual(PAYMENTS, [self.token])
+
+		# another page load is another payment attempt
+		self.idempotency_key = frappe.generate_hash(length=20)
+		self.assertEqual(self.pay()["attempt"], 2)
+
+	def test_call_in_flight_is_refused(self):
+		idempotency.claim("Checkout", self.get_key(), 60)
+		self.addCleanup(idempotency.release, "Checkout", self.get_key())
+
+		self.assertRaises(DuplicatePaymentError, self.pay)
+		self.assertEqual(PAYMENTS, [])
+
+	def test_call_without_outcome_can_be_retried(self):
+		self.pay(status="Queued")
+		self.assertEqual(self.pay()["attempt"], 2)
+		self.assertEqual(self.pay()["attempt"], 2)
@@ -0,0 +1,100 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+from unittest.mock import patch
+
+import frappe
+import requests
+from frappe.tests.utils import FrappeTestCase
+
+from payments.exceptions import CircuitOpenError
+from payments.utils import circuit_breaker
+from payments.utils.circuit_breaker import CLOSED, HALF_OPEN, OPEN
+
+
+def http_error(status_code):
+	response = requests.Response()
+	response.status_code = status_code
+	return requests.exceptions.HTTPError(response=response)
+
+
+class TestCircuitBreaker(FrappeTestCase):
+	def setUp(self):
+		self.name = f"Stripe-{frappe.generate_hash(length=6)}"
+		self.addCleanup(self.reset)
+
+		patcher = patch.dict(
+			frappe.conf,
+			{"payments_circuit_min_calls": 4, "payments_circuit_failure_rate": 0.5},
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def reset(self):
+		circuit_breaker.close_circuit(self.name)
+		frappe.cache().delete(circuit_breaker.get_key(self.name, "open"))
+
+	def call(self, exception=None):
+		try:
+			with circuit_breaker.guard(self.name):
+				if exception:
+					raise exception
+		except Exception as e:
+			if e is not exception:
+				raise
+
+	def end_open_period(self):
+		frappe.cache().delete(circuit_breaker.get_key(self.name, "open"))
+
+	def test_failure_classification(self):
+		self.assertTrue(circuit_breaker.is_gateway_failure(http_error(503)))
+		self.assertTrue(circuit_breaker.is_gateway_failure(http_error(429)))
+		self.assertFalse(circuit_breaker.is_gateway_failure(http_error(402)))
+		self.assertTrue(circuit_breaker.is_gateway_failure(requests.exceptions.ConnectTimeout()))
+		self.assertFalse(circuit_breaker.is_gateway_failure(ValueError()))
+
+	def test_opens_after_failure_rate(self):
+		self.call()
+		self.call()
+		self.call(http_error(502))
+		# a failure rate of 1/3, and fewer calls than needed anyway
+		self.assertEqual(circuit_breaker.get_circuit_state(self.name), CLOSED)
+
+		self.call(http_error(502))
+		self.assertEqual(circuit_breaker.get_circuit_state(self.name), OPEN)
+
+		stats = circuit_breaker.get_circuit_stats(self.name)
+		self.assertEqual((stats.calls, stats.failures), (4, 2))
+
+		self.assertRaises(CircuitOpenError, self.call)
+
+	def test_request_errors_do_not_open(self):
+		for _i in range(5):
+			self.call(http_error(400))
+
+		self.assertEqual(circuit_breaker.get_circuit_state(self.name), CLOSED)
+
+	def test_successful_probe_closes(self):
+		circuit_breaker.open_circuit(self.name)
+		self.end_open_period()
+		self.assertEqual(circuit_breaker.get_circuit_state(self.name), HALF_OPEN)
+
+		self.call()
+		self.assertEqual(circuit_breaker.get_circuit_state(self.name), CLOSED)
+		self.assertEqual(circuit_breaker.get_circuit_stats(self.name).calls, 0)
+
+	def test_failed_probe_opens_again(self):
+		circuit_breaker.open_circuit(self.name)
+		self.end_open_period()
+
+		self.call(requests.exceptions.ConnectionError())
+		self.assertEqual(circuit_breaker.get_circuit_state(self.name), OPEN)
+
+	def test_single_probe(self):
+		circuit_breaker.open_circuit(self.name)
+		self.end_open_period()
+
+		with circuit_breaker.guard(self.name):
+			# other calls are refused while the probe is in flight
+			self.assertRaises(CircuitOpenError, self.call)
+
+		self.assertEqual(circuit_breaker.get_circuit_state(self.name), CLOSED)
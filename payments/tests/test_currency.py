@@ -0,0 +1,62 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import unittest
+
+import frappe
+
+from payments.utils import currency
+
+
+class TestCurrency(unittest.TestCase):
+	def test_supported_currencies(self):
+		self.assertTrue(currency.supports_currency("Stripe", "USD"))
+		self.assertTrue(currency.supports_currency("Stripe-Acme", "JPY"))
+		self.assertFalse(currency.supports_currency("Razorpay", "USD"))
+		self.assertTrue(currency.supports_currency("Razorpay", "INR"))
+
+		# gateways of other apps are not restricted here
+		self.assertTrue(currency.supports_currency("Custom", "XYZ"))
+
+	def test_minimum_amounts(self):
+		self.assertEqual(currency.get_minimum_amount("Stripe-Acme", "USD"), 0.5)
+		self.assertEqual(currency.get_minimum_amount("Stripe", "INR"), 0)
+		self.assertEqual(currency.get_minimum_amount("Razorpay", "INR"), 0)
+
+	def test_minor_units(self):
+		self.assertEqual(currency.to_minor_units(10.5, "USD"), 1050)
+		self.assertEqual(currency.to_minor_units(500, "jpy"), 500)
+		self.assertEqual(currency.to_minor_units(1.234, "KWD"), 1234)
+		# rounded, not truncated, e.g. 0.29 * 100 == 28.999999999999996
+		self.assertEqual(currency.to_minor_units(0.29, "EUR"), 29)
+
+		self.assertEqual(currency.from_minor_units(1050, "USD"), 10.5)
+		self.assertEqual(currency.from_minor_units(500, "JPY"), 500)
+		self.assertEqual(currency.from_minor_units(1234, "KWD"), 1.234)
+
+	def test_validate_payments(self):
+		errors = currency.validate_payments(
+			"Stripe-Acme",
+			[
+				{"currency": "USD", "amount": 10},
+				{"currency": "USD", "amount": 0.2},
+				{"currency": "XYZ", "amount": 10},
+				{"currency": "JPY", "amount": 50},
+			],
+		)
+
+		self.assertEqual(set(errors), {1, 2})
+		self.assertIn("0.5", errors[1])
+		self.assertIn("XYZ", errors[2])
+
+	def test_validate_single_payment(self):
+		currency.validate_transaction_currency("Razorpay", "INR")
+		self.assertRaises(
+			frappe.ValidationError, currency.validate_transaction_currency, "Razorpay", "USD"
+		)
+		self.assertRaises(
+			frappe.ValidationError,
+			currency.validate_minimum_transaction_amount,
+			"Stripe",
+			"GBP",
+			0.2,
+		)
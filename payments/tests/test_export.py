@@ -0,0 +1,70 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import json
+import os
+import tempfile
+
+import frappe
+from frappe.integrations.utils import create_request_log
+from frappe.tests.utils import FrappeTestCase
+
+from payments.utils.export import decode_payload, export_payment_records, iter_payment_records
+
+
+class TestExport(FrappeTestCase):
+	def setUp(self):
+		self.gateway = f"Export-{frappe.generate_hash(length=6)}"
+		self.names = []
+		for idx in range(5):
+			request = create_request_log(
+				{"amount": idx + 1, "currency": "INR"}, service_name=self.gateway
+			)
+			self.names.append(request.name)
+
+		# requests created within the same second are told apart by name
+		frappe.db.set_value(
+			"Integration Request",
+			{"name": ("in", self.names)},
+			"creation",
+			"2023-01-01 10:00:00",
+			update_modified=False,
+		)
+
+	def test_keyset_pagination(self):
+		for batch_size in (1, 2, 5, 10):
+			records = list(iter_payment_records(gateway=self.gateway, batch_size=batch_size))
+			self.assertEqual([record.name for record in records], sorted(self.names))
+
+	def test_date_filters(self):
+		records = iter_payment_records(
+			gateway=self.gateway, from_date="2023-01-01", to_date="2023-01-01"
+		)
+		self.assertEqual(len(list(records)), 5)
+
+		records = iter_payment_records(gateway=self.gateway, from_date="2023-01-02")
+		self.assertEqual(list(records), [])
+
+	def test_ndjson_export(self):
+		frappe.db.set_value("Integration Request", self.names[0], "data", json.dumps([1, 2]))
+
+		fd, file_path = tempfile.mkstemp(suffix=".ndjson")
+		os.close(fd)
+		self.addCleanup(os.remove, file_path)
+
+		count = export_payment_records(
+			file_path, export_format="ndjson", gateway=self.gateway, batch_size=2
+		)
+		self.assertEqual(count, 5)
+
+		with open(file_path) as f:
+			rows = {row["name"]: row for row in map(json.loads, f)}
+
+		self.assertEqual(set(rows), set(self.names))
+		self.assertEqual(rows[self.names[0]]["data"], {"value": [1, 2]})
+		self.assertEqual(rows[self.names[1]]["data"]["amount"], 2)
+
+	def test_decode_payload(self):
+		self.assertEqual(decode_payload(None), {})
+		self.assertEqual(decode_payload('{"amount": 1}'), {"amount": 1})
+		self.assertEqual(decode_payload('"text"'), {"value": "text"})
+		self.assertEqual(decode_payload("not json"), {"raw": "not json"})
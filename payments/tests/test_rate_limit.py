@@ -0,0 +1,99 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest.mock import patch
+
+import frappe
+import requests
+from frappe.tests.utils import FrappeTestCase
+
+from payments.utils import http, rate_limit
+
+
+class TestRateLimit(FrappeTestCase):
+	def setUp(self):
+		self.gateway = f"Stripe-{frappe.generate_hash(length=6)}"
+		self.bucket = self.make_bucket(rate=20)
+		self.addCleanup(frappe.cache().delete, self.bucket.key)
+
+	def make_bucket(self, rate):
+		cache = frappe.cache()
+		return rate_limit.TokenBucket(
+			cache.make_key(f"payments:rate_limit:{self.gateway}"),
+			cache.register_script(rate_limit.ACQUIRE_SCRIPT),
+			rate,
+		)
+
+	def take(self):
+		"""Take a token, returns the seconds to wait for one if there is none"""
+		bucket = self.bucket
+		return float(bucket.script(keys=[bucket.key], args=[bucket.rate, bucket.capacity, 0]))
+
+	def test_bucket_holds_one_second_of_tokens(self):
+		for _i in range(20):
+			self.assertEqual(self.take(), 0)
+
+		wait = self.take()
+		self.assertGreater(wait, 0)
+		self.assertLessEqual(wait, 1 / 20)
+
+	def test_acquire_waits_for_refill(self):
+		for _i in range(20):
+			self.bucket.acquire()
+
+		started_at = time.monotonic()
+		self.bucket.acquire()
+		self.assertGreaterEqual(time.monotonic() - started_at, 0.02)
+
+	def test_pause(self):
+		self.bucket.pause(2)
+		self.assertGreater(self.take(), 2)
+
+		# Retry-After is capped
+		self.bucket.pause(24 * 60 * 60)
+		self.assertLessEqual(self.take(), rate_limit.MAX_RETRY_AFTER + 1)
+
+	def test_gateway_rates(self):
+		with patch.dict(
+			frappe.conf,
+			{"payments_gateway_rate_limits": {"Stripe": 50, "Stripe-Slow": 2}},
+		):
+			self.assertEqual(rate_limit.get_gateway_rate("Stripe-Acme"), 50)
+			self.assertEqual(rate_limit.get_gateway_rate("Stripe-Slow"), 2)
+			self.assertEqual(rate_limit.get_gateway_rate("Razorpay"), 10)
+			self.assertEqual(rate_limit.get_gateway_rate("Custom"), 5)
+
+			limiter = rate_limit.get_gateway_limiter("Stripe-Slow")
+			self.assertIs(rate_limit.get_gateway_limiter("Stripe-Slow"), limiter)
+
+			frappe.conf.payments_gateway_rate_limits = {"Stripe-Slow": 3}
+			self.assertEqual(rate_limit.get_gateway_limiter("Stripe-Slow").rate, 3)
+
+	def test_retry_after(self):
+		response = requests.Response()
+		self.assertEqual(http.get_retry_after(response, 1), 1)
+
+		response.headers["Retry-After"] = "7"
+		self.assertEqual(http.get_retry_after(response), 7)
+
+		response.headers["Retry-After"] = format_datetime(
+			datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True
+		)
+		self.assertAlmostEqual(http.get_retry_after(response), 30, delta=2)
+
+	@patch("payments.utils.http.get_session")
+	def test_429_pauses_the_bucket_of_the_thread(self, get_session):
+		response = requests.Response()
+		response.status_code = 429
+		response.headers["Retry-After"] = "3"
+		get_session.return_value.request.return_value = response
+
+		previous = http.set_rate_limiter(self.bucket)
+		try:
+			self.assertRaises(requests.exceptions.HTTPError, http.make_get_request, "https://x")
+		finally:
+			http.set_rate_limiter(previous)
+
+		self.assertGreater(self.take(), 3)
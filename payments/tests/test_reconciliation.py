@@ -0,0 +1,51 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+from unittest.mock import patch
+
+import frappe
+from frappe.integrations.utils import create_request_log
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, now_datetime
+
+from payments.utils import reconciliation
+
+
+@patch("payments.utils.http.make_get_request")
+class TestRazorpayReconciliation(FrappeTestCase):
+	def make_order_request(self):
+		"""A Queued order flow request, as left by `create_order` when the callback is lost"""
+		request = create_request_log({"amount": 10000, "currency": "INR"}, service_name="Razorpay")
+		request.db_set("request_id", f"order_{frappe.generate_hash(length=10)}")
+		return request
+
+	def reconcile(self, request):
+		request = frappe.get_doc("Integration Request", request.name)
+		result = reconciliation.get_status_query(request)()
+		reconciliation.apply_reconciled_status(request.name, result)
+		return result
+
+	def test_lost_callback_is_completed(self, make_get_request):
+		request = self.make_order_request()
+		make_get_request.return_value = {
+			"items": [{"id": "pay_failed", "status": "failed"}, {"id": "pay_1", "status": "captured"}]
+		}
+
+		self.reconcile(request)
+
+		self.assertIn(f"/v1/orders/{request.request_id}/payments", make_get_request.call_args.args[0])
+		request.reload()
+		self.assertEqual(request.status, "Completed")
+		self.assertEqual(request.gateway_payment_id, "pay_1")
+		self.assertEqual(frappe.parse_json(request.data).razorpay_payment_id, "pay_1")
+
+	def test_unpaid_order_is_cancelled_once_expired(self, make_get_request):
+		request = self.make_order_request()
+		make_get_request.return_value = {"items": [{"id": "pay_failed", "status": "failed"}]}
+
+		self.assertIsNone(self.reconcile(request)["status"])
+
+		request.db_set("creation", add_days(now_datetime(), -31), update_modified=False)
+		self.reconcile(request)
+
+		request.reload()
+		self.assertEqual(request.status, "Cancelled")
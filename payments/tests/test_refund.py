@@ -0,0 +1,102 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import json
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.integrations.utils import create_request_log
+from frappe.tests.utils import FrappeTestCase
+
+from payments.payments.doctype.refund_operation.refund_operation import create_refund_operation
+from payments.utils import refund
+
+
+class TestRefund(FrappeTestCase):
+	def setUp(self):
+		self.refunds = []
+		controller = MagicMock()
+		controller.get_refund_query.side_effect = self.get_refund_query
+
+		patcher = patch.object(refund, "get_integration_request_controller", return_value=controller)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def get_refund_query(self, integration_request, amount=None, idempotency_key=None):
+		def query():
+			self.refunds.append(idempotency_key)
+			return {
+				"refund_id": f"re_{len(self.refunds)}",
+				"refunded_amount": amount or 100,
+				"status": "succeeded",
+			}
+
+		return query
+
+	def make_payment(self, amount=100, **data):
+		request = create_request_log(
+			{"amount": amount, "currency": "USD", **data}, service_name="Stripe"
+		)
+		request.db_set("status", "Completed")
+		return request
+
+	def get_data(self, request):
+		return frappe._dict(
+			json.loads(frappe.db.get_value("Integration Request", request.name, "data"))
+		)
+
+	def test_partial_refunds(self):
+		request = self.make_payment()
+
+		refund.refund_payment(request.name, 60)
+		self.assertRaises(frappe.ValidationError, refund.refund_payment, request.name, 50)
+
+		# what is left of the payment
+		refund.refund_payment(request.name)
+		data = self.get_data(request)
+		self.assertEqual(data.refunded_amount, 100)
+		self.assertEqual([row["amount"] for row in data.refunds], [60, 40])
+
+		self.assertRaises(frappe.ValidationError, refund.refund_payment, request.name)
+		# one idempotency key per refund of the payment
+		self.assertEqual(self.refunds, [f"{request.name}-refund-0", f"{request.name}-refund-1"])
+
+	def test_only_completed_payments_are_refunded(self):
+		request = self.make_payment()
+		request.db_set("status", "Failed")
+
+		self.assertRaises(frappe.ValidationError, refund.refund_payment, request.name)
+		self.assertEqual(self.refunds, [])
+
+	def test_recorded_refund_is_not_counted_again(self):
+		request = self.make_payment()
+		refund.refund_payment(request.name, 30)
+
+		# e.g. the webhook of the refund, along with one made at the gateway
+		refund.record_refunds(
+			{
+				request.name: [
+					{"refund_id": "re_1", "refunded_amount": 30},
+					{"refund_id": "re_dashboard", "refunded_amount": 20},
+				]
+			}
+		)
+		self.assertEqual(self.get_data(request).refunded_amount, 50)
+
+		# gateways only reporting the refunded total
+		refund.record_refunds({request.name: {"total_refunded": 50}})
+		refund.record_refunds({request.name: {"total_refunded": 70}})
+		data = self.get_data(request)
+		self.assertEqual(data.refunded_amount, 70)
+		self.assertEqual(len(data.refunds), 3)
+
+	def test_duplicate_payments_in_operation(self):
+		request = self.make_payment()
+
+		self.assertRaises(
+			frappe.ValidationError,
+			create_refund_operation,
+			[request.name, {"integration_request": request.name, "amount": 10}],
+		)
+		self.assertFalse(
+			frappe.db.exists("Refund Operation Item", {"integration_request": request.name})
+		)
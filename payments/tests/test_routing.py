@@ -0,0 +1,96 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+from payments.utils import routing, utils
+from payments.utils.circuit_breaker import CLOSED, HALF_OPEN, OPEN
+
+GATEWAYS = ["Razorpay", "Stripe-Acme", "Stripe-Other", "Custom"]
+
+
+class TestRouting(unittest.TestCase):
+	def setUp(self):
+		self.states = {}
+		self.latencies = {}
+
+		for target, value in (
+			("get_payment_gateways", lambda: GATEWAYS),
+			("get_circuit_state", lambda name: self.states.get(name, CLOSED)),
+			(
+				"get_circuit_stats",
+				lambda name: frappe._dict(latency=self.latencies.get(name, 0.0)),
+			),
+		):
+			patcher = patch.object(routing, target, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		patcher = patch.dict(
+			frappe.conf,
+			{"payments_routing_rules": None, "payments_alternate_gateways": None},
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_can_take_payment(self):
+		self.assertTrue(routing.can_take_payment("Stripe-Acme", "USD", 0.5))
+		self.assertFalse(routing.can_take_payment("Stripe-Acme", "USD", 0.4))
+		self.assertFalse(routing.can_take_payment("Razorpay", "USD", 100))
+		# gateways of other apps are not restricted by currency
+		self.assertTrue(routing.can_take_payment("Custom", "EUR", 100))
+
+	def test_routing_rule_matching(self):
+		frappe.conf.payments_routing_rules = [
+			{"currency": "INR", "max_amount": 1000, "gateways": ["Razorpay"]},
+			{"currency": "INR", "gateways": ["Stripe-Acme"]},
+			{"min_amount": 100, "gateways": ["Custom"]},
+		]
+
+		self.assertEqual(routing.get_routing_rule("INR", 500)["gateways"], ["Razorpay"])
+		self.assertEqual(routing.get_routing_rule("INR", 5000)["gateways"], ["Stripe-Acme"])
+		self.assertEqual(routing.get_routing_rule("USD", 500)["gateways"], ["Custom"])
+		self.assertIsNone(routing.get_routing_rule("USD", 50))
+
+	def test_payment_stays_with_healthy_gateway(self):
+		self.latencies = {"Stripe-Acme": 2.0, "Stripe-Other": 0.1}
+		frappe.conf.payments_alternate_gateways = {"Stripe-Acme": ["Stripe-Other"]}
+
+		self.assertEqual(routing.route_payment("USD", 10, "Stripe-Acme"), "Stripe-Acme")
+
+	def test_payment_moves_to_alternate_of_site_config(self):
+		frappe.conf.payments_alternate_gateways = {"Stripe-Acme": ["Stripe-Other"]}
+
+		self.states = {"Stripe-Acme": OPEN}
+		self.assertEqual(routing.route_payment("USD", 10, "Stripe-Acme"), "Stripe-Other")
+
+		# the alternate can not take it either, so the payment stays and its gateway reports why
+		self.assertEqual(routing.route_payment("JPY", 10, "Stripe-Acme"), "Stripe-Acme")
+
+	def test_healthy_gateways_before_probing(self):
+		frappe.conf.payments_routing_rules = [{"gateways": ["Stripe-Acme", "Stripe-Other"]}]
+		self.states = {"Stripe-Acme": HALF_OPEN}
+		self.latencies = {"Stripe-Acme": 0.1, "Stripe-Other": 2.0}
+
+		self.assertEqual(routing.route_payment("USD", 10), "Stripe-Other")
+
+		self.states = {}
+		self.assertEqual(routing.route_payment("USD", 10), "Stripe-Acme")
+
+	def test_no_gateway_available(self):
+		self.states = {name: OPEN for name in GATEWAYS}
+		self.assertRaises(frappe.ValidationError, routing.route_payment, "USD", 10)
+
+	def test_checkout_uses_routed_account(self):
+		with patch("payments.utils.utils.get_payment_gateway_controller") as get_controller:
+			utils.get_payment_details_controller(
+				{"payment_gateway": "Stripe-Other", "reference_doctype": "Payment Request"},
+				"Stripe",
+			)
+			get_controller.assert_called_once_with("Stripe-Other")
+
+			get_controller.reset_mock()
+			utils.get_payment_details_controller({}, "Stripe")
+			get_controller.assert_called_once_with("Stripe")
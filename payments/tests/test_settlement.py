@@ -0,0 +1,127 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import csv
+import os
+import tempfile
+
+import frappe
+from frappe.integrations.utils import create_request_log
+from frappe.tests.utils import FrappeTestCase
+
+from payments.payments.doctype.integration_request_archive.integration_request_archive import (
+	ARCHIVED_FIELDS,
+	archive_batch,
+)
+from payments.utils.settlement import (
+	SETTLEMENT_LAYOUTS,
+	import_settlement_file,
+	parse_settlement_row,
+)
+
+
+class TestSettlement(FrappeTestCase):
+	def write_report(self, columns, rows):
+		fd, file_path = tempfile.mkstemp(suffix=".csv")
+		os.close(fd)
+		self.addCleanup(os.remove, file_path)
+
+		with open(file_path, "w", newline="", encoding="utf-8") as f:
+			writer = csv.writer(f)
+			writer.writerow(columns)
+			writer.writerows(rows)
+
+		return file_path
+
+	def make_payment(self, amount, currency="INR", **data):
+		payment_id = f"pay_{frappe.generate_hash(length=10)}"
+		request = create_request_log(
+			{"amount": amount, "currency": currency, **data}, service_name="Razorpay"
+		)
+		request.db_set({"status": "Completed", "gateway_payment_id": payment_id})
+		return request, payment_id
+
+	def test_parse_rows(self):
+		razorpay = SETTLEMENT_LAYOUTS["Razorpay"]
+		row = parse_settlement_row(
+			{"entity_id": " pay_1 ", "amount": "1,050", "currency": "inr"}, razorpay
+		)
+		self.assertEqual(
+			row, {"payment_id": "pay_1", "amount": 10.5, "minor_amount": 1050, "currency": "INR"}
+		)
+
+		# zero decimal currencies have no minor unit
+		row = parse_settlement_row(
+			{"entity_id": "pay_2", "amount": "500", "currency": "JPY"}, razorpay
+		)
+		self.assertEqual(row.amount, 500)
+
+		row = parse_settlement_row(
+			{"Transaction ID": "TX1", "Gross": "1,234.50", "Currency": "USD"},
+			SETTLEMENT_LAYOUTS["PayPal"],
+		)
+		self.assertEqual(row.amount, 1234.5)
+		self.assertEqual(row.minor_amount, 123450)
+
+	def test_missing_columns(self):
+		file_path = self.write_report(["entity_id", "amount"], [["pay_1", "100"]])
+		self.assertRaises(frappe.ValidationError, import_settlement_file, file_path, "Razorpay")
+
+	def test_import_settlement_file(self):
+		settled, settled_id = self.make_payment(100)
+		mismatched, mismatched_id = self.make_payment(200)
+
+		file_path = self.write_report(
+			["entity_id", "amount", "currency", "type"],
+			[
+				[settled_id, "10000", "INR", "payment"],
+				[mismatched_id, "19000", "INR", "payment"],
+				["pay_unknown", "500", "INR", "payment"],
+				[settled_id, "10000", "INR", "refund"],
+			],
+		)
+
+		summary = import_settlement_file(file_path, "Razorpay", batch_size=2)
+
+		self.assertEqual(summary.rows, 3)
+		self.assertEqual((summary.settled, summary.mismatched, summary.unmatched), (1, 1, 1))
+		self.assertEqual(summary.unmatched_ids, ["pay_unknown"])
+
+		settled.reload()
+		self.assertEqual(settled.settlement_status, "Settled")
+		self.assertEqual(settled.settled_amount, 100)
+
+		mismatched.reload()
+		self.assertEqual(mismatched.settlement_status, "Mismatched")
+		self.assertEqual(mismatched.settled_amount, 190)
+
+	def test_order_flow_and_archived_payments(self):
+		# `create_order` stores the amount in paise
+		order, order_payment_id = self.make_payment(10050, razorpay_order_id="order_1")
+
+		archived, archived_payment_id = self.make_payment(0.29)
+		archive_batch(
+			frappe.get_all(
+				"Integration Request", filters={"name": archived.name}, fields=ARCHIVED_FIELDS
+			)
+		)
+
+		file_path = self.write_report(
+			["entity_id", "amount", "currency", "type"],
+			[
+				[order_payment_id, "10050", "INR", "payment"],
+				[archived_payment_id, "29", "INR", "payment"],
+			],
+		)
+
+		summary = import_settlement_file(file_path, "Razorpay")
+
+		self.assertEqual((summary.settled, summary.mismatched, summary.unmatched), (2, 0, 0))
+		self.assertEqual(
+			frappe.db.get_value("Integration Request", order.name, "settled_amount"), 100.5
+		)
+		self.assertEqual(
+			frappe.db.get_value(
+				"Integration Request Archive", archived.name, "settlement_status"
+			),
+			"Settled",
+		)
@@ -0,0 +1,105 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from payments.utils import status_cache
+
+
+def get_status(payment):
+	return {"authorized": "Authorized", "captured": "Completed"}.get(payment["status"])
+
+
+class TestStatusCache(FrappeTestCase):
+	def setUp(self):
+		self.payment_id = f"pay_{frappe.generate_hash(length=10)}"
+		self.cache = status_cache.get_payment_status_cache("Razorpay", self.payment_id)
+		self.fetches = 0
+		self.addCleanup(
+			frappe.cache().delete, self.cache.key, self.cache.version_key, self.cache.lock_key
+		)
+
+	def fetch(self, status="authorized"):
+		self.fetches += 1
+		return {"id": self.payment_id, "status": status}
+
+	def get_request(self, status):
+		return frappe._dict(
+			integration_request_service="Razorpay",
+			gateway_payment_id=self.payment_id,
+			status=status,
+		)
+
+	def test_concurrent_lookups_share_one_fetch(self):
+		started = threading.Event()
+		release = threading.Event()
+
+		def fetch():
+			started.set()
+			release.wait(5)
+			return self.fetch()
+
+		with ThreadPoolExecutor(max_workers=5) as executor:
+			leader = executor.submit(self.cache.get, fetch)
+			started.wait(5)
+			followers = [executor.submit(self.cache.get, fetch) for _i in range(4)]
+			release.set()
+
+			results = [future.result() for future in [leader, *followers]]
+
+		self.assertEqual(self.fetches, 1)
+		self.assertTrue(all(result == results[0] for result in results))
+
+		# later lookups are served from redis
+		self.assertEqual(self.cache.get(self.fetch), results[0])
+		self.assertEqual(self.fetches, 1)
+
+	def test_waits_for_other_worker(self):
+		frappe.cache().set(self.cache.lock_key, "other-worker", ex=status_cache.LOCK_TIMEOUT)
+
+		def other_worker():
+			# stores its result and releases its lock like `fetch_once`
+			self.cache.cache.set(
+				self.cache.key,
+				frappe.as_json({"version": 0, "payment": {"status": "captured"}, "status": None}),
+			)
+			self.cache.cache.delete(self.cache.lock_key)
+
+		timer = threading.Timer(0.3, other_worker)
+		timer.start()
+		self.addCleanup(timer.cancel)
+
+		self.assertEqual(self.cache.get(self.fetch), {"status": "captured"})
+		self.assertEqual(self.fetches, 0)
+
+	def test_lock_of_other_worker_is_kept(self):
+		def fetch():
+			# the lock expired during the call and another worker took it over
+			frappe.cache().set(self.cache.lock_key, "other-worker")
+			return self.fetch()
+
+		self.cache.get(fetch)
+		self.assertEqual(frappe.safe_decode(frappe.cache().get(self.cache.lock_key)), "other-worker")
+
+	def test_status_change_of_cached_payment(self):
+		self.cache.get(self.fetch, get_status)
+
+		# the request changed to what the cached payment says, e.g. on authorize
+		status_cache.clear_payment_status(self.get_request("Authorized"))
+		self.cache.get(self.fetch, get_status)
+		self.assertEqual(self.fetches, 1)
+
+		status_cache.clear_payment_status(self.get_request("Completed"))
+		self.assertEqual(self.cache.get(lambda: self.fetch("captured"))["status"], "captured")
+		self.assertEqual(self.fetches, 2)
+
+	def test_change_during_fetch_is_not_cached(self):
+		def fetch():
+			status_cache.invalidate_payment_status("Razorpay", self.payment_id)
+			return self.fetch()
+
+		self.cache.get(fetch)
+		self.assertIsNone(self.cache.get_cached()[1])
@@ -0,0 +1,108 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import time
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from payments.utils import velocity
+
+
+class TestVelocity(FrappeTestCase):
+	def setUp(self):
+		self.endpoint = f"test.endpoint_{frappe.generate_hash(length=6)}"
+		velocity._blocked.clear()
+		self.addCleanup(velocity._blocked.clear)
+
+		patcher = patch.dict(
+			frappe.conf,
+			{"payments_velocity_limits": {"ip": [3, 60], "payer_email": [2, 1], "reference": None}},
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def attempt(self, **keys):
+		velocity.check_velocity(self.endpoint, keys)
+
+	def get_attempts(self, key_type, value):
+		key = frappe.cache().make_key(f"payments:velocity:{self.endpoint}:{key_type}:{value}")
+		return frappe.cache().zcard(key)
+
+	def test_limit_per_key(self):
+		for _i in range(3):
+			self.attempt(ip="10.0.0.1")
+
+		self.assertRaises(frappe.TooManyRequestsError, self.attempt, ip="10.0.0.1")
+		# refused attempts are not counted
+		self.assertEqual(self.get_attempts("ip", "10.0.0.1"), 3)
+
+		# other clients are not affected
+		self.attempt(ip="10.0.0.2")
+
+	def test_refused_without_redis_once_blocked(self):
+		for _i in range(3):
+			self.attempt(ip="10.0.0.1")
+		self.assertRaises(frappe.TooManyRequestsError, self.attempt, ip="10.0.0.1")
+
+		make_key = frappe.cache().make_key
+		with patch.object(velocity.frappe, "cache") as cache:
+			cache.return_value.make_key = make_key
+			self.assertRaises(frappe.TooManyRequestsError, self.attempt, ip="10.0.0.1")
+			cache.return_value.pipeline.assert_not_called()
+
+	def test_sliding_window(self):
+		self.attempt(payer_email="buyer@example.com")
+		self.attempt(payer_email="buyer@example.com")
+		self.assertRaises(
+			frappe.TooManyRequestsError, self.attempt, payer_email="buyer@example.com"
+		)
+
+		# the window of payer emails is a second long
+		time.sleep(1.1)
+		self.attempt(payer_email="buyer@example.com")
+
+	def test_refused_attempt_counts_for_no_key(self):
+		self.attempt(ip="10.0.0.1", payer_email="buyer@example.com")
+		self.attempt(ip="10.0.0.1", payer_email="buyer@example.com")
+		self.assertRaises(
+			frappe.TooManyRequestsError,
+			self.attempt,
+			ip="10.0.0.1",
+			payer_email="buyer@example.com",
+		)
+
+		self.assertEqual(self.get_attempts("ip", "10.0.0.1"), 2)
+
+	def test_unlimited_keys(self):
+		for _i in range(5):
+			self.attempt(reference="Sales Invoice:SINV-0001")
+
+		self.assertEqual(self.get_attempts("reference", "Sales Invoice:SINV-0001"), 0)
+
+	def test_decorator_keys(self):
+		calls = []
+
+		@velocity.velocity_limit(reference=("doctype", "docname"), payer_email="email")
+		def endpoint(doctype=None, docname=None, email=None):
+			calls.append((doctype, docname, email))
+
+		with patch.object(velocity, "check_velocity") as check_velocity:
+			frappe.local.request_ip = "10.0.0.1"
+			self.addCleanup(setattr, frappe.local, "request_ip", None)
+
+			endpoint(doctype="Sales Invoice", docname="SINV-0001", email="buyer@example.com")
+			endpoint(doctype="Sales Invoice")
+
+		self.assertEqual(len(calls), 2)
+		self.assertEqual(
+			[call.args[1] for call in check_velocity.call_args_list],
+			[
+				{
+					"ip": "10.0.0.1",
+					"payer_email": "buyer@example.com",
+					"reference": "Sales Invoice:SINV-0001",
+				},
+				{"ip": "10.0.0.1", "payer_email": None},
+			],
+		)
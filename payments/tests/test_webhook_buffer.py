@@ -0,0 +1,103 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from payments.utils import webhooks
+
+
+class TestWebhookBuffer(FrappeTestCase):
+	def setUp(self):
+		self.clear_buffer()
+		self.addCleanup(self.clear_buffer)
+
+		for patcher in (
+			patch.dict(
+				frappe.conf,
+				{"payments_webhook_flush_interval": 1, "payments_webhook_buffer_size": 3},
+			),
+			patch("frappe.enqueue"),
+		):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def clear_buffer(self):
+		frappe.cache().delete_value([webhooks.BUFFER_KEY, webhooks.PROCESSING_KEY])
+		webhooks.idempotency.release("Webhook Buffer", "scheduled")
+
+	def get_buffered(self, key=webhooks.BUFFER_KEY):
+		return [json.loads(entry) for entry in frappe.cache().lrange(key, 0, -1)]
+
+	def test_buffer_notification(self):
+		webhooks.buffer_notification("Razorpay", {"event": "a", "cmd": "ignored"}, headers={})
+		webhooks.buffer_notification("Razorpay", {"event": "b"}, headers={})
+
+		entries = self.get_buffered()
+		self.assertEqual([entry["data"]["event"] for entry in entries], ["b", "a"])
+		self.assertEqual(entries[1]["data"], {"event": "a", "payment_gateway": "Razorpay"})
+
+		# a single flush is scheduled however many notifications arrive
+		flushes = [
+			call
+			for call in frappe.enqueue.call_args_list
+			if call.args == ("payments.utils.webhooks.flush_notification_buffer",)
+		]
+		self.assertEqual(len(flushes), 1)
+
+	def test_full_buffer(self):
+		for event in range(3):
+			webhooks.buffer_notification("PayPal", {"event": event}, headers={})
+
+		self.assertRaises(
+			frappe.TooManyRequestsError,
+			webhooks.buffer_notification,
+			"PayPal",
+			{"event": 3},
+			headers={},
+		)
+		self.assertEqual(len(self.get_buffered()), 3)
+
+	def test_flush_notification_buffer(self):
+		for event in ("a", "b"):
+			webhooks.buffer_notification("Razorpay", {"event": event}, headers={"X-Test": "1"})
+		names = [entry["name"] for entry in self.get_buffered()]
+
+		webhooks.flush_notification_buffer()
+
+		self.assertEqual(self.get_buffered(), [])
+		self.assertEqual(self.get_buffered(webhooks.PROCESSING_KEY), [])
+		for name in names:
+			request = frappe.get_doc("Integration Request", name)
+			self.assertEqual(request.request_description, webhooks.WEBHOOK_RECEIVED)
+			self.assertEqual(request.status, "Queued")
+			self.assertEqual(json.loads(request.request_headers), {"X-Test": "1"})
+
+		frappe.enqueue.assert_any_call(
+			"payments.utils.webhooks.process_notifications",
+			queue="long",
+			timeout=600,
+			docnames=list(reversed(names)),
+		)
+
+	def test_flush_resumes_interrupted_flush(self):
+		webhooks.buffer_notification("Razorpay", {"event": "a"}, headers={})
+		webhooks.buffer_notification("Razorpay", {"event": "b"}, headers={})
+
+		# a flush that died after moving "a" to the processing list, and after inserting it
+		entries = webhooks.collect_buffered_notifications()
+		webhooks.insert_notifications([json.loads(entry) for entry in entries[:1]])
+		webhooks.buffer_notification("Razorpay", {"event": "c"}, headers={})
+
+		webhooks.flush_notification_buffer()
+
+		requests = frappe.get_all(
+			"Integration Request",
+			filters={"name": ("in", [json.loads(entry)["name"] for entry in entries])},
+			pluck="name",
+		)
+		self.assertEqual(len(requests), 2)
+		self.assertEqual(self.get_buffered(), [])
+		self.assertEqual(self.get_buffered(webhooks.PROCESSING_KEY), [])
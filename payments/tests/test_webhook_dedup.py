@@ -0,0 +1,57 @@
+# Copyright (c) 2023, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from payments.payment_gateways.doctype.razorpay_settings import razorpay_settings
+from payments.utils import idempotency, webhooks
+
+
+class TestWebhookDeduplication(FrappeTestCase):
+	def setUp(self):
+		self.event_id = frappe.generate_hash(length=10)
+		self.data = {"event": "subscription.charged", "id": self.event_id}
+
+	def claim(self, gateway, data, event_id=None):
+		key = webhooks.claim_notification(gateway, data, event_id)
+		if key:
+			self.addCleanup(webhooks.release_notification, gateway, key)
+		return key
+
+	def test_notification_is_claimed_once(self):
+		self.assertTrue(self.claim("Razorpay", self.data))
+		# the form dict of a redelivery may carry another `cmd`
+		self.assertIsNone(self.claim("Razorpay", dict(self.data, cmd="ignored")))
+
+		# claims are kept per gateway
+		self.assertTrue(self.claim("PayPal", self.data))
+
+		# the event id identifies a notification whatever its payload
+		self.assertTrue(self.claim("Stripe-Acme", {}, event_id=self.event_id))
+		self.assertIsNone(self.claim("Stripe-Acme", {"other": 1}, event_id=self.event_id))
+
+	def test_released_notification_is_claimed_again(self):
+		key = self.claim("Razorpay", self.data)
+		webhooks.release_notification("Razorpay", key)
+
+		self.assertEqual(self.claim("Razorpay", self.data), key)
+		self.assertEqual(
+			key, idempotency.get_payload_hash(self.data), "payloads are claimed by their hash"
+		)
+
+	@patch("payments.utils.webhooks.ingest_notification")
+	@patch("frappe.get_request_header", return_value=None)
+	def test_redelivered_webhook_is_ingested_once(self, get_request_header, ingest_notification):
+		self.addCleanup(
+			webhooks.release_notification, "Razorpay", idempotency.get_payload_hash(self.data)
+		)
+
+		with patch.dict(
+			frappe.conf, {"payments_async_webhooks": 1, "payments_buffered_webhooks": 0}
+		), patch.object(frappe.local, "form_dict", frappe._dict(self.data), create=True):
+			razorpay_settings.razorpay_subscription_callback()
+			razorpay_settings.razorpay_subscription_callback()
+
+		ingest_notification.assert_called_once()
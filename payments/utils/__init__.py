@@ -2,6 +2,14 @@ from payments.utils.utils import (
 	before_install,
 	create_payment_gateway,
 	delete_custom_fields,
+	get_checkout_session,
+	get_integration_request,
+	get_integration_request_controller,
+	get_payment_details_controller,
 	get_payment_gateway_controller,
+	get_request_data,
 	make_custom_fields,
+	set_integration_request_status,
 )
+from payments.utils.payment_links import create_payment_links, get_payment_urls
+from payments.utils.routing import route_payment
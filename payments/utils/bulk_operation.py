@@ -0,0 +1,249 @@
+"""
+Bulk operations over thousands of items, like Refund Operation and Subscription
+Operation.
+
+An operation is a document with an `items` child table whose rows have a `status`,
+an `error` and a `processed_on` field. Its items are inserted in bulk with
+`insert_items`, as Pending, and `run_operation` works through them in batches of
+`batch_size_key` (site config, default 200) on the long queue. Each batch goes to the
+`process_batch` of the operation's controller, which calls the gateway for every item
+and returns their results, and the results are written with one update.
+
+Operations whose gateway calls must not be repeated set `interrupted_error`: their
+batches are marked Processing first, and items still Processing when a run starts
+are marked Failed with that error for review instead of being called again.
+
+Operations are resumed from the form, which retries failed items and continues
+pending ones, and `resume_operations` queues interrupted operations again every hour.
+"""
+
+import traceback
+
+import frappe
+from frappe import _
+from frappe.model.base_document import get_controller
+from frappe.model.document import Document
+from frappe.utils import cint, now_datetime
+
+OPERATION_DOCTYPES = ("Refund Operation", "Subscription Operation")
+DEFAULT_BATCH_SIZE = 200
+
+
+class BulkOperation(Document):
+	# child doctype of the `items` table
+	item_doctype = None
+	# item fields passed to `process_batch` along with the name
+	item_fields = ()
+	# operation fields passed to `process_batch` along with the name
+	operation_fields = ()
+	# site config of the batch size
+	batch_size_key = None
+	# `{item status: operation field}` of the counts shown on the operation
+	progress_fields = {}
+	# error of items interrupted during a gateway call, `None` to call them again
+	interrupted_error = None
+
+	def before_insert(self):
+		self.status = "Queued"
+
+	def after_insert(self):
+		enqueue_operation(self.doctype, self.name)
+
+	@frappe.whitelist()
+	def resume(self):
+		"""Retry failed items and continue with pending ones"""
+		self.check_permission("write")
+
+		frappe.db.set_value(
+			self.item_doctype,
+			{"parent": self.name, "parenttype": self.doctype, "status": "Failed"},
+			{"status": "Pending", "error": None},
+			update_modified=False,
+		)
+		self.db_set("status", "Queued")
+		enqueue_operation(self.doctype, self.name)
+
+	@staticmethod
+	def process_batch(operation, items):
+		"""Run the operation for a batch of items, returns `{item name: get_item_result()}`"""
+		raise NotImplementedError
+
+
+def insert_items(doc, fields, values):
+	"""Insert the items of `doc` in bulk, an operation can cover thousands of them.
+	`values` are tuples of `fields`, each becomes a Pending item"""
+	now = now_datetime()
+	frappe.db.bulk_insert(
+		doc.item_doctype,
+		fields=[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"parent",
+			"parenttype",
+			"parentfield",
+			"idx",
+			*fields,
+			"status",
+		],
+		values=[
+			(
+				frappe.generate_hash(length=10),
+				now,
+				now,
+				frappe.session.user,
+				frappe.session.user,
+				doc.name,
+				doc.doctype,
+				"items",
+				idx,
+				*row,
+				"Pending",
+			)
+			for idx, row in enumerate(values, 1)
+		],
+	)
+
+
+def enqueue_operation(doctype, operation):
+	frappe.enqueue(
+		"payments.utils.bulk_operation.run_operation",
+		queue="long",
+		timeout=3600,
+		enqueue_after_commit=True,
+		doctype=doctype,
+		operation=operation,
+	)
+
+
+def run_operation(doctype, operation):
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key(f"payments:bulk_operation:{doctype}:{operation}"), timeout=3600)
+	if not lock.acquire(blocking=False):
+		# already running
+		return
+
+	try:
+		controller = get_controller(doctype)
+		item_filters = {"parent": operation, "parenttype": doctype}
+
+		if controller.interrupted_error:
+			# calls of a run that died midway may or may not have reached the gateway
+			frappe.db.set_value(
+				controller.item_doctype,
+				dict(item_filters, status="Processing"),
+				{"status": "Failed", "error": _(controller.interrupted_error)},
+				update_modified=False,
+			)
+
+		values = frappe._dict(name=operation)
+		if controller.operation_fields:
+			values.update(
+				frappe.db.get_value(doctype, operation, controller.operation_fields, as_dict=True)
+			)
+
+		frappe.db.set_value(doctype, operation, "status", "In Progress")
+		frappe.db.commit()
+
+		batch_size = cint(frappe.conf.get(controller.batch_size_key)) or DEFAULT_BATCH_SIZE
+		while True:
+			items = frappe.get_all(
+				controller.item_doctype,
+				filters=dict(item_filters, status="Pending"),
+				fields=["name", *controller.item_fields],
+				order_by="idx asc",
+				limit=batch_size,
+			)
+			if not items:
+				break
+
+			process_batch(doctype, values, items)
+			update_operation_progress(doctype, operation)
+
+			if len(items) < batch_size:
+				break
+
+		counts = update_operation_progress(doctype, operation)
+		if not counts.get("Pending"):
+			frappe.db.set_value(
+				doctype,
+				operation,
+				"status",
+				"Partially Failed" if counts.get("Failed") else "Completed",
+			)
+			frappe.db.commit()
+	finally:
+		lock.release()
+
+
+def process_batch(doctype, operation, items):
+	controller = get_controller(doctype)
+	if controller.interrupted_error:
+		frappe.db.set_value(
+			controller.item_doctype,
+			{"name": ("in", [item.name for item in items])},
+			"status",
+			"Processing",
+			update_modified=False,
+		)
+		frappe.db.commit()
+
+	updates = controller.process_batch(operation, items)
+	if updates:
+		frappe.db.bulk_update(controller.item_doctype, updates, update_modified=False)
+
+	frappe.db.commit()
+
+
+def get_item_result(status, error=None, **values):
+	return {"status": status, "error": error, "processed_on": now_datetime(), **values}
+
+
+def get_failed_result(exception):
+	"""Return the result of an item whose gateway call raised `exception`"""
+	return get_item_result(
+		"Failed",
+		error="".join(
+			traceback.format_exception(type(exception), exception, exception.__traceback__)
+		),
+	)
+
+
+def update_operation_progress(doctype, operation):
+	"""Update the item counts of an operation, returns the count of items by status"""
+	controller = get_controller(doctype)
+	counts = dict(
+		frappe.get_all(
+			controller.item_doctype,
+			filters={"parent": operation, "parenttype": doctype},
+			fields=["status", "count(name) as count"],
+			group_by="status",
+			as_list=True,
+		)
+	)
+
+	frappe.db.set_value(
+		doctype,
+		operation,
+		{
+			fieldname: counts.get(status, 0)
+			for status, fieldname in controller.progress_fields.items()
+		},
+	)
+	frappe.db.commit()
+
+	return counts
+
+
+def resume_operations():
+	"""Queue operations interrupted by a worker restart again, operations that are still
+	running ignore the extra run"""
+	for doctype in OPERATION_DOCTYPES:
+		for operation in frappe.get_all(
+			doctype,
+			filters={"status": ("in", ("Queued", "In Progress"))},
+			pluck="name",
+		):
+			enqueue_operation(doctype, operation)
@@ -0,0 +1,128 @@
+"""
+Bulkheads and a deadline budget for gateway calls made while serving a web request.
+
+Checkout pages and `make_payment` call gateways from web workers. Without limits a
+slow gateway holds every worker it gets, and checkouts on healthy gateways starve
+with it. Such calls are made inside `gateway_call(gateway)`, which:
+
+- admits at most `payments_gateway_concurrency[gateway]` (site config, default 10)
+  calls per gateway at a time across all web workers, and fails at once with
+  `GatewayUnavailableError` when the gateway is at its limit
+- gives every web request a budget of `payments_request_deadline` seconds (site
+  config, default 20) for all of its gateway calls, and caps the timeout of each
+  call to what is left of it
+
+Calls through `payments.utils.http` respect the deadline on their own. Gateway SDKs
+have to be given `http.get_timeout()` as their timeout. Outside web requests, e.g.
+in background jobs, calls are paced by the rate limiter of the gateway account (see
+`payments.utils.rate_limit`) instead. The circuit breaker of the gateway (see
+`payments.utils.circuit_breaker`) applies to both.
+"""
+
+import math
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe import _
+
+from payments.exceptions import GatewayUnavailableError
+from payments.utils import circuit_breaker, http
+from payments.utils.rate_limit import get_gateway_limiter
+
+DEFAULT_DEADLINE = 20
+DEFAULT_CONCURRENCY = 10
+
+
+def get_gateway_concurrency(gateway):
+	return (frappe.conf.payments_gateway_concurrency or {}).get(gateway) or DEFAULT_CONCURRENCY
+
+
+def get_request_budget():
+	return frappe.conf.payments_request_deadline or DEFAULT_DEADLINE
+
+
+def get_deadline():
+	"""Return the deadline of the current request, started by its first gateway call"""
+	if not getattr(frappe.local, "payments_deadline", None):
+		frappe.local.payments_deadline = time.monotonic() + get_request_budget()
+
+	return frappe.local.payments_deadline
+
+
+@contextmanager
+def gateway_call(gateway, account=None):
+	"""Guard a call to `gateway`, `account` is the account of gateways that can have
+	several (the gateway name of Stripe and Braintree Settings)"""
+	name = f"{gateway}-{account}" if account else gateway
+	with circuit_breaker.guard(name):
+		if getattr(frappe.local, "request", None):
+			with web_request_call(gateway):
+				yield
+		else:
+			with background_call(name):
+				yield
+
+
+@contextmanager
+def web_request_call(gateway):
+	deadline = get_deadline()
+	remaining = deadline - time.monotonic()
+	if remaining <= 0:
+		frappe.throw(
+			_("{0} is taking too long to respond, please try again later").format(gateway),
+			GatewayUnavailableError,
+		)
+
+	lease = acquire_slot(gateway, remaining)
+	previous = http.set_deadline(deadline)
+	try:
+		yield
+	finally:
+		http.set_deadline(previous)
+		release_slot(gateway, lease)
+
+
+@contextmanager
+def background_call(name):
+	limiter = get_gateway_limiter(name)
+	limiter.acquire()
+
+	previous = http.set_rate_limiter(limiter)
+	try:
+		yield
+	finally:
+		http.set_rate_limiter(previous)
+
+
+def get_bulkhead_key(gateway):
+	return frappe.cache().make_key(f"payments:bulkhead:{gateway}")
+
+
+def acquire_slot(gateway, ttl):
+	"""Take one of the slots of `gateway` for at most `ttl` seconds. Slots are kept in a
+	sorted set scored by their expiry, so slots of killed workers free themselves."""
+	key = get_bulkhead_key(gateway)
+	lease = frappe.generate_hash(length=10)
+	now = time.time()
+
+	pipeline = frappe.cache().pipeline()
+	pipeline.zremrangebyscore(key, 0, now)
+	pipeline.zadd(key, {lease: now + ttl})
+	pipeline.zcard(key)
+	# no slot outlives a request budget
+	pipeline.expire(key, math.ceil(get_request_budget()))
+	in_use = pipeline.execute()[2]
+
+	if in_use > get_gateway_concurrency(gateway):
+		frappe.cache().zrem(key, lease)
+		frappe.throw(
+			_("{0} is busy right now, please try again in a moment").format(gateway),
+			GatewayUnavailableError,
+		)
+
+	return lease
+
+
+def release_slot(gateway, lease):
+	frappe.cache().zrem(get_bulkhead_key(gateway), lease)
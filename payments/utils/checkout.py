@@ -0,0 +1,148 @@
+"""
+Asynchronous payment confirmation for the checkout pages.
+
+With `payments_async_checkout` enabled in site config, the `make_payment` endpoints
+of the Razorpay, Stripe and Braintree checkout pages do not charge the buyer inside
+the request. They queue the charge, `on_payment_authorized` and the commit as a job
+and return `{"checkout_job": ...}` at once. The page then polls `get_payment_status`
+until the job has finished, which returns what `make_payment` would have returned.
+
+Job results are kept in redis for `payments_checkout_job_ttl` seconds (default one
+hour) and are only known by the job token, so the status endpoint never touches the
+database.
+
+Checkout pages also send an `idempotency_key`, generated once per page load. Once a
+call with a key (and checkout token) reached an outcome, i.e. the payment was queued
+or its Integration Request left Queued, its response is kept for
+`payments_checkout_idempotency_ttl` seconds (default 24 hours, the window Stripe keeps
+its own keys for), and double clicks or browser retries get that response back without
+the gateway being called again. Calls made while the first one is still running get a
+409, and calls that failed before reaching an outcome can be retried with the same
+key. Stripe also receives the key with the charge.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint, get_url
+
+from payments.exceptions import DuplicatePaymentError
+from payments.utils import idempotency
+
+DEFAULT_JOB_TTL = 60 * 60
+DEFAULT_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# statuses of the Integration Request of a checkout once its payment reached an outcome
+FINAL_STATUSES = ("Authorized", "Completed", "Failed", "Cancelled")
+
+QUEUED = "Queued"
+FINISHED = "Finished"
+FAILED = "Failed"
+
+
+def is_async_checkout_enabled():
+	return cint(frappe.conf.payments_async_checkout)
+
+
+def process_payment(method, kwargs, idempotency_key=None):
+	"""Confirm a checkout payment with `method(**kwargs)`, in the request or queued
+	depending on site config, at most once per `idempotency_key`"""
+	if not idempotency_key:
+		return dispatch_payment(method, **kwargs)
+
+	token = kwargs.get("token")
+	key = idempotency.get_payload_hash(
+		{"method": method, "token": token, "idempotency_key": idempotency_key}
+	)
+	cache_key = f"payments:checkout_response:{key}"
+	ttl = cint(frappe.conf.payments_checkout_idempotency_ttl) or DEFAULT_IDEMPOTENCY_TTL
+
+	response = frappe.cache().get_value(cache_key)
+	if response is not None:
+		return response
+
+	if not idempotency.claim("Checkout", key, ttl):
+		frappe.throw(
+			_("This payment is already being processed, please wait"), DuplicatePaymentError
+		)
+
+	try:
+		response = dispatch_payment(method, **kwargs)
+	except Exception:
+		idempotency.release("Checkout", key)
+		raise
+
+	if has_outcome(token, response):
+		frappe.cache().set_value(cache_key, response, expires_in_sec=ttl)
+	else:
+		# e.g. a server error before the gateway was reached, a retry may still succeed
+		idempotency.release("Checkout", key)
+
+	return response
+
+
+def has_outcome(token, response):
+	"""Whether the payment of checkout `token` was queued or reached a final status"""
+	if isinstance(response, dict) and response.get("checkout_job"):
+		return True
+
+	return bool(token) and (
+		frappe.db.get_value("Integration Request", token, "status") in FINAL_STATUSES
+	)
+
+
+def dispatch_payment(method, **kwargs):
+	if is_async_checkout_enabled():
+		return enqueue_payment(method, **kwargs)
+
+	return frappe.get_attr(method)(**kwargs)
+
+
+def get_job_cache_key(job):
+	return f"payments:checkout_job:{job}"
+
+
+def set_job_status(job, status, result=None):
+	ttl = cint(frappe.conf.payments_checkout_job_ttl) or DEFAULT_JOB_TTL
+	frappe.cache().set_value(
+		get_job_cache_key(job), {"status": status, "result": result}, expires_in_sec=ttl
+	)
+
+
+def enqueue_payment(method, **kwargs):
+	"""Queue `method(**kwargs)`, the synchronous confirmation of a checkout page, and
+	return the job token to poll `get_payment_status` with"""
+	job = frappe.generate_hash(length=20)
+	set_job_status(job, QUEUED)
+
+	frappe.enqueue(
+		"payments.utils.checkout.run_payment",
+		queue="short",
+		job=job,
+		method=method,
+		kwargs=kwargs,
+	)
+
+	return {"checkout_job": job}
+
+
+def run_payment(job, method, kwargs):
+	try:
+		result = frappe.get_attr(method)(**kwargs)
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(frappe.get_traceback(), "Checkout payment failed")
+		set_job_status(job, FAILED, {"redirect_to": get_url("payment-failed")})
+		return
+
+	set_job_status(job, FINISHED, result)
+
+
+@frappe.whitelist(allow_guest=True)
+def get_payment_status(checkout_job):
+	"""Return `{"status": ..., "result": ...}` of a queued payment, the result is set
+	once the status is Finished or Failed"""
+	status = frappe.cache().get_value(get_job_cache_key(checkout_job))
+	if not status:
+		frappe.throw(_("Payment not found"), frappe.DoesNotExistError)
+
+	return status
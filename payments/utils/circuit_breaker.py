@@ -0,0 +1,204 @@
+"""
+Circuit breakers for gateway calls, one per Payment Gateway (gateway and account).
+
+Calls made through `payments.utils.bulkhead.gateway_call` are counted in windows of
+`payments_circuit_window` seconds (site config, default 60). A call fails when the
+gateway can not be reached, times out or answers with a server error, and calls that
+take longer than `payments_circuit_slow_call` seconds (default 10) count as failures
+too. Declined cards and other errors of the request itself do not.
+
+Once at least `payments_circuit_min_calls` calls (default 10) were made in the
+current and the previous window and `payments_circuit_failure_rate` of them (default
+0.5) failed, the breaker opens: calls are refused at once with `CircuitOpenError` for
+`payments_circuit_open_for` seconds (default 30). After that a single call is let
+through as a probe. The breaker closes if the probe succeeds and opens again if not.
+
+The state and the call statistics (see `get_circuit_stats`) are kept in redis, so they
+are shared by web workers and background jobs. `payments.utils.routing` uses both to
+steer payments to healthy gateways.
+"""
+
+import time
+from contextlib import contextmanager
+
+import frappe
+import requests
+from frappe import _
+from frappe.utils import cint, flt
+
+from payments.exceptions import CircuitOpenError, GatewayUnavailableError
+
+CLOSED = "Closed"
+OPEN = "Open"
+HALF_OPEN = "Half Open"
+
+DEFAULT_WINDOW = 60
+DEFAULT_MIN_CALLS = 10
+DEFAULT_FAILURE_RATE = 0.5
+DEFAULT_SLOW_CALL = 10
+DEFAULT_OPEN_FOR = 30
+
+# exceptions of gateway SDKs that mean the gateway is unavailable, matched by name so
+# that no SDK has to be imported here
+SDK_FAILURES = (
+	"APIConnectionError",
+	"APIError",
+	"ServerError",
+	"ServiceUnavailableError",
+	"DownForMaintenanceError",
+	"TimeoutError",
+	"ReadTimeoutError",
+	"ConnectTimeoutError",
+)
+
+
+def get_key(name, suffix):
+	return frappe.cache().make_key(f"payments:circuit:{name}:{suffix}")
+
+
+def get_window():
+	return cint(frappe.conf.payments_circuit_window) or DEFAULT_WINDOW
+
+
+def get_circuit_state(name):
+	pipeline = frappe.cache().pipeline()
+	pipeline.exists(get_key(name, "open"))
+	pipeline.exists(get_key(name, "tripped"))
+	is_open, tripped = pipeline.execute()
+
+	if is_open:
+		return OPEN
+
+	return HALF_OPEN if tripped else CLOSED
+
+
+@frappe.whitelist(allow_guest=True)
+def get_circuit_states(payment_gateways):
+	"""Return the breaker state of each of `payment_gateways`"""
+	return {name: get_circuit_state(name) for name in frappe.parse_json(payment_gateways)}
+
+
+def get_circuit_stats(name):
+	"""Return the calls, failures and average latency (in seconds) of the current and
+	the previous window of breaker `name`"""
+	bucket = int(time.time() // get_window())
+
+	pipeline = frappe.cache().pipeline()
+	for key in (get_key(name, bucket), get_key(name, bucket - 1)):
+		pipeline.hmget(key, "calls", "failures", "latency")
+
+	calls = failures = latency = 0
+	for values in pipeline.execute():
+		calls += cint(values[0])
+		failures += cint(values[1])
+		latency += flt(values[2])
+
+	return frappe._dict(
+		calls=calls, failures=failures, latency=latency / calls if calls else 0.0
+	)
+
+
+@contextmanager
+def guard(name):
+	"""Run a gateway call under the breaker `name`"""
+	state = get_circuit_state(name)
+	probe = False
+
+	if state == OPEN:
+		raise_circuit_open(name)
+	elif state == HALF_OPEN:
+		# only one call probes the gateway, the others are refused until it is done
+		probe_ttl = cint(frappe.conf.payments_circuit_slow_call) or DEFAULT_SLOW_CALL
+		if not frappe.cache().set(get_key(name, "probe"), 1, nx=True, ex=probe_ttl * 3):
+			raise_circuit_open(name)
+
+		probe = True
+
+	started_at = time.monotonic()
+	try:
+		yield
+	except GatewayUnavailableError:
+		# refused before reaching the gateway, e.g. by its bulkhead
+		if probe:
+			frappe.cache().delete(get_key(name, "probe"))
+		raise
+	except Exception as e:
+		record_call(name, is_gateway_failure(e), time.monotonic() - started_at, probe)
+		raise
+
+	latency = time.monotonic() - started_at
+	slow_call = flt(frappe.conf.payments_circuit_slow_call) or DEFAULT_SLOW_CALL
+	record_call(name, latency > slow_call, latency, probe)
+
+
+def raise_circuit_open(name):
+	frappe.throw(
+		_("{0} is not responding right now, please try again later").format(name),
+		CircuitOpenError,
+	)
+
+
+def is_gateway_failure(exception):
+	if isinstance(exception, requests.exceptions.HTTPError):
+		response = exception.response
+		return response is None or response.status_code >= 500 or response.status_code == 429
+
+	if isinstance(exception, requests.exceptions.RequestException):
+		return True
+
+	return type(exception).__name__ in SDK_FAILURES
+
+
+def record_call(name, failed, latency, probe=False):
+	if probe:
+		if failed:
+			open_circuit(name)
+		else:
+			close_circuit(name)
+		return
+
+	window = get_window()
+	bucket = int(time.time() // window)
+
+	pipeline = frappe.cache().pipeline()
+	key = get_key(name, bucket)
+	pipeline.hincrby(key, "calls", 1)
+	pipeline.hincrby(key, "failures", cint(failed))
+	pipeline.hincrbyfloat(key, "latency", latency)
+	pipeline.expire(key, window * 2)
+	pipeline.hmget(get_key(name, bucket - 1), "calls", "failures")
+	calls, failures, _latency, _expiry, previous = pipeline.execute()
+
+	if not failed:
+		return
+
+	calls += cint(previous[0])
+	failures += cint(previous[1])
+	min_calls = cint(frappe.conf.payments_circuit_min_calls) or DEFAULT_MIN_CALLS
+	failure_rate = flt(frappe.conf.payments_circuit_failure_rate) or DEFAULT_FAILURE_RATE
+
+	if calls >= min_calls and failures / calls >= failure_rate:
+		open_circuit(name)
+
+
+def open_circuit(name):
+	cache = frappe.cache()
+	open_for = cint(frappe.conf.payments_circuit_open_for) or DEFAULT_OPEN_FOR
+
+	cache.set(get_key(name, "open"), 1, ex=open_for)
+	cache.set(get_key(name, "tripped"), 1, ex=24 * 60 * 60)
+	cache.delete(get_key(name, "probe"))
+	frappe.log_error(
+		_("Calls to {0} are refused for {1} seconds after repeated failures").format(name, open_for),
+		f"Circuit opened for {name}",
+	)
+
+
+def close_circuit(name):
+	bucket = int(time.time() // get_window())
+	frappe.cache().delete(
+		get_key(name, "tripped"),
+		get_key(name, "probe"),
+		get_key(name, bucket),
+		get_key(name, bucket - 1),
+	)
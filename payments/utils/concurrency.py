@@ -0,0 +1,56 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import frappe
+from frappe.utils import cint
+
+from payments.utils import http
+from payments.utils.rate_limit import get_gateway_limiter
+
+DEFAULT_CONCURRENCY = 4
+
+
+def get_concurrency():
+	return cint(frappe.conf.payments_job_concurrency) or DEFAULT_CONCURRENCY
+
+
+def run_concurrently(tasks, max_workers=None):
+	"""
+	Run `(key, gateway, fn)` tasks on a bounded thread pool and yield
+	`(key, result, exception)` in completion order.
+
+	`fn` runs in a worker thread and must only do network calls, every database read
+	it needs has to happen while building the task and every write while consuming
+	the results. Calls are paced by the token bucket of their gateway (see
+	`payments.utils.rate_limit`), shared by all workers of the site, and at most
+	`2 * max_workers` tasks are held in flight, so `tasks` can be a lazy iterable.
+	"""
+	max_workers = max_workers or get_concurrency()
+	pending = {}
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		for key, gateway, fn in tasks:
+			limiter = get_gateway_limiter(gateway)
+			pending[executor.submit(run_task, limiter, fn)] = key
+
+			if len(pending) >= 2 * max_workers:
+				yield from collect(pending)
+
+		while pending:
+			yield from collect(pending)
+
+
+def run_task(limiter, fn):
+	limiter.acquire()
+	previous = http.set_rate_limiter(limiter)
+	try:
+		return fn()
+	finally:
+		http.set_rate_limiter(previous)
+
+
+def collect(pending):
+	done, _ = wait(pending, return_when=FIRST_COMPLETED)
+	for future in done:
+		key = pending.pop(future)
+		exception = future.exception()
+		yield key, None if exception else future.result(), exception
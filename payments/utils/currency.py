@@ -0,0 +1,426 @@
+"""
+Currency capabilities of the payment gateways.
+
+The registry is built once at import: the currencies each gateway supports as frozen
+sets, the minimum amount per currency and the number of decimals of each currency's
+minor unit. Lookups are O(1), and `validate_payments` checks a whole batch of
+payments with one pass.
+
+Gateways are looked up by type ("Stripe", "Braintree", "PayPal", "Razorpay" and
+"Paytm"). Payment Gateway names of accounts, like "Stripe-Acme", resolve to their
+type.
+"""
+
+from types import MappingProxyType
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+
+SUPPORTED_CURRENCIES = MappingProxyType(
+	{
+		"Stripe": frozenset(
+			(
+				"AED",
+				"ALL",
+				"ANG",
+				"ARS",
+				"AUD",
+				"AWG",
+				"BBD",
+				"BDT",
+				"BIF",
+				"BMD",
+				"BND",
+				"BOB",
+				"BRL",
+				"BSD",
+				"BWP",
+				"BZD",
+				"CAD",
+				"CHF",
+				"CLP",
+				"CNY",
+				"COP",
+				"CRC",
+				"CVE",
+				"CZK",
+				"DJF",
+				"DKK",
+				"DOP",
+				"DZD",
+				"EGP",
+				"ETB",
+				"EUR",
+				"FJD",
+				"FKP",
+				"GBP",
+				"GIP",
+				"GMD",
+				"GNF",
+				"GTQ",
+				"GYD",
+				"HKD",
+				"HNL",
+				"HRK",
+				"HTG",
+				"HUF",
+				"IDR",
+				"ILS",
+				"INR",
+				"ISK",
+				"JMD",
+				"JPY",
+				"KES",
+				"KHR",
+				"KMF",
+				"KRW",
+				"KYD",
+				"KZT",
+				"LAK",
+				"LBP",
+				"LKR",
+				"LRD",
+				"MAD",
+				"MDL",
+				"MNT",
+				"MOP",
+				"MRO",
+				"MUR",
+				"MVR",
+				"MWK",
+				"MXN",
+				"MYR",
+				"NAD",
+				"NGN",
+				"NIO",
+				"NOK",
+				"NPR",
+				"NZD",
+				"PAB",
+				"PEN",
+				"PGK",
+				"PHP",
+				"PKR",
+				"PLN",
+				"PYG",
+				"QAR",
+				"RUB",
+				"SAR",
+				"SBD",
+				"SCR",
+				"SEK",
+				"SGD",
+				"SHP",
+				"SLL",
+				"SOS",
+				"STD",
+				"SVC",
+				"SZL",
+				"THB",
+				"TOP",
+				"TTD",
+				"TWD",
+				"TZS",
+				"UAH",
+				"UGX",
+				"USD",
+				"UYU",
+				"UZS",
+				"VND",
+				"VUV",
+				"WST",
+				"XAF",
+				"XOF",
+				"XPF",
+				"YER",
+				"ZAR",
+			)
+		),
+		"Braintree": frozenset(
+			(
+				"AED",
+				"AMD",
+				"AOA",
+				"ARS",
+				"AUD",
+				"AWG",
+				"AZN",
+				"BAM",
+				"BBD",
+				"BDT",
+				"BGN",
+				"BIF",
+				"BMD",
+				"BND",
+				"BOB",
+				"BRL",
+				"BSD",
+				"BWP",
+				"BYN",
+				"BZD",
+				"CAD",
+				"CHF",
+				"CLP",
+				"CNY",
+				"COP",
+				"CRC",
+				"CVE",
+				"CZK",
+				"DJF",
+				"DKK",
+				"DOP",
+				"DZD",
+				"EGP",
+				"ETB",
+				"EUR",
+				"FJD",
+				"FKP",
+				"GBP",
+				"GEL",
+				"GHS",
+				"GIP",
+				"GMD",
+				"GNF",
+				"GTQ",
+				"GYD",
+				"HKD",
+				"HNL",
+				"HRK",
+				"HTG",
+				"HUF",
+				"IDR",
+				"ILS",
+				"INR",
+				"ISK",
+				"JMD",
+				"JPY",
+				"KES",
+				"KGS",
+				"KHR",
+				"KMF",
+				"KRW",
+				"KYD",
+				"KZT",
+				"LAK",
+				"LBP",
+				"LKR",
+				"LRD",
+				"LSL",
+				"LTL",
+				"MAD",
+				"MDL",
+				"MKD",
+				"MNT",
+				"MOP",
+				"MUR",
+				"MVR",
+				"MWK",
+				"MXN",
+				"MYR",
+				"MZN",
+				"NAD",
+				"NGN",
+				"NIO",
+				"NOK",
+				"NPR",
+				"NZD",
+				"PAB",
+				"PEN",
+				"PGK",
+				"PHP",
+				"PKR",
+				"PLN",
+				"PYG",
+				"QAR",
+				"RON",
+				"RSD",
+				"RUB",
+				"RWF",
+				"SAR",
+				"SBD",
+				"SCR",
+				"SEK",
+				"SGD",
+				"SHP",
+				"SLL",
+				"SOS",
+				"SRD",
+				"STD",
+				"SVC",
+				"SYP",
+				"SZL",
+				"THB",
+				"TJS",
+				"TOP",
+				"TRY",
+				"TTD",
+				"TWD",
+				"TZS",
+				"UAH",
+				"UGX",
+				"USD",
+				"UYU",
+				"UZS",
+				"VEF",
+				"VND",
+				"VUV",
+				"WST",
+				"XAF",
+				"XCD",
+				"XOF",
+				"XPF",
+				"YER",
+				"ZAR",
+				"ZMK",
+				"ZWD",
+			)
+		),
+		"PayPal": frozenset(
+			(
+				"AUD",
+				"BRL",
+				"CAD",
+				"CZK",
+				"DKK",
+				"EUR",
+				"HKD",
+				"HUF",
+				"ILS",
+				"JPY",
+				"MYR",
+				"MXN",
+				"TWD",
+				"NZD",
+				"NOK",
+				"PHP",
+				"PLN",
+				"GBP",
+				"RUB",
+				"SGD",
+				"SEK",
+				"CHF",
+				"THB",
+				"TRY",
+				"USD",
+			)
+		),
+		"Razorpay": frozenset(("INR",)),
+		"Paytm": frozenset(("INR",)),
+	}
+)
+
+MINIMUM_AMOUNTS = MappingProxyType(
+	{
+		"Stripe": MappingProxyType(
+			{
+				"JPY": 50,
+				"MXN": 10,
+				"DKK": 2.50,
+				"HKD": 4.00,
+				"NOK": 3.00,
+				"SEK": 3.00,
+				"USD": 0.50,
+				"AUD": 0.50,
+				"BRL": 0.50,
+				"CAD": 0.50,
+				"CHF": 0.50,
+				"EUR": 0.50,
+				"GBP": 0.30,
+				"NZD": 0.50,
+				"SGD": 0.50,
+			}
+		),
+	}
+)
+
+# currencies whose amounts are not sent to gateways in hundredths
+ZERO_DECIMAL_CURRENCIES = frozenset(
+	(
+		"BIF",
+		"CLP",
+		"DJF",
+		"GNF",
+		"JPY",
+		"KMF",
+		"KRW",
+		"MGA",
+		"PYG",
+		"RWF",
+		"UGX",
+		"VND",
+		"VUV",
+		"XAF",
+		"XOF",
+		"XPF",
+	)
+)
+THREE_DECIMAL_CURRENCIES = frozenset(("BHD", "JOD", "KWD", "OMR", "TND"))
+
+
+def get_gateway_type(gateway):
+	return gateway.split("-", 1)[0]
+
+
+def supports_currency(gateway, currency):
+	currencies = SUPPORTED_CURRENCIES.get(get_gateway_type(gateway))
+	return currencies is None or currency in currencies
+
+
+def get_minimum_amount(gateway, currency):
+	return MINIMUM_AMOUNTS.get(get_gateway_type(gateway), {}).get(currency, 0)
+
+
+def get_minor_unit_exponent(currency):
+	currency = (currency or "").upper()
+	if currency in ZERO_DECIMAL_CURRENCIES:
+		return 0
+	if currency in THREE_DECIMAL_CURRENCIES:
+		return 3
+	return 2
+
+
+def to_minor_units(amount, currency):
+	"""Return `amount` in the smallest unit of `currency`, e.g. paise or cents"""
+	return cint(round(flt(amount) * 10 ** get_minor_unit_exponent(currency)))
+
+
+def from_minor_units(amount, currency):
+	return flt(amount) / 10 ** get_minor_unit_exponent(currency)
+
+
+def get_payment_error(gateway, currency, amount):
+	"""Return why `gateway` can not take a payment of `amount` in `currency`, if it can not"""
+	if not supports_currency(gateway, currency):
+		return _(
+			"Please select another payment method. {0} does not support transactions in currency '{1}'"
+		).format(get_gateway_type(gateway), currency)
+
+	minimum_amount = get_minimum_amount(gateway, currency)
+	if flt(amount) < minimum_amount:
+		return _("For currency {0}, the minimum transaction amount should be {1}").format(
+			currency, minimum_amount
+		)
+
+
+def validate_payments(gateway, payments):
+	"""Return `{index: error}` for the payments (dicts with `currency` and `amount`) that
+	`gateway` can not take"""
+	errors = {}
+	for idx, payment in enumerate(payments):
+		error = get_payment_error(gateway, payment.get("currency"), payment.get("amount"))
+		if error:
+			errors[idx] = error
+
+	return errors
+
+
+def validate_transaction_currency(gateway, currency):
+	if not supports_currency(gateway, currency):
+		frappe.throw(get_payment_error(gateway, currency, None))
+
+
+def validate_minimum_transaction_amount(gateway, currency, amount):
+	error = get_payment_error(gateway, currency, amount)
+	if error:
+		frappe.throw(error)
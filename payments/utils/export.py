@@ -0,0 +1,153 @@
+import csv
+import json
+
+import frappe
+from frappe.utils import add_days, cstr, getdate
+
+EXPORT_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"integration_request_service",
+	"status",
+	"reference_doctype",
+	"reference_docname",
+)
+
+# payload keys written as their own CSV columns, the full payload is kept in `payload`
+PAYLOAD_FIELDS = (
+	"amount",
+	"currency",
+	"payer_name",
+	"payer_email",
+	"order_id",
+	"title",
+	"description",
+)
+
+EXPORT_FORMATS = ("csv", "ndjson")
+
+
+def export_payment_records(
+	file_path,
+	export_format="csv",
+	gateway=None,
+	status=None,
+	from_date=None,
+	to_date=None,
+	include_archived=False,
+	batch_size=1000,
+):
+	"""
+	Write payment requests matching the filters to `file_path` as CSV or newline
+	delimited JSON and return the number of records written.
+
+	Integration Requests are walked by (creation, name) keyset pagination and every
+	record is decoded and written as it is read, so only one batch is held in memory
+	irrespective of how many records match.
+	"""
+	if export_format not in EXPORT_FORMATS:
+		frappe.throw(
+			frappe._("Export format must be one of {0}").format(", ".join(EXPORT_FORMATS))
+		)
+
+	doctypes = ["Integration Request"]
+	if include_archived:
+		doctypes.append("Integration Request Archive")
+
+	count = 0
+	with open(file_path, "w", newline="") as f:
+		write = get_csv_writer(f) if export_format == "csv" else get_ndjson_writer(f)
+
+		for doctype in doctypes:
+			for record in iter_payment_records(
+				doctype, gateway, status, from_date, to_date, batch_size
+			):
+				write(record)
+				count += 1
+
+	return count
+
+
+def get_csv_writer(f):
+	writer = csv.writer(f)
+	writer.writerow(EXPORT_FIELDS + PAYLOAD_FIELDS + ("payload",))
+
+	def write(record):
+		payload = decode_payload(record.data)
+		writer.writerow(
+			[cstr(record.get(fieldname)) for fieldname in EXPORT_FIELDS]
+			+ [cstr(payload.get(key)) for key in PAYLOAD_FIELDS]
+			+ [json.dumps(payload, default=str)]
+		)
+
+	return write
+
+
+def get_ndjson_writer(f):
+	def write(record):
+		row = {fieldname: record.get(fieldname) for fieldname in EXPORT_FIELDS}
+		row["data"] = decode_payload(record.data)
+		f.write(json.dumps(row, default=str))
+		f.write("\n")
+
+	return write
+
+
+def decode_payload(data):
+	"""Return the payload of a request as a dict, payloads that are not JSON objects are
+	wrapped as `{"raw": ...}` or `{"value": ...}`"""
+	try:
+		payload = json.loads(data or "{}")
+	except (TypeError, ValueError):
+		return {"raw": data}
+
+	return payload if isinstance(payload, dict) else {"value": payload}
+
+
+def iter_payment_records(
+	doctype="Integration Request",
+	gateway=None,
+	status=None,
+	from_date=None,
+	to_date=None,
+	batch_size=1000,
+):
+	"""Yield payment requests of `doctype` in (creation, name) order, one batch at a time"""
+	table = frappe.qb.DocType(doctype)
+
+	query = (
+		frappe.qb.from_(table)
+		.select(*(table[fieldname] for fieldname in EXPORT_FIELDS + ("data",)))
+		.where(table.is_remote_request == 0)
+		.orderby(table.creation)
+		.orderby(table.name)
+		.limit(batch_size)
+	)
+
+	if gateway:
+		query = query.where(table.integration_request_service == gateway)
+	if status:
+		statuses = status.split(",") if isinstance(status, str) else status
+		query = query.where(table.status.isin([s.strip() for s in statuses]))
+	if from_date:
+		query = query.where(table.creation >= getdate(from_date))
+	if to_date:
+		query = query.where(table.creation < add_days(getdate(to_date), 1))
+
+	last = None
+	while True:
+		batch_query = query
+		if last:
+			batch_query = query.where(
+				(table.creation > last.creation)
+				| ((table.creation == last.creation) & (table.name > last.name))
+			)
+
+		batch = batch_query.run(as_dict=True)
+		yield from batch
+
+		if len(batch) < batch_size:
+			break
+
+		last = batch[-1]
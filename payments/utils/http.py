@@ -0,0 +1,111 @@
+"""
+Outbound HTTP for payment gateways.
+
+Unlike `frappe.integrations.utils.make_request` nothing here touches `frappe.local`,
+so these helpers can also be called from the worker threads of background jobs.
+
+Requests made while a deadline is set for the thread (see `payments.utils.bulkhead`)
+time out by the deadline, and fail at once once it has passed. A 429 answer pauses the
+rate limiter set for the thread (see `payments.utils.rate_limit`) for its
+`Retry-After`.
+"""
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs
+
+import requests
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRY_AFTER = 1
+
+_local = threading.local()
+
+
+def get_session():
+	if not hasattr(_local, "session"):
+		_local.session = requests.Session()
+
+	return _local.session
+
+
+def set_deadline(deadline):
+	"""Make requests of this thread end by `deadline`, a `time.monotonic()` value or
+	None, returns the previous deadline"""
+	previous = getattr(_local, "deadline", None)
+	_local.deadline = deadline
+	return previous
+
+
+def get_timeout(timeout=None):
+	"""Return `timeout` (or the default) capped to the time left before the deadline"""
+	timeout = timeout or DEFAULT_TIMEOUT
+	deadline = getattr(_local, "deadline", None)
+	if deadline is None:
+		return timeout
+
+	remaining = deadline - time.monotonic()
+	if remaining <= 0:
+		raise requests.exceptions.Timeout("Deadline exceeded before the request was sent")
+
+	return min(timeout, remaining)
+
+
+def set_rate_limiter(limiter):
+	"""Report rate limited requests of this thread to `limiter`, returns the previous
+	limiter"""
+	previous = getattr(_local, "rate_limiter", None)
+	_local.rate_limiter = limiter
+	return previous
+
+
+def get_retry_after(response, default=None):
+	"""Return the seconds to wait given by the `Retry-After` header of `response`"""
+	retry_after = response.headers.get("Retry-After")
+	if not retry_after:
+		return default
+
+	try:
+		return float(retry_after)
+	except ValueError:
+		pass
+
+	try:
+		return parsedate_to_datetime(retry_after).timestamp() - time.time()
+	except (TypeError, ValueError):
+		return default
+
+
+def make_request(
+	method, url, auth=None, headers=None, data=None, json=None, params=None, timeout=None
+):
+	response = get_session().request(
+		method,
+		url,
+		auth=auth,
+		headers=headers,
+		data=data,
+		json=json,
+		params=params,
+		timeout=get_timeout(timeout),
+	)
+
+	limiter = getattr(_local, "rate_limiter", None)
+	if limiter and response.status_code == 429:
+		limiter.pause(get_retry_after(response, DEFAULT_RETRY_AFTER))
+
+	response.raise_for_status()
+
+	if response.headers.get("content-type", "").startswith("text/plain"):
+		return parse_qs(response.text)
+
+	return response.json()
+
+
+def make_get_request(url, **kwargs):
+	return make_request("GET", url, **kwargs)
+
+
+def make_post_request(url, **kwargs):
+	return make_request("POST", url, **kwargs)
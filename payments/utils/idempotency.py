@@ -0,0 +1,31 @@
+"""
+Short lived idempotency keys kept in redis.
+
+Keys expire on their own after their TTL, so the store never needs to be cleaned up.
+"""
+
+import hashlib
+import json
+
+import frappe
+
+
+def get_cache_key(namespace, key):
+	return frappe.cache().make_key(f"payments:idempotency:{namespace}:{key}")
+
+
+def claim(namespace, key, ttl):
+	"""Atomically claim `key` for `ttl` seconds, returns False if it is already claimed"""
+	return bool(frappe.cache().set(get_cache_key(namespace, key), 1, nx=True, ex=ttl))
+
+
+def release(namespace, key):
+	"""Release a claimed key so that a retry is processed again"""
+	frappe.cache().delete(get_cache_key(namespace, key))
+
+
+def get_payload_hash(data):
+	payload = {key: value for key, value in dict(data).items() if key != "cmd"}
+	return hashlib.sha256(
+		json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+	).hexdigest()
@@ -0,0 +1,198 @@
+"""
+Bulk generation of checkout urls, e.g. for a monthly invoicing run.
+
+`get_payment_urls(payment_gateway, payment_details)` takes a list of the
+`payment_details` dicts `get_payment_url` accepts, all for one gateway, and yields
+`(index, url, error)` as urls become ready. Currencies and minimum amounts are
+checked for the whole list against `payments.utils.currency`, payments the gateway can
+not take are yielded with their error and skipped.
+
+Gateway controllers support it through `get_payment_url_query(**payment_details)`,
+which returns a callable run on a worker thread that returns a dict with:
+
+- `url`: the checkout url
+- `integration_request` (optional): the Integration Request to create, built with
+  `get_integration_request_row`
+
+Integration Requests are inserted in bulk every `payments_payment_link_flush_size`
+(site config, default 100) urls, and a url is only yielded once its Integration
+Request is committed. Gateways without `get_payment_url_query` fall back to one
+`get_payment_url` call per payment.
+"""
+
+import json
+from collections import defaultdict
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, getdate, now_datetime
+
+from payments.utils.concurrency import run_concurrently
+from payments.utils.currency import SUPPORTED_CURRENCIES, get_gateway_type, validate_payments
+from payments.utils.utils import get_payment_gateway_controller
+
+DEFAULT_FLUSH_SIZE = 100
+
+
+def get_integration_request_row(data, service_name, name=None):
+	"""Return an Integration Request to be inserted by `get_payment_urls`, safe to call
+	from worker threads"""
+	return {
+		"name": name or frappe.generate_hash(length=10),
+		"integration_request_service": service_name,
+		"request_description": data.get("description"),
+		"reference_doctype": data.get("reference_doctype"),
+		"reference_docname": data.get("reference_docname"),
+		"data": json.dumps(data, default=str),
+		"currency": data.get("currency"),
+		"amount": flt(data.get("amount")),
+	}
+
+
+@frappe.whitelist()
+def create_payment_links(payment_gateway, payment_details):
+	"""Return `{"url": ..., "error": ...}` for each of `payment_details`, in order"""
+	if not frappe.has_permission("Integration Request", "create"):
+		frappe.throw(_("Not permitted to create payment links"), frappe.PermissionError)
+
+	payment_details = frappe.parse_json(payment_details)
+	links = [None] * len(payment_details)
+	for idx, url, error in get_payment_urls(payment_gateway, payment_details):
+		links[idx] = {"url": url, "error": error}
+
+	return links
+
+
+def get_payment_urls(payment_gateway, payment_details):
+	"""Yield `(index, url, error)` for each of `payment_details` as its url is ready"""
+	controller = get_payment_gateway_controller(payment_gateway)
+	errors = validate_payment_details(payment_gateway, controller, payment_details)
+	for idx, error in errors.items():
+		yield idx, None, error
+
+	if not hasattr(controller, "get_payment_url_query"):
+		for idx, details in enumerate(payment_details):
+			if idx in errors:
+				continue
+
+			try:
+				yield idx, controller.get_payment_url(**details), None
+				frappe.db.commit()
+			except Exception as e:
+				frappe.db.rollback()
+				frappe.log_error(frappe.get_traceback(), "Payment link creation failed")
+				yield idx, None, str(e)
+		return
+
+	tasks = []
+	for idx, details in enumerate(payment_details):
+		if idx in errors:
+			continue
+
+		try:
+			tasks.append((idx, payment_gateway, controller.get_payment_url_query(**details)))
+		except Exception as e:
+			frappe.clear_last_message()
+			frappe.log_error(frappe.get_traceback(), "Payment link creation failed")
+			yield idx, None, str(e)
+
+	flush_size = cint(frappe.conf.payments_payment_link_flush_size) or DEFAULT_FLUSH_SIZE
+	ready = []
+	for idx, result, exception in run_concurrently(tasks):
+		if exception:
+			yield idx, None, str(exception)
+			continue
+
+		ready.append((idx, result))
+		if len(ready) >= flush_size:
+			yield from flush_payment_urls(ready)
+			ready = []
+
+	yield from flush_payment_urls(ready)
+
+
+def validate_payment_details(payment_gateway, controller, payment_details):
+	"""Return `{index: error}` for the payments of a batch the gateway can not take"""
+	if get_gateway_type(payment_gateway) in SUPPORTED_CURRENCIES:
+		return validate_payments(payment_gateway, payment_details)
+
+	# gateways of other apps validate themselves, once per currency for the batch
+	payments = defaultdict(list)
+	for idx, details in enumerate(payment_details):
+		payments[details.get("currency")].append(idx)
+
+	errors = {}
+	for currency, indexes in payments.items():
+		try:
+			controller.validate_transaction_currency(currency)
+			if hasattr(controller, "validate_minimum_transaction_amount"):
+				controller.validate_minimum_transaction_amount(
+					currency, min(flt(payment_details[idx].get("amount")) for idx in indexes)
+				)
+		except Exception as e:
+			frappe.clear_last_message()
+			errors.update((idx, str(e)) for idx in indexes)
+
+	return errors
+
+
+def flush_payment_urls(ready):
+	rows = [
+		result["integration_request"] for idx, result in ready if result.get("integration_request")
+	]
+	if rows:
+		insert_integration_requests(rows)
+
+	for idx, result in ready:
+		yield idx, result["url"], None
+
+
+def insert_integration_requests(rows):
+	from payments.payments.doctype.payment_analytics_rollup.payment_analytics_rollup import (
+		buffer_rollup,
+	)
+
+	now = now_datetime()
+	frappe.db.bulk_insert(
+		"Integration Request",
+		fields=[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"integration_request_service",
+			"request_description",
+			"reference_doctype",
+			"reference_docname",
+			"status",
+			"data",
+		],
+		values=[
+			(
+				row["name"],
+				now,
+				now,
+				frappe.session.user,
+				frappe.session.user,
+				row["integration_request_service"],
+				row["request_description"],
+				row["reference_doctype"],
+				row["reference_docname"],
+				"Queued",
+				row["data"],
+			)
+			for row in rows
+		],
+	)
+
+	# bulk inserts skip `on_change`, so the new requests are counted here instead
+	queued = defaultdict(lambda: [0, 0])
+	for row in rows:
+		queued[(row["integration_request_service"], row["currency"])][0] += 1
+		queued[(row["integration_request_service"], row["currency"])][1] += row["amount"]
+
+	for (service, currency), (count, amount) in queued.items():
+		buffer_rollup(getdate(), service, currency, "Queued", count=count, amount=amount)
+
+	frappe.db.commit()
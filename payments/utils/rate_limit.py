@@ -0,0 +1,117 @@
+"""
+Outbound rate limits of background jobs, per gateway and account.
+
+Every gateway account has a token bucket in redis, shared by all workers of the site,
+refilled at `payments_gateway_rate_limits[gateway]` requests per second (site config,
+see `DEFAULT_RATE_LIMITS`) and holding at most one second of requests. Tasks of
+`payments.utils.concurrency.run_concurrently` and background calls made inside
+`payments.utils.bulkhead.gateway_call` take a token before calling the gateway and
+wait for one when the bucket is empty.
+
+When a gateway still answers with 429, `payments.utils.http` hands its `Retry-After`
+to the bucket of the call. The bucket then goes into debt for that long, so no worker
+calls the gateway again before it asked to be called, and afterwards requests resume
+at the configured rate instead of all at once.
+"""
+
+import threading
+import time
+
+import frappe
+
+# outbound requests per second allowed for background jobs, per gateway.
+# Override with `payments_gateway_rate_limits` in site config, by gateway
+# ("Stripe") or account ("Stripe-Acme").
+DEFAULT_RATE_LIMITS = {
+	"Razorpay": 10,
+	"Stripe": 25,
+	"Braintree": 10,
+	"PayPal": 5,
+	"Paytm": 5,
+}
+
+# the longest a single Retry-After may stall the workers of a gateway
+MAX_RETRY_AFTER = 5 * 60
+
+# Take a token from the bucket at KEYS[1], refilled at ARGV[1] tokens per second up to
+# ARGV[2]. Returns 0 if a token was taken, else the seconds until one is available.
+# ARGV[3] > 0 pauses the bucket for that many seconds instead. Times are redis time,
+# so that the clocks of the workers do not matter.
+ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local pause = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+
+local wait = 0
+if pause > 0 then
+	tokens = math.min(tokens, -pause * rate)
+elseif tokens >= 1 then
+	tokens = tokens - 1
+else
+	wait = (1 - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated_at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate + math.max(pause, 0)) + 60)
+return tostring(wait)
+"""
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+	"""Token bucket in redis refilled at `rate` tokens per second, safe to use from
+	worker threads"""
+
+	def __init__(self, key, script, rate, capacity=None):
+		self.key = key
+		self.script = script
+		self.rate = float(rate)
+		self.capacity = float(capacity or rate)
+
+	def acquire(self):
+		"""Block until a token is available"""
+		while True:
+			wait = float(self.script(keys=[self.key], args=[self.rate, self.capacity, 0]))
+			if not wait:
+				return
+
+			time.sleep(wait)
+
+	def pause(self, seconds):
+		"""Hand out no tokens for `seconds`, e.g. after a 429 with Retry-After"""
+		seconds = min(max(float(seconds), 0), MAX_RETRY_AFTER)
+		if seconds:
+			self.script(keys=[self.key], args=[self.rate, self.capacity, seconds])
+
+
+def get_gateway_rate(gateway):
+	rate_limits = dict(DEFAULT_RATE_LIMITS, **(frappe.conf.payments_gateway_rate_limits or {}))
+	return rate_limits.get(gateway) or rate_limits.get(gateway.split("-", 1)[0]) or 5
+
+
+def get_gateway_limiter(gateway):
+	"""Return the token bucket of `gateway` (a gateway or "gateway-account"), must be
+	called from the main thread since the rate is read from site config"""
+	rate = get_gateway_rate(gateway)
+	key = (frappe.local.site, gateway)
+
+	with _buckets_lock:
+		bucket = _buckets.get(key)
+		if not bucket or bucket.rate != rate:
+			cache = frappe.cache()
+			bucket = _buckets[key] = TokenBucket(
+				cache.make_key(f"payments:rate_limit:{gateway}"),
+				cache.register_script(ACQUIRE_SCRIPT),
+				rate,
+			)
+
+	return bucket
@@ -0,0 +1,141 @@
+"""
+Reconciliation of payment requests abandoned mid-flow.
+
+Integration Requests that stay Queued or Authorized longer than
+`payments_reconciliation_stale_after` minutes (site config, default 60) are looked up
+at their gateway and moved to the status the gateway reports.
+
+Checkout links (Queued requests no payment was attempted for yet, i.e. without a
+`gateway_payment_id`) are left alone for `payments_checkout_session_expiry` days
+(site config, default 30), so links sent out e.g. with monthly invoices stay payable.
+Once expired, gateways report them as Cancelled. Requests for which the gateway already
+created an order, kept as their `request_id`, are looked up once stale: their payment
+may have gone through while its callback never arrived.
+
+Every gateway controller provides the lookup through `get_payment_status_query`,
+which receives the Integration Request and returns a callable. The callable is run
+on a worker thread, so it may only do network calls, and returns a dict with:
+
+- `status`: the Integration Request status to move to, `None` while still pending
+- `data` (optional): params to update in the Integration Request data
+- `gateway_payment_id` (optional): the payment id at the gateway
+
+Other apps can provide or override the lookup of a service with the
+`payment_status_queries` hook: `{"Service": "dotted.path.to.get_query"}`.
+"""
+
+import traceback
+
+import frappe
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+
+from payments.payments.doctype.payment_callback.payment_callback import (
+	authorize_reference_document,
+)
+from payments.utils import get_integration_request_controller, set_integration_request_status
+from payments.utils.concurrency import run_concurrently
+
+STALE_STATUSES = ("Queued", "Authorized")
+DEFAULT_CHECKOUT_SESSION_EXPIRY = 30
+
+
+def reconcile_stale_requests():
+	stale_after = cint(frappe.conf.payments_reconciliation_stale_after) or 60
+	batch_size = cint(frappe.conf.payments_reconciliation_batch_size) or 500
+
+	requests = frappe.get_all(
+		"Integration Request",
+		filters={
+			"status": ("in", STALE_STATUSES),
+			"is_remote_request": 0,
+			"integration_request_service": ("is", "set"),
+			"modified": ("<", add_to_date(now_datetime(), minutes=-stale_after)),
+		},
+		or_filters={
+			"status": "Authorized",
+			"gateway_payment_id": ("is", "set"),
+			"request_id": ("is", "set"),
+			"creation": ("<", get_checkout_session_cutoff()),
+		},
+		fields=[
+			"name",
+			"creation",
+			"status",
+			"integration_request_service",
+			"gateway_payment_id",
+			"request_id",
+			"data",
+		],
+		order_by="modified asc",
+		limit=batch_size,
+	)
+
+	for name, result, exception in run_concurrently(get_status_queries(requests)):
+		if exception:
+			frappe.log_error(
+				"".join(traceback.format_exception(type(exception), exception, exception.__traceback__)),
+				f"Payment reconciliation failed for {name}",
+			)
+			continue
+
+		try:
+			apply_reconciled_status(name, result)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(frappe.get_traceback(), f"Payment reconciliation failed for {name}")
+
+
+def get_checkout_session_cutoff():
+	session_expiry = (
+		cint(frappe.conf.payments_checkout_session_expiry) or DEFAULT_CHECKOUT_SESSION_EXPIRY
+	)
+	return add_to_date(now_datetime(), days=-session_expiry)
+
+
+def is_checkout_session_expired(request):
+	return get_datetime(request.creation) < get_checkout_session_cutoff()
+
+
+def get_status_queries(requests):
+	for request in requests:
+		try:
+			query = get_status_query(request)
+		except Exception:
+			frappe.log_error(
+				frappe.get_traceback(), f"Payment reconciliation failed for {request.name}"
+			)
+			continue
+
+		if query:
+			yield request.name, request.integration_request_service, query
+
+
+def get_status_query(request):
+	custom_queries = frappe.get_hooks("payment_status_queries") or {}
+	if custom_queries.get(request.integration_request_service):
+		return frappe.get_attr(custom_queries[request.integration_request_service][-1])(request)
+
+	controller = get_integration_request_controller(request)
+	if hasattr(controller, "get_payment_status_query"):
+		return controller.get_payment_status_query(request)
+
+
+def apply_reconciled_status(name, result):
+	if not result or not result.get("status"):
+		return
+
+	integration_request = frappe.get_doc("Integration Request", name, for_update=True)
+	if (
+		integration_request.status not in STALE_STATUSES
+		or integration_request.status == result["status"]
+	):
+		return
+
+	if result.get("gateway_payment_id"):
+		integration_request.gateway_payment_id = result["gateway_payment_id"]
+
+	set_integration_request_status(integration_request, result.get("data"), result["status"])
+
+	if result["status"] in ("Authorized", "Completed"):
+		authorize_reference_document(integration_request, result["status"], sync=False)
@@ -0,0 +1,187 @@
+"""
+Refunds of completed payments.
+
+Every gateway controller provides refunds through
+`get_refund_query(integration_request, amount=None, idempotency_key=None)`, which
+returns a callable refunding `amount` (the whole payment when `None`). The callable is
+run on a worker thread, so it may only do network calls, and returns a dict with:
+
+- `refund_id`: the id of the refund at the gateway
+- `refunded_amount`: the amount refunded, in the currency of the payment
+- `status`: the status of the refund at the gateway
+
+Gateways that support it (Stripe, PayPal and Paytm) refund only once per
+`idempotency_key`, so retrying a refund that timed out does not refund twice.
+`refund_payment` derives the key from the request and the number of refunds recorded
+for it, so a retry before the refund was recorded reuses the key.
+
+A refund may not exceed what is left of the payment, its `amount` less the
+`refunded_amount` already recorded, and refunding "all" of a partially refunded
+payment refunds what is left.
+
+Refunds are recorded in the Integration Request data, as the list of `refunds` and
+the `refunded_amount` total, and the reference document is told through
+`on_payment_refunded(refunded_amount)`. Payments whose request was archived are
+refunded and recorded in Integration Request Archive.
+"""
+
+import json
+
+import frappe
+from frappe import _
+from frappe.utils import flt, now_datetime
+
+from payments.utils import (
+	get_integration_request,
+	get_integration_request_controller,
+	get_request_data,
+)
+from payments.utils.currency import to_minor_units
+
+REFUNDABLE_STATUSES = ("Completed",)
+
+
+@frappe.whitelist()
+def refund_payment(integration_request, amount=None):
+	"""Refund `amount` of a completed payment, or all of it"""
+	if not frappe.has_permission("Integration Request", "write"):
+		frappe.throw(_("Not permitted to refund payments"), frappe.PermissionError)
+
+	# locked until the refund is recorded, so concurrent refunds see each other
+	doc = get_integration_request(integration_request, for_update=True)
+
+	idempotency_key = "{}-refund-{}".format(
+		doc.name, len(get_request_data(doc).get("refunds") or [])
+	)
+	result = get_refund_query(doc, amount, idempotency_key=idempotency_key)()
+	record_refunds({doc.name: result})
+
+	return result
+
+
+def get_refund_query(integration_request, amount=None, idempotency_key=None):
+	if integration_request.status not in REFUNDABLE_STATUSES:
+		frappe.throw(
+			_("{0} can not be refunded since it is {1}").format(
+				integration_request.name, integration_request.status
+			)
+		)
+
+	amount = get_refundable_amount(integration_request, amount)
+
+	controller = get_integration_request_controller(integration_request)
+	if not hasattr(controller, "get_refund_query"):
+		frappe.throw(_("Refunds are not supported for {0}").format(controller.doctype))
+
+	return controller.get_refund_query(
+		integration_request, amount=amount, idempotency_key=idempotency_key
+	)
+
+
+def get_refundable_amount(integration_request, amount=None):
+	"""Return the amount to refund, `None` for all of an unrefunded payment. Throws if
+	`amount` is more than what is left of the payment."""
+	data = get_request_data(integration_request)
+	if not flt(data.amount):
+		# nothing to check against, the gateway refuses refunds beyond the payment
+		return flt(amount) or None
+
+	remaining = flt(data.amount) - flt(data.refunded_amount)
+	if to_minor_units(remaining, data.currency) <= 0:
+		frappe.throw(_("{0} has already been refunded").format(integration_request.name))
+
+	if to_minor_units(amount, data.currency) > to_minor_units(remaining, data.currency):
+		frappe.throw(
+			_("Only {0} of {1} is left to refund").format(
+				frappe.format_value(remaining, {"fieldtype": "Currency", "options": data.currency}),
+				integration_request.name,
+			)
+		)
+
+	return flt(amount) or (remaining if flt(data.refunded_amount) else None)
+
+
+def record_refunds(refunds):
+	"""Record `{Integration Request name: refund or list of refunds}` with a single write.
+
+	Refunds whose `refund_id` is already recorded are skipped, so a refund reported
+	again, e.g. by a webhook, is neither counted nor notified twice. A refund with
+	`total_refunded` instead of `refunded_amount` (a gateway only reporting the running
+	total) records what the total adds to the recorded refunds.
+	"""
+	if not refunds:
+		return
+
+	found, changed = set(), []
+	for doctype in ("Integration Request", "Integration Request Archive"):
+		names = [name for name in refunds if name not in found]
+		if not names:
+			break
+
+		# read-modify-write of `data`, locked so that concurrent refunds are not lost
+		rows = frappe.db.get_values(
+			doctype,
+			{"name": ("in", names)},
+			["name", "data"],
+			as_dict=True,
+			for_update=True,
+		)
+
+		updates = {}
+		for request in rows:
+			found.add(request.name)
+			data = get_request_data(request)
+			if add_refunds(data, refunds[request.name]):
+				request.data = data
+				updates[request.name] = {"data": json.dumps(data, default=str)}
+				changed.append(request)
+
+		if updates:
+			frappe.db.bulk_update(doctype, updates)
+
+	for request in changed:
+		notify_reference_document(request.name, request.data)
+
+
+def add_refunds(data, refunds):
+	"""Add new `refunds` to the request `data`, returns whether any was new"""
+	recorded = {refund.get("refund_id") for refund in data.get("refunds") or []}
+	added = False
+
+	for refund in refunds if isinstance(refunds, list) else [refunds]:
+		refund_id = refund.get("refund_id")
+		if refund_id and refund_id in recorded:
+			continue
+
+		amount = flt(refund.get("refunded_amount"))
+		if refund.get("total_refunded") is not None:
+			amount = flt(refund.get("total_refunded")) - flt(data.refunded_amount)
+			if to_minor_units(amount, data.currency) <= 0:
+				continue
+
+		data.setdefault("refunds", []).append(
+			{
+				"refund_id": refund_id,
+				"amount": amount,
+				"status": refund.get("status"),
+				"refunded_on": str(now_datetime()),
+			}
+		)
+		data.refunded_amount = flt(data.refunded_amount) + amount
+		recorded.add(refund_id)
+		added = True
+
+	return added
+
+
+def notify_reference_document(name, data):
+	if not (data.reference_doctype and data.reference_docname):
+		return
+
+	try:
+		frappe.flags.data = data
+		frappe.get_doc(data.reference_doctype, data.reference_docname).run_method(
+			"on_payment_refunded", data.refunded_amount
+		)
+	except Exception:
+		frappe.log_error(frappe.get_traceback(), f"Refund notification failed for {name}")
@@ -0,0 +1,88 @@
+"""
+Routing of payments to the gateway best able to take them.
+
+`route_payment(currency, amount, payment_gateway=None)` picks the Payment Gateway for
+a payment from:
+
+- the currencies each gateway supports and its minimum amount per currency, from the
+  currency registry of `payments.utils.currency`, so routing never loads gateway
+  settings.
+- `payments_routing_rules` in site config, a list of rules like
+  `{"currency": "INR", "min_amount": 0, "max_amount": 100000, "gateways": [...]}`.
+  The first rule matching the payment limits the gateways it may go to, every key
+  but `gateways` is optional.
+- the circuit breaker state and live call statistics of each gateway, see
+  `payments.utils.circuit_breaker`
+
+Without a matching rule, a payment for a given `payment_gateway` stays with it while
+it is healthy and otherwise moves to one of its alternates
+(`payments_alternate_gateways[payment_gateway]` in site config). Among candidates,
+healthy gateways come before those whose breaker is probing, and the fastest first.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+from payments.utils.circuit_breaker import CLOSED, OPEN, get_circuit_state, get_circuit_stats
+from payments.utils.currency import get_minimum_amount, supports_currency
+
+
+def get_payment_gateways():
+	return frappe.get_all("Payment Gateway", pluck="name")
+
+
+def can_take_payment(gateway, currency, amount):
+	return supports_currency(gateway, currency) and flt(amount) >= get_minimum_amount(
+		gateway, currency
+	)
+
+
+def get_routing_rule(currency, amount):
+	amount = flt(amount)
+	for rule in frappe.conf.payments_routing_rules or []:
+		if rule.get("currency") and rule["currency"] != currency:
+			continue
+		if rule.get("min_amount") is not None and amount < flt(rule["min_amount"]):
+			continue
+		if rule.get("max_amount") is not None and amount > flt(rule["max_amount"]):
+			continue
+
+		return rule
+
+
+def route_payment(currency, amount, payment_gateway=None):
+	"""Return the Payment Gateway a payment of `amount` in `currency` should go to.
+	Only site config decides which gateways a payment may move to, never the request."""
+	rule = get_routing_rule(currency, amount)
+
+	if rule:
+		candidates = rule.get("gateways") or []
+	elif payment_gateway:
+		alternate_gateways = (frappe.conf.payments_alternate_gateways or {}).get(payment_gateway)
+		candidates = [payment_gateway, *(alternate_gateways or [])]
+	else:
+		candidates = get_payment_gateways()
+
+	states = {}
+	for gateway in candidates:
+		if can_take_payment(gateway, currency, amount):
+			state = get_circuit_state(gateway)
+			if state != OPEN:
+				states[gateway] = state
+
+	if not states:
+		if payment_gateway:
+			# let the gateway of the payment report why it can not take it
+			return payment_gateway
+
+		frappe.throw(
+			_("No payment gateway can take payments of {0} {1} right now").format(currency, amount)
+		)
+
+	if not rule and states.get(payment_gateway) == CLOSED:
+		return payment_gateway
+
+	return min(
+		states, key=lambda gateway: (states[gateway] != CLOSED, get_circuit_stats(gateway).latency)
+	)
@@ -0,0 +1,173 @@
+import csv
+
+import frappe
+from frappe import _
+from frappe.utils import cint, cstr, flt
+
+from payments.utils import get_request_data
+from payments.utils.currency import from_minor_units, to_minor_units
+
+# column layouts of the settlement reports downloaded from each gateway
+SETTLEMENT_LAYOUTS = {
+	# Settlement Recon report, amounts are in the minor unit of their currency
+	"Razorpay": frappe._dict(
+		payment_id="entity_id",
+		amount="amount",
+		currency="currency",
+		minor_units=True,
+		type_column="type",
+		types=("payment",),
+		# order flow requests are created with the amount in paise, see `create_order`
+		minor_unit_requests="razorpay_order_id",
+	),
+	# Itemized balance change / payout reconciliation report
+	"Stripe": frappe._dict(
+		payment_id="source_id",
+		amount="gross",
+		currency="currency",
+		minor_units=False,
+		type_column="reporting_category",
+		types=("charge",),
+	),
+	# Activity download report
+	"PayPal": frappe._dict(
+		payment_id="Transaction ID",
+		amount="Gross",
+		currency="Currency",
+		minor_units=False,
+		type_column=None,
+		types=(),
+	),
+}
+
+UNMATCHED_SAMPLE_SIZE = 100
+
+
+def import_settlement_file(file_path, gateway, batch_size=1000):
+	"""
+	Match a settlement report of `gateway` against Integration Requests and mark
+	them Settled or Mismatched.
+
+	The file is read in a single pass, `batch_size` rows at a time. Each batch is
+	looked up with one query on `gateway_payment_id` and written back with one bulk
+	update, so memory is bounded by the batch size regardless of file size. Payments
+	not found are looked up in Integration Request Archive.
+
+	Amounts are compared in the minor unit of their currency.
+	"""
+	layout = SETTLEMENT_LAYOUTS.get(gateway)
+	if not layout:
+		frappe.throw(
+			_("Settlement import is not supported for {0}. Supported gateways are {1}").format(
+				gateway, ", ".join(SETTLEMENT_LAYOUTS)
+			)
+		)
+
+	summary = frappe._dict(rows=0, settled=0, mismatched=0, unmatched=0, unmatched_ids=[])
+
+	with open(file_path, newline="", encoding="utf-8-sig") as f:
+		reader = csv.DictReader(f)
+		validate_columns(reader.fieldnames or [], layout, gateway)
+
+		batch = {}
+		for row in reader:
+			if layout.type_column and row.get(layout.type_column) not in layout.types:
+				continue
+
+			entry = parse_settlement_row(row, layout)
+			if not entry.payment_id:
+				continue
+
+			batch[entry.payment_id] = entry
+			if len(batch) >= batch_size:
+				match_settlement_batch(gateway, batch, summary)
+				batch = {}
+
+		if batch:
+			match_settlement_batch(gateway, batch, summary)
+
+	return summary
+
+
+def validate_columns(columns, layout, gateway):
+	required = [layout.payment_id, layout.amount, layout.currency]
+	if layout.type_column:
+		required.append(layout.type_column)
+
+	missing = [column for column in required if column not in columns]
+	if missing:
+		frappe.throw(
+			_("Settlement file is missing {0} columns: {1}").format(gateway, ", ".join(missing))
+		)
+
+
+def parse_settlement_row(row, layout):
+	amount = flt(cstr(row.get(layout.amount)).replace(",", ""))
+	currency = cstr(row.get(layout.currency)).strip().upper()
+	if layout.minor_units:
+		minor_amount = cint(amount)
+		amount = from_minor_units(amount, currency)
+	else:
+		minor_amount = to_minor_units(amount, currency)
+
+	return frappe._dict(
+		payment_id=cstr(row.get(layout.payment_id)).strip(),
+		amount=amount,
+		minor_amount=minor_amount,
+		currency=currency,
+	)
+
+
+def get_request_minor_amount(data, layout, currency):
+	"""Return the amount of a request in the minor unit of `currency`"""
+	if layout.minor_unit_requests and data.get(layout.minor_unit_requests):
+		return cint(flt(data.get("amount")))
+
+	return to_minor_units(data.get("amount"), currency)
+
+
+def match_settlement_batch(gateway, batch, summary):
+	layout = SETTLEMENT_LAYOUTS[gateway]
+	matched = set()
+
+	for doctype in ("Integration Request", "Integration Request Archive"):
+		payment_ids = [payment_id for payment_id in batch if payment_id not in matched]
+		if not payment_ids:
+			break
+
+		requests = frappe.get_all(
+			doctype,
+			filters={
+				"integration_request_service": gateway,
+				"gateway_payment_id": ("in", payment_ids),
+			},
+			fields=["name", "gateway_payment_id", "data"],
+		)
+
+		updates = {}
+		for request in requests:
+			entry = batch[request.gateway_payment_id]
+			data = get_request_data(request)
+			matched.add(request.gateway_payment_id)
+
+			currency = cstr(data.get("currency")).upper()
+			is_settled = (not currency or currency == entry.currency) and get_request_minor_amount(
+				data, layout, entry.currency
+			) == entry.minor_amount
+			updates[request.name] = {
+				"settlement_status": "Settled" if is_settled else "Mismatched",
+				"settled_amount": entry.amount,
+			}
+			summary["settled" if is_settled else "mismatched"] += 1
+
+		if updates:
+			frappe.db.bulk_update(doctype, updates, update_modified=False)
+
+	frappe.db.commit()
+
+	summary.rows += len(batch)
+	for payment_id in batch:
+		if payment_id not in matched:
+			summary.unmatched += 1
+			if len(summary.unmatched_ids) < UNMATCHED_SAMPLE_SIZE:
+				summary.unmatched_ids.append(payment_id)
@@ -0,0 +1,169 @@
+"""
+Short lived cache of payments fetched from gateways.
+
+The same payment is often looked up several times within seconds: the checkout page
+and the gateway's callback both confirm it, and background jobs check it again.
+`get_payment_status_cache(gateway, payment_id).get(fetch)` returns what `fetch()`
+returned for the payment within the last `payments_status_cache_ttl` seconds (site
+config, default 30), and makes concurrent lookups of one payment share one call:
+
+- threads of the same process wait for the call already in flight
+- other workers wait up to `LOCK_TIMEOUT` seconds for the worker holding the lock in
+  redis to store its result, and call the gateway themselves after that
+
+Cached payments are dropped whenever the status of their Integration Request changes
+(see `clear_payment_status`), unless the cached payment is what the request changed
+to: `get(fetch, get_status)` keeps the Integration Request status the payment maps to
+along with it, so e.g. the payment that authorized a request is still cached when it
+is captured. Each drop bumps a version, so a call that was in flight during the change
+does not store its now stale result.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+import frappe
+from frappe.utils import cint
+
+DEFAULT_TTL = 30
+LOCK_TIMEOUT = 30
+POLL_INTERVAL = 0.1
+
+# Delete the lock at KEYS[1] only if it still holds ARGV[1], so that a worker whose
+# lock expired does not release the lock of the worker that took it over.
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+	return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class PaymentStatusCache:
+	"""Cache of one payment, safe to use from worker threads"""
+
+	def __init__(self, cache, key, ttl, release_script):
+		self.cache = cache
+		self.key = key
+		self.version_key = f"{key}:version"
+		self.lock_key = f"{key}:lock"
+		self.ttl = ttl
+		self.release_script = release_script
+
+	def get(self, fetch, get_status=None):
+		"""Return the cached payment, or the result of `fetch()` shared with concurrent
+		lookups of the same payment. `get_status(payment)` returns the Integration
+		Request status the payment maps to, if any."""
+		version, payment = self.get_cached()
+		if payment is not None:
+			return payment
+
+		with _flights_lock:
+			flight = _flights.get(self.key)
+			leader = flight is None
+			if leader:
+				flight = _flights[self.key] = Future()
+
+		if not leader:
+			return flight.result()
+
+		try:
+			payment = self.fetch_once(fetch, version, get_status)
+		except BaseException as e:
+			flight.set_exception(e)
+			raise
+		else:
+			flight.set_result(payment)
+		finally:
+			with _flights_lock:
+				_flights.pop(self.key, None)
+
+		return payment
+
+	def get_cached(self):
+		"""Return the current version and the payment cached for it, if any"""
+		version, value = self.cache.mget(self.version_key, self.key)
+		version = cint(version)
+		if value is None:
+			return version, None
+
+		value = json.loads(value)
+		return version, value["payment"] if value["version"] == version else None
+
+	def fetch_once(self, fetch, version, get_status=None):
+		lock = frappe.generate_hash(length=10)
+		if self.cache.set(self.lock_key, lock, nx=True, ex=LOCK_TIMEOUT):
+			try:
+				payment = fetch()
+				self.cache.set(
+					self.key,
+					json.dumps(
+						{
+							"version": version,
+							"payment": payment,
+							"status": get_status(payment) if get_status else None,
+						},
+						default=str,
+					),
+					ex=self.ttl,
+				)
+				return payment
+			finally:
+				self.release_script(keys=[self.lock_key], args=[lock])
+
+		# another worker is fetching the payment
+		deadline = time.monotonic() + LOCK_TIMEOUT
+		while time.monotonic() < deadline:
+			time.sleep(POLL_INTERVAL)
+			payment = self.get_cached()[1]
+			if payment is not None:
+				return payment
+
+			if not self.cache.get(self.lock_key):
+				# it failed, or the payment changed meanwhile
+				break
+
+		return fetch()
+
+
+def get_cache_key(gateway, payment_id):
+	return frappe.cache().make_key(f"payments:payment_status:{gateway}:{payment_id}")
+
+
+def get_payment_status_cache(gateway, payment_id):
+	"""Return the cache of payment `payment_id` of `gateway` (the service name of its
+	Integration Requests), must be called from the main thread"""
+	ttl = cint(frappe.conf.payments_status_cache_ttl) or DEFAULT_TTL
+	cache = frappe.cache()
+	return PaymentStatusCache(
+		cache, get_cache_key(gateway, payment_id), ttl, cache.register_script(RELEASE_SCRIPT)
+	)
+
+
+def invalidate_payment_status(gateway, payment_id):
+	key = get_cache_key(gateway, payment_id)
+
+	pipeline = frappe.cache().pipeline()
+	pipeline.incr(f"{key}:version")
+	pipeline.expire(f"{key}:version", 24 * 60 * 60)
+	pipeline.delete(key)
+	pipeline.execute()
+
+
+def clear_payment_status(doc, method=None):
+	"""`on_change` hook for Integration Request, drops its cached payment unless it is
+	the one the request changed to"""
+	if not (doc.integration_request_service and doc.gateway_payment_id):
+		return
+
+	key = get_cache_key(doc.integration_request_service, doc.gateway_payment_id)
+	value = frappe.cache().get(key)
+	if value is not None and doc.status and json.loads(value).get("status") == doc.status:
+		return
+
+	invalidate_payment_status(doc.integration_request_service, doc.gateway_payment_id)
@@ -1,8 +1,15 @@
+import json
+
 import click
 import frappe
 from frappe import _
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
+from payments.utils.routing import route_payment
+from payments.utils.velocity import velocity_limit
+
+CHECKOUT_SESSION_TTL = 30 * 60
+
 
 def get_payment_gateway_controller(payment_gateway):
 	"""Return payment gateway controller"""
@@ -19,11 +26,106 @@ def get_payment_gateway_controller(payment_gateway):
 			frappe.throw(_("{0} Settings not found").format(payment_gateway))
 
 
+def get_integration_request_controller(integration_request):
+	"""Return the gateway controller that created `integration_request`"""
+	return get_payment_details_controller(
+		get_request_data(integration_request), integration_request.integration_request_service
+	)
+
+
+def get_payment_details_controller(data, service_name):
+	"""Return the gateway controller of the payment details `data` of a request: the
+	Payment Gateway the payment was routed to, else the one of its reference document,
+	else `service_name`"""
+	data = frappe._dict(data)
+	payment_gateway = data.get("payment_gateway")
+
+	if (
+		not payment_gateway
+		and data.reference_doctype
+		and data.reference_docname
+		and frappe.get_meta(data.reference_doctype).has_field("payment_gateway")
+	):
+		payment_gateway = frappe.db.get_value(
+			data.reference_doctype, data.reference_docname, "payment_gateway"
+		)
+
+	return get_payment_gateway_controller(payment_gateway or service_name)
+
+
+def get_integration_request(name, for_update=False):
+	"""Return Integration Request `name`, falling back to Integration Request Archive
+	once the request has been archived"""
+	try:
+		return frappe.get_doc("Integration Request", name, for_update=for_update)
+	except frappe.DoesNotExistError:
+		if not frappe.db.exists("Integration Request Archive", name):
+			raise
+
+		frappe.clear_last_message()
+		return frappe.get_doc("Integration Request Archive", name, for_update=for_update)
+
+
+def set_integration_request_status(integration_request, params, status):
+	"""Update the data and status of `integration_request` like its `update_status`, but
+	without committing, so that what follows from the change (e.g. the callback of
+	`authorize_reference_document`) is committed with it"""
+	data = get_request_data(integration_request)
+	data.update(params or {})
+	integration_request.data = json.dumps(data)
+	integration_request.status = status
+	integration_request.save(ignore_permissions=True)
+
+
+def get_request_data(integration_request):
+	"""Return the decoded `data` of an Integration Request, empty if it is not valid JSON"""
+	try:
+		return frappe._dict(json.loads(integration_request.data or "{}"))
+	except (TypeError, ValueError):
+		return frappe._dict()
+
+
+def get_checkout_session(token, service_name):
+	"""Return the payment details of a checkout session, the Integration Request
+	`get_payment_url` created for `service_name`. Checkout pages and `make_payment` read
+	them on every call, so the decoded details are cached for a while."""
+	cache_key = f"payments:checkout_session:{token}"
+	session = frappe.cache().get_value(cache_key)
+
+	if session is None:
+		integration_request = frappe.db.get_value(
+			"Integration Request", token, ["integration_request_service", "data"], as_dict=True
+		)
+		session = integration_request and (
+			integration_request.integration_request_service,
+			get_request_data(integration_request),
+		)
+		if session:
+			frappe.cache().set_value(cache_key, session, expires_in_sec=CHECKOUT_SESSION_TTL)
+
+	if not session or session[0] != service_name:
+		frappe.throw(_("Seems token you are using is invalid!"), frappe.DoesNotExistError)
+
+	return frappe._dict(session[1])
+
+
 @frappe.whitelist(allow_guest=True, xss_safe=True)
+@velocity_limit(reference=("reference_doctype", "reference_docname"), payer_email="payer_email")
 def get_checkout_url(**kwargs):
+	"""Return the checkout url of `payment_gateway`, or of the gateway the payment is
+	routed to when `payment_gateway` can not take it (see `payments.utils.routing`)"""
 	try:
 		if kwargs.get("payment_gateway"):
-			doc = frappe.get_doc("{} Settings".format(kwargs.get("payment_gateway")))
+			payment_gateway = route_payment(
+				kwargs.get("currency"),
+				kwargs.get("amount"),
+				kwargs["payment_gateway"],
+			)
+			if payment_gateway != kwargs["payment_gateway"]:
+				kwargs["payment_gateway"] = payment_gateway
+				doc = get_payment_gateway_controller(payment_gateway)
+			else:
+				doc = frappe.get_doc(f"{payment_gateway} Settings")
 			return doc.get_payment_url(**kwargs)
 		else:
 			raise Exception
@@ -136,6 +238,41 @@ def make_custom_fields():
 
 		frappe.clear_cache(doctype="Web Form")
 
+	if not frappe.get_meta("Integration Request").has_field("gateway_payment_id"):
+		click.secho("* Installing Payment Custom Fields in Integration Request")
+
+		create_custom_fields(
+			{
+				"Integration Request": [
+					{
+						"fieldname": "gateway_payment_id",
+						"fieldtype": "Data",
+						"label": "Gateway Payment ID",
+						"read_only": 1,
+						"search_index": 1,
+						"insert_after": "reference_docname",
+					},
+					{
+						"fieldname": "settlement_status",
+						"fieldtype": "Select",
+						"label": "Settlement Status",
+						"options": "\nSettled\nMismatched",
+						"read_only": 1,
+						"insert_after": "gateway_payment_id",
+					},
+					{
+						"fieldname": "settled_amount",
+						"fieldtype": "Float",
+						"label": "Settled Amount",
+						"read_only": 1,
+						"insert_after": "settlement_status",
+					},
+				]
+			}
+		)
+
+		frappe.clear_cache(doctype="Integration Request")
+
 
 def delete_custom_fields():
 	if frappe.get_meta("Web Form").has_field("payments_tab"):
@@ -159,6 +296,14 @@ def delete_custom_fields():
 
 		frappe.clear_cache(doctype="Web Form")
 
+	if frappe.get_meta("Integration Request").has_field("gateway_payment_id"):
+		click.secho("* Uninstalling Payment Custom Fields from Integration Request")
+
+		for fieldname in ("gateway_payment_id", "settlement_status", "settled_amount"):
+			frappe.db.delete("Custom Field", {"name": "Integration Request-" + fieldname})
+
+		frappe.clear_cache(doctype="Integration Request")
+
 
 def before_install():
 	# TODO: remove this
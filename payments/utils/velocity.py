@@ -0,0 +1,141 @@
+"""
+Velocity checks for the guest endpoints that start payments.
+
+Endpoints like `get_order`, `get_checkout_url` and the `make_payment` of checkout
+pages create gateway orders, sessions and Integration Requests for anonymous
+callers. `velocity_limit` caps how often they are called per client IP, payer email
+and reference document (or checkout token) before any of that work is done:
+
+- attempts are counted in a sliding window per endpoint and key in redis, shared by
+  all web workers
+- once a key is over its limit, the worker remembers it until the window frees a
+  slot, and refuses further attempts without asking redis
+
+Limits are `payments_velocity_limits` in site config, `[attempts, seconds]` by key,
+e.g. `{"ip": [30, 60], "payer_email": [10, 60], "reference": [10, 60]}`, see
+`DEFAULT_LIMITS`. Refused attempts raise `frappe.TooManyRequestsError` and are not
+counted.
+"""
+
+import threading
+import time
+from functools import wraps
+
+import frappe
+from frappe import _
+
+DEFAULT_LIMITS = {
+	"ip": (30, 60),
+	"payer_email": (10, 60),
+	"reference": (10, 60),
+}
+
+# remembered keys over their limit, pruned once there are more
+MAX_BLOCKED_KEYS = 10000
+
+_blocked = {}
+_blocked_lock = threading.Lock()
+
+
+def velocity_limit(reference=None, payer_email=None):
+	"""Limit attempts of the decorated endpoint per client IP, and per the values of
+	its `payer_email` argument and its `reference` arguments (one name or a tuple of
+	names identifying the reference document)"""
+	if isinstance(reference, str):
+		reference = (reference,)
+
+	def decorator(fn):
+		endpoint = f"{fn.__module__}.{fn.__name__}"
+
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			keys = {"ip": frappe.local.request_ip}
+			if payer_email:
+				keys["payer_email"] = kwargs.get(payer_email)
+			if reference and all(kwargs.get(arg) for arg in reference):
+				keys["reference"] = ":".join(str(kwargs[arg]) for arg in reference)
+
+			check_velocity(endpoint, keys)
+			return fn(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+
+def get_limits():
+	return dict(DEFAULT_LIMITS, **(frappe.conf.payments_velocity_limits or {}))
+
+
+def check_velocity(endpoint, keys):
+	"""Count an attempt at `endpoint` for each of `keys` (`{key type: value}`), throws
+	if any of them is over its limit"""
+	limits = get_limits()
+	cache = frappe.cache()
+
+	windows = []
+	for key_type, value in keys.items():
+		if not value or not limits.get(key_type):
+			continue
+
+		limit, seconds = limits[key_type]
+		key = cache.make_key(f"payments:velocity:{endpoint}:{key_type}:{value}")
+		if is_blocked(key):
+			raise_too_many_attempts()
+
+		windows.append((key, int(limit), float(seconds)))
+
+	if not windows:
+		return
+
+	now = time.time()
+	attempt = f"{now}:{frappe.generate_hash(length=6)}"
+
+	pipeline = cache.pipeline()
+	for key, _limit, seconds in windows:
+		pipeline.zremrangebyscore(key, 0, now - seconds)
+		pipeline.zadd(key, {attempt: now})
+		pipeline.zcard(key)
+		pipeline.zrange(key, 0, 0, withscores=True)
+		pipeline.expire(key, int(seconds) + 1)
+	results = pipeline.execute()
+
+	refused = False
+	for i, (key, limit, seconds) in enumerate(windows):
+		attempts, oldest = results[i * 5 + 2], results[i * 5 + 3]
+		if attempts > limit:
+			refused = True
+			block(key, (oldest[0][1] if oldest else now) + seconds)
+
+	if refused:
+		pipeline = cache.pipeline()
+		for key, _limit, _seconds in windows:
+			pipeline.zrem(key, attempt)
+		pipeline.execute()
+
+		raise_too_many_attempts()
+
+
+def is_blocked(key):
+	until = _blocked.get(key)
+	return until is not None and until > time.time()
+
+
+def block(key, until):
+	with _blocked_lock:
+		if len(_blocked) >= MAX_BLOCKED_KEYS:
+			now = time.time()
+			for blocked_key in [k for k, blocked_until in _blocked.items() if blocked_until <= now]:
+				del _blocked[blocked_key]
+
+			if len(_blocked) >= MAX_BLOCKED_KEYS:
+				_blocked.clear()
+
+		_blocked[key] = until
+
+
+def raise_too_many_attempts():
+	frappe.throw(
+		_("Too many payment attempts, please try again in a little while"),
+		frappe.TooManyRequestsError,
+	)
@@ -0,0 +1,437 @@
+"""
+Asynchronous ingestion of gateway notifications.
+
+With `payments_async_webhooks` enabled in site config, webhook endpoints only persist
+the raw payload and headers as a "Webhook Received" Integration Request and respond.
+Validating the notification with the gateway and handing it to
+`handle_subscription_notification` happens in `process_notification` on a worker.
+
+With `payments_buffered_webhooks` enabled, endpoints do not write to the database at
+all. Notifications are pushed to a bounded redis list and `flush_notification_buffer`
+bulk inserts them every `payments_webhook_flush_size` notifications or
+`payments_webhook_flush_interval` milliseconds, whichever comes first.
+
+With `payments_batch_subscription_notifications` enabled, validated notifications are
+not handed over one job each. `process_subscription_notifications` drains them in
+batches through the `handle_subscription_notifications` hook instead.
+
+Gateways deliver notifications at least once, so every notification is first claimed
+by its event id (or a hash of its payload) for `payments_webhook_dedup_ttl` seconds
+and redeliveries are dropped before anything is written or queued.
+"""
+
+import json
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import call_hook_method, cint, now_datetime
+
+from payments.utils import idempotency
+
+# PayPal retries IPNs for up to 4 days, Razorpay retries webhooks for 24 hours
+DEFAULT_DEDUP_TTL = 4 * 24 * 60 * 60
+
+DEFAULT_BUFFER_SIZE = 10000
+DEFAULT_FLUSH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 500
+
+# redis lists, notifications are moved from the buffer to the processing list while
+# being flushed and only dropped from it once they are committed to the database
+BUFFER_KEY = "payments:webhook_buffer"
+PROCESSING_KEY = "payments:webhook_buffer_processing"
+
+WEBHOOK_RECEIVED = "Webhook Received"
+SUBSCRIPTION_NOTIFICATION = "Subscription Notification"
+
+# request headers not worth keeping (or not safe to keep) with the payload
+IGNORED_HEADERS = ("Authorization", "Cookie")
+
+NOTIFICATION_METHODS = {
+	"Razorpay": (
+		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.validate_payment_callback",
+		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.handle_subscription_notification",
+	),
+	"PayPal": (
+		"payments.payment_gateways.doctype.paypal_settings.paypal_settings.validate_ipn_request",
+		"payments.payment_gateways.doctype.paypal_settings.paypal_settings.handle_subscription_notification",
+	),
+}
+
+
+def is_async_webhooks_enabled():
+	return cint(frappe.conf.payments_async_webhooks)
+
+
+def is_buffered_webhooks_enabled():
+	return cint(frappe.conf.payments_buffered_webhooks)
+
+
+def is_batch_notifications_enabled():
+	return cint(frappe.conf.payments_batch_subscription_notifications)
+
+
+def claim_notification(gateway, data, event_id=None):
+	"""Return the idempotency key of a notification, or None if it was already received"""
+	key = event_id or idempotency.get_payload_hash(data)
+	ttl = cint(frappe.conf.payments_webhook_dedup_ttl) or DEFAULT_DEDUP_TTL
+
+	if idempotency.claim(f"{gateway} Notification", key, ttl):
+		return key
+
+
+def release_notification(gateway, key):
+	"""Forget a notification that could not be processed, so its redelivery is processed"""
+	idempotency.release(f"{gateway} Notification", key)
+
+
+def get_request_headers():
+	if not getattr(frappe.local, "request", None):
+		return {}
+
+	return {
+		key: value
+		for key, value in frappe.local.request.headers.items()
+		if key not in IGNORED_HEADERS
+	}
+
+
+def receive_notification(gateway, data):
+	"""Accept a notification without validating it, buffered in redis or stored as a
+	Webhook Received Integration Request depending on site config"""
+	if is_buffered_webhooks_enabled():
+		buffer_notification(gateway, data)
+	else:
+		ingest_notification(gateway, data)
+
+
+def ingest_notification(gateway, data, headers=None):
+	"""Persist a raw notification of `gateway` with a single insert and queue it for
+	validation, without calling the gateway"""
+	data = dict(data)
+	data.pop("cmd", None)
+	data["payment_gateway"] = gateway
+
+	doc = frappe.get_doc(
+		{
+			"doctype": "Integration Request",
+			"integration_request_service": gateway,
+			"request_description": WEBHOOK_RECEIVED,
+			"is_remote_request": 1,
+			"status": "Queued",
+			"data": json.dumps(data),
+			"request_headers": json.dumps(headers if headers is not None else get_request_headers()),
+		}
+	).insert(ignore_permissions=True)
+	frappe.db.commit()
+
+	frappe.enqueue(
+		"payments.utils.webhooks.process_notification",
+		queue="long",
+		timeout=600,
+		enqueue_after_commit=True,
+		docname=doc.name,
+	)
+
+	return doc
+
+
+def buffer_notification(gateway, data, headers=None):
+	"""Push a raw notification of `gateway` to the redis buffer. Raises
+	`TooManyRequestsError`, so that the gateway retries later, when the buffer is full."""
+	cache = frappe.cache()
+	if cache.llen(BUFFER_KEY) >= (cint(frappe.conf.payments_webhook_buffer_size) or DEFAULT_BUFFER_SIZE):
+		frappe.throw(
+			_("Too many notifications pending, please retry later"),
+			exc=frappe.TooManyRequestsError,
+		)
+
+	data = dict(data)
+	data.pop("cmd", None)
+	data["payment_gateway"] = gateway
+
+	cache.lpush(
+		BUFFER_KEY,
+		json.dumps(
+			{
+				"name": frappe.generate_hash(length=10),
+				"gateway": gateway,
+				"data": data,
+				"headers": headers if headers is not None else get_request_headers(),
+				"received_at": str(now_datetime()),
+			},
+			default=str,
+		),
+	)
+
+	if idempotency.claim("Webhook Buffer", "scheduled", ttl=60):
+		frappe.enqueue(
+			"payments.utils.webhooks.flush_notification_buffer", queue="short", timeout=600
+		)
+
+
+def flush_notification_buffer():
+	"""Bulk insert buffered notifications as Webhook Received Integration Requests and
+	queue their validation. Also runs on the `all` scheduler to pick up stragglers."""
+	# let notifications arriving from now on schedule another flush
+	idempotency.release("Webhook Buffer", "scheduled")
+
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key("payments:webhook_buffer_flush"), timeout=600)
+	if not lock.acquire(blocking=True, blocking_timeout=60):
+		return
+
+	try:
+		# notifications of a flush that died before acknowledging them, inserting them
+		# again is harmless since duplicates (by name) are ignored
+		entries = cache.lrange(PROCESSING_KEY, 0, -1) or collect_buffered_notifications()
+
+		while entries:
+			insert_notifications([json.loads(entry) for entry in entries])
+			cache.delete_value(PROCESSING_KEY)
+			entries = collect_buffered_notifications()
+	finally:
+		lock.release()
+
+
+def collect_buffered_notifications():
+	"""Move up to `payments_webhook_flush_size` notifications to the processing list,
+	waiting at most `payments_webhook_flush_interval` ms for the batch to fill up"""
+	cache = frappe.cache()
+	flush_size = cint(frappe.conf.payments_webhook_flush_size) or DEFAULT_FLUSH_SIZE
+	deadline = time.monotonic() + (
+		cint(frappe.conf.payments_webhook_flush_interval) or DEFAULT_FLUSH_INTERVAL
+	) / 1000
+
+	entries = []
+	while len(entries) < flush_size:
+		# `rpoplpush` is not namespaced by RedisWrapper unlike `lrange` and `llen`
+		entry = cache.rpoplpush(cache.make_key(BUFFER_KEY), cache.make_key(PROCESSING_KEY))
+		if entry:
+			entries.append(entry)
+			continue
+
+		if not entries or time.monotonic() >= deadline:
+			break
+
+		time.sleep(0.05)
+
+	return entries
+
+
+def insert_notifications(notifications):
+	fields = (
+		"name",
+		"creation",
+		"modified",
+		"owner",
+		"modified_by",
+		"integration_request_service",
+		"request_description",
+		"is_remote_request",
+		"status",
+		"data",
+		"request_headers",
+	)
+
+	frappe.db.bulk_insert(
+		"Integration Request",
+		fields=fields,
+		values=[
+			(
+				notification["name"],
+				notification["received_at"],
+				notification["received_at"],
+				"Guest",
+				"Guest",
+				notification["gateway"],
+				WEBHOOK_RECEIVED,
+				1,
+				"Queued",
+				json.dumps(notification["data"]),
+				json.dumps(notification["headers"]),
+			)
+			for notification in notifications
+		],
+		ignore_duplicates=True,
+	)
+	frappe.db.commit()
+
+	frappe.enqueue(
+		"payments.utils.webhooks.process_notifications",
+		queue="long",
+		timeout=600,
+		docnames=[notification["name"] for notification in notifications],
+	)
+
+
+def process_notifications(docnames):
+	for docname in docnames:
+		try:
+			process_notification(docname)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(frappe.get_traceback(), f"{docname} notification processing failed")
+
+
+def process_notification(docname):
+	"""Validate a received notification with its gateway and hand it over to
+	`handle_subscription_notification`, then mark it Completed (or Failed)"""
+	doc = frappe.get_doc("Integration Request", docname)
+	if doc.request_description != WEBHOOK_RECEIVED or doc.status != "Queued":
+		return
+
+	if not validate_notification(doc):
+		return
+
+	if is_batch_notifications_enabled():
+		schedule_subscription_notifications()
+		return
+
+	validator, handler = NOTIFICATION_METHODS[doc.integration_request_service]
+	try:
+		frappe.get_attr(handler)(doctype="Integration Request", docname=doc.name)
+	except Exception:
+		frappe.db.rollback()
+		mark_notifications_processed([doc.name], {doc.name: frappe.get_traceback()})
+		raise
+
+	mark_notifications_processed([doc.name], {})
+
+
+def validate_notification(doc):
+	"""Validate a received notification, promoting it to a queued Subscription
+	Notification. Returns False if the notification was rejected."""
+	if doc.integration_request_service not in NOTIFICATION_METHODS:
+		doc.db_set({"status": "Failed", "error": _("Unsupported notification gateway")})
+		return False
+
+	validator, handler = NOTIFICATION_METHODS[doc.integration_request_service]
+
+	try:
+		frappe.get_attr(validator)(frappe._dict(json.loads(doc.data)))
+	except frappe.InvalidStatusError:
+		doc.db_set({"status": "Cancelled", "error": frappe.get_traceback()})
+		frappe.db.commit()
+		return False
+	except Exception:
+		doc.db_set({"status": "Failed", "error": frappe.get_traceback()})
+		frappe.db.commit()
+		frappe.log_error(doc.error, f"{doc.name} notification validation failed")
+		return False
+
+	doc.db_set("request_description", SUBSCRIPTION_NOTIFICATION)
+	frappe.db.commit()
+	return True
+
+
+def schedule_subscription_notifications():
+	"""Queue a run of `process_subscription_notifications` unless one is already waiting"""
+	if idempotency.claim("Subscription Notifications", "scheduled", ttl=600):
+		frappe.enqueue(
+			"payments.utils.webhooks.process_subscription_notifications",
+			queue="long",
+			timeout=1500,
+			enqueue_after_commit=True,
+		)
+
+
+def process_subscription_notifications():
+	"""
+	Drain queued Subscription Notifications in batches of
+	`payments_notification_batch_size` (default 500).
+
+	Each batch is passed to the `handle_subscription_notifications(doctype, docnames)`
+	hook, which may return a dict of failed docnames and their errors. Without that
+	hook, or if it raises, the batch falls back to one `handle_subscription_notification`
+	call per notification. Notifications are then marked Completed or Failed.
+	"""
+	if not is_batch_notifications_enabled():
+		return
+
+	# let notifications arriving from now on schedule another run
+	idempotency.release("Subscription Notifications", "scheduled")
+
+	lock = frappe.cache().lock(
+		frappe.cache().make_key("payments:subscription_notifications"), timeout=1500
+	)
+	if not lock.acquire(blocking=False):
+		return
+
+	try:
+		batch_size = cint(frappe.conf.payments_notification_batch_size) or 500
+		while True:
+			docnames = frappe.get_all(
+				"Integration Request",
+				filters={
+					"request_description": SUBSCRIPTION_NOTIFICATION,
+					"status": "Queued",
+					"is_remote_request": 1,
+				},
+				order_by="creation asc",
+				limit=batch_size,
+				pluck="name",
+			)
+			if not docnames:
+				break
+
+			process_notification_batch(docnames)
+
+			if len(docnames) < batch_size:
+				break
+	finally:
+		lock.release()
+
+
+def process_notification_batch(docnames):
+	failed = None
+	if frappe.get_hooks("handle_subscription_notifications"):
+		try:
+			failed = {}
+			for method in frappe.get_hooks("handle_subscription_notifications"):
+				failed.update(
+					frappe.get_attr(method)(doctype="Integration Request", docnames=docnames) or {}
+				)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(frappe.get_traceback(), "Batch subscription notification failed")
+			failed = None
+
+	if failed is None:
+		failed = {}
+		for docname in docnames:
+			try:
+				call_hook_method(
+					"handle_subscription_notification", doctype="Integration Request", docname=docname
+				)
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				failed[docname] = frappe.get_traceback()
+
+	mark_notifications_processed(docnames, failed)
+
+
+def mark_notifications_processed(docnames, failed):
+	"""Mark processed notifications Completed, or Failed with the error in `failed`
+	({docname: error}), with one write each"""
+	completed = [docname for docname in docnames if docname not in failed]
+	if completed:
+		# handlers may have set a status of their own, only settle the ones still queued
+		frappe.db.set_value(
+			"Integration Request",
+			{"name": ("in", completed), "status": "Queued"},
+			"status",
+			"Completed",
+			update_modified=False,
+		)
+
+	if failed:
+		frappe.db.bulk_update(
+			"Integration Request",
+			{docname: {"status": "Failed", "error": error} for docname, error in failed.items()},
+			update_modified=False,
+		)
+
+	frappe.db.commit()